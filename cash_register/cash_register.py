@@ -5,15 +5,48 @@
     Общий интерфейс печати и выполнения команд на ККТ
 """
 import functools
+import logging
+from binascii import hexlify
 from collections import OrderedDict
+from contextlib import contextmanager
+from threading import RLock, Thread
+from timeit import default_timer
 
 import time
 
-from lc_cashcontrol.device_types.shtrih.shtrih_constants import WAITING_COMMANDS
-from middleware import LogMixin, SmartMixin
+from lc_cashcontrol.device_types.shtrih.breaker import BREAKER_CLOSED
+from lc_cashcontrol.device_types.shtrih.retry import DEFAULT_POLICIES, \
+    LAYER_COMMAND
+from lc_cashcontrol.device_types.shtrih.shtrih_constants import \
+    ERR_DATA_LENGTH, WAITING_COMMANDS
+from lc_cashcontrol.device_types.shtrih.shtrih_exceptions import \
+    ShtrihCommandError, ShtrihError
+from events import EVT_PLAN_STARTED, EVT_COMMAND, EVT_RESULT, EVT_ERROR, \
+    EVT_PLAN_FINISHED
+from frame_cache import FrameCache
+from layout import ITEM_COLUMNS, TableLayout, formatter, wrap_text
+from middleware import LogMixin, SmartMixin, device_identity
 from utils import format_string, prepare_barcode
 
 
+# Нефискальные команды калибровки: (команда, позиционные аргументы, именованные)
+CALIBRATION_PLAN = [
+    ("beep", (), {}),
+    ("get_status", (), {}),
+    ("get_short_status", (), {}),
+    ("feed_document", (1, ), {}),
+    ("cut_check", (), {}),
+]
+CALIBRATION_LENGTHS = (1, 19, 38)   # длины строк для калибровки печати
+CALIBRATION_TIMEOUT = 10    # предельное время выполнения команды при калибровке
+
+# Пауза между строками блока печати (в секундах)
+PACING_STEP = 0.02  # приращение на каждый ответ "идет печать"
+PACING_DECAY = 0.9  # уменьшение после блока без ответов "идет печать"
+PACING_MIN = 0.002  # меньшая пауза не выдерживается
+PACING_MAX = 0.5
+
+
 def define_user_case(exception, action, is_critical):
     """ Определение вариантов реакции пользователя
         на основе константы, обозначающей дальнейшее действие
@@ -42,96 +75,378 @@ def define_user_case(exception, action, is_critical):
 
 
 def command(method):
-    """ Обертка над процессом выполнения команды """
-    tries_to_exec = 10
-
+    """ Обертка над процессом выполнения команды
+        Число повторов определяется политикой уровня command
+        (CashRegister.retry_policies). Реакция на ошибку выбирается
+        политикой разрешения (CashRegister.resolution_policy), а при
+        отсутствии решения запрашивается у пользователя.
+        Исходный метод доступен в атрибуте raw обертки
+        (используется CashRegister.execute).
+    """
     @functools.wraps(method)
     def wrap(self, *args, **kwargs):
         def gen_wrap():
             name = method.__name__
             response = {}
-            for _ in range(tries_to_exec):
-                self.log_info('Make {}'.format(name))
-                self.log_debug("Args: {}".format(args))
-                self.log_debug("Kwargs: {}".format(kwargs))
-
-                try:
-                    response = method(self, *args, **kwargs)
-                except Exception as err:
-                    self.log_critical("Unhandled exception while making {}".format(name), err)
-                self.log_debug("Response: {}".format(response))
-
-                if response['exception']:
-                    exception = response['exception']
-                    desc = exception['description']
-                    if isinstance(desc, str):
-                        desc = unicode(desc, "utf-8")
-                    self.log_error(u"{0}: {1}".format(exception['code'], desc))
-
-                call_again = False
-                action = response['action']
-                self.log_info("Action: {}".format(action))
-
-                if action != 'continue':
-                    if response['exception']:
-                        reaction = yield define_user_case(
-                            response['exception'],
-                            response['action'],
-                            response['is_critical'])
-                    else:
-                        reaction = [response['action']]
-
-                    self.log_info("User choice: {}".format(reaction))
-                    for action in reaction:
-                        if action == 'break':
-                            if response['is_critical']:
-                                self.log_warning(u"Аннулирование чека")
-                                self.make_cancel_check()
-                        if action == 'retry':
-                            self.log_info(u"Повтор выполнения {}".format(name))
-                            call_again = True
-                            break
-                        if action == 'wait':
-                            wait_time = response['delta'] or 1
-                            time.sleep(wait_time)
-                            response['delta'] += wait_time
-                        else:
-                            break
-                if not call_again:
+            policy = self.retry_policies.get(LAYER_COMMAND, name)
+            for attempt in policy.attempts():
+                response = self._attempt_command(
+                    method, name, attempt, args, kwargs)
+                if response['action'] == 'continue':
+                    break
+                reaction = self._resolve_command(name, response, attempt)
+                if reaction is None:
+                    reaction = yield define_user_case(
+                        response['exception'],
+                        response['action'],
+                        response['is_critical'])
+                if not self._apply_reaction(name, response, reaction):
                     break
             else:
-                error = {
-                    'error': 'CashRegisterError',
-                    'message': u"'{}': Не удалось выолнить команду".format(name),
-                    'args': (),
-                    'code': -1,
-                    'description': u"Нет связи с устройством",
-                    'action': name
-                }
-                self.log_error(error)
-                response['exception'] = error
+                self._command_failed(name, response)
             yield response
         return gen_wrap()
+    wrap.raw = method
     return wrap
 
 
+def step_failed(response):
+    """ Признак прерывания плана на ответе команды
+        (ошибка, не завершившаяся пропуском команды)
+    """
+    return bool(response['exception']) and \
+        'skip' not in (response.get('reaction') or ())
+
+
 class CashRegister(LogMixin, SmartMixin):
-    """ Класс реализует общий набор команд к ККТ """
+    """ Класс реализует общий набор команд к ККТ
+
+        Многопоточность: обмен с устройством защищен блокировкой
+        профильного класса (каждая команда выполняется атомарно),
+        метрика команд (metric, last_command) -- блокировкой экземпляра.
+        Несколько потоков могут использовать один объект; порядок команд
+        документа между потоками не согласуется -- для этого
+        предназначен DeviceScheduler. Разные устройства обслуживаются
+        независимо (например, пулом потоков, по объекту на устройство).
+    """
 
-    def __init__(self, device):
+    metrics = None  # объект класса MetricsRegistry (статистика команд)
+    retry_policies = DEFAULT_POLICIES   # политики повторов (RetryPolicies)
+    # политика разрешения ошибок без участия пользователя
+    # (ResolutionPolicy); None -- решение всегда за пользователем
+    resolution_policy = None
+    # кэш кадров печати строк (FrameCache), общий для всех устройств;
+    # None -- кадры строятся для каждой строки
+    frame_cache = FrameCache()
+
+    def __init__(self, device, namespace=None):
         """ Класс агрегирует при создании экземпляр профильного класса,
             реализующего протокол обмена информацией с определенным
             типом устройства. Передаваемый объект содержит открытое
             соединение с устройством.
+            :param device: экземпляр профильного класса
+            :param namespace: пространство имен метрики устройства
+                (по умолчанию определяется портом подключения и
+                уточняется при подключении к устройству)
         """
         super(CashRegister, self).__init__()
+        self.__lock = RLock()   # блокировка метрики команд
         self.__device = device
+        self.__namespace = namespace    # явно заданное пространство имен
+        self.bind_smart(namespace or self.__port_namespace(device.port))
 
         self.metric = self.get_commands_metric()
         self.last_command = ''
         self.delta_step = self.__device.delta_step()
+        self.__batch = (None, 0)    # незавершенная серия продаж
 
         self.init_connection_parameters()
+        self.__bind_port()
+
+    def __port_namespace(self, port):
+        """ Пространство имен метрики устройства на порту: пространство,
+            уточненное отпечатком устройства (bind_device_namespace),
+            если оно единственное для порта, иначе -- по порту
+            :param port: порт подключения
+        """
+        identity = device_identity(port)
+        storage = self.get_smart_storage()
+        if port and storage is not None:
+            refined = [key for key in storage.namespaces
+                       if key.startswith(identity + '|')]
+            if len(refined) == 1:
+                return refined[0]
+        return identity
+
+    def __bind_port(self):
+        """ Привязка метрики к порту, ставшему известным после подключения
+            (сохраненные параметры, инициализация, поиск устройства)
+        """
+        port = self.__device.port
+        if self.__namespace is not None or not port or \
+                self.smart_namespace.split('|')[0] == device_identity(port):
+            return
+        with self.__lock:
+            self.bind_smart(self.__port_namespace(port))
+            self.metric = self.get_commands_metric()
+
+    def _attempt_command(self, method, name, attempt, args, kwargs):
+        """ Однократное выполнение команды с журналированием и учетом
+            в статистике
+            :returns ответ профильного класса
+        """
+        response = {}
+        info = self.log_enabled(logging.INFO)
+        debug = self.log_enabled(logging.DEBUG)
+        if info:
+            self.log_info('Make {}'.format(name))
+        if debug:
+            self.log_debug("Args: {}".format(args))
+            self.log_debug("Kwargs: {}".format(kwargs))
+
+        start = default_timer()
+        try:
+            response = method(self, *args, **kwargs)
+        except Exception as err:
+            self.log_critical("Unhandled exception while making {}".format(name), err)
+        if debug:
+            self.log_debug("Response: {}".format(response))
+        latency = default_timer() - start
+        self.log_record(
+            logging.INFO, name, command=name,
+            device=self.smart_namespace, attempt=attempt,
+            latency=latency, action=response.get('action'))
+        if self.metrics is not None:
+            self.metrics.observe_command(
+                self.device_port, name, latency, attempt)
+
+        if response['exception']:
+            exception = response['exception']
+            desc = exception['description']
+            if isinstance(desc, str):
+                desc = unicode(desc, "utf-8")
+            self.log_error(u"{0}: {1}".format(exception['code'], desc))
+        if info:
+            self.log_info("Action: {}".format(response['action']))
+        return response
+
+    def _resolve_command(self, name, response, attempt):
+        """ Реакция на ответ без участия пользователя
+            :returns список реакций или None, если требуется
+                решение пользователя
+        """
+        if not response['exception']:
+            return [response['action']]
+        reaction = None
+        if self.resolution_policy is not None:
+            reaction = self.resolution_policy.resolve(name, response, attempt)
+            if reaction is not None and self.log_enabled(logging.INFO):
+                self.log_info("Resolved: {}".format(reaction))
+        return reaction
+
+    def _apply_reaction(self, name, response, reaction):
+        """ Выполнение реакции на ответ команды
+            :param reaction: список реакций (break, retry, wait, skip)
+            :returns признак повторного выполнения команды
+        """
+        info = self.log_enabled(logging.INFO)
+        if info:
+            self.log_info("User choice: {}".format(reaction))
+        response['reaction'] = reaction
+        for action in reaction:
+            if action == 'break':
+                if response['is_critical']:
+                    self.log_warning(u"Аннулирование чека")
+                    self.make_cancel_check()
+                    if self.metrics is not None:
+                        self.metrics.observe_cancellation(self.device_port)
+            if action == 'retry':
+                if info:
+                    self.log_info(u"Повтор выполнения {}".format(name))
+                return True
+            if action == 'wait':
+                wait_time = response['delta'] or 1
+                time.sleep(wait_time)
+                response['delta'] += wait_time
+            else:
+                break
+        self.__batch_reset()
+        return False
+
+    def _command_failed(self, name, response):
+        """ Ответ при исчерпании повторов команды """
+        error = {
+            'error': 'CashRegisterError',
+            'message': u"'{}': Не удалось выолнить команду".format(name),
+            'args': (),
+            'code': -1,
+            'description': u"Нет связи с устройством",
+            'action': name
+        }
+        self.log_error(error)
+        response['exception'] = error
+        self.__batch_reset()
+
+    def execute(self, name, args=(), kwargs=None, decide=None):
+        """ Выполнение команды без генератора.
+            Реакция на ошибку, не разрешенную политикой, запрашивается
+            через decide; без него команда прерывается.
+            :param name: наименование команды (или обертка команды)
+            :param args: позиционные аргументы
+            :param kwargs: именованные аргументы
+            :param decide: обработчик выбора decide(name, case) -> реакции,
+                где case -- результат define_user_case
+            :returns ответ команды
+        """
+        if not isinstance(name, basestring):
+            name = name.__name__
+        method = getattr(type(self), name).raw
+        kwargs = kwargs or {}
+        response = {}
+        policy = self.retry_policies.get(LAYER_COMMAND, name)
+        for attempt in policy.attempts():
+            response = self._attempt_command(
+                method, name, attempt, args, kwargs)
+            if response['action'] == 'continue':
+                break
+            reaction = self._resolve_command(name, response, attempt)
+            if reaction is None:
+                case = define_user_case(response['exception'],
+                                        response['action'],
+                                        response['is_critical'])
+                reaction = ['break'] if decide is None else \
+                    decide(name, case)
+            if not self._apply_reaction(name, response, reaction):
+                break
+        else:
+            self._command_failed(name, response)
+        return response
+
+    def run_step(self, index, item, bus=None):
+        """ Выполнение одной команды плана с передачей событий
+            :param index: номер команды в плане
+            :param item: (команда, позиционные аргументы,
+                именованные аргументы); команда -- имя или обертка
+            :param bus: объект класса EventBus (события и выбор реакции)
+            :returns ответ команды
+        """
+        cmd, args, kwargs = item
+        name = cmd if isinstance(cmd, basestring) else cmd.__name__
+        if bus is None:
+            return self.execute(name, args, kwargs)
+
+        bus.emit(EVT_COMMAND, index=index, command=name)
+        response = self.execute(name, args, kwargs, bus.decide)
+        bus.emit(EVT_RESULT, index=index, command=name, response=response)
+        if step_failed(response):
+            bus.emit(EVT_ERROR, index=index, command=name,
+                     exception=response['exception'])
+        return response
+
+    def run_plan(self, plan, bus=None):
+        """ Выполнение плана команд с передачей событий.
+            Выполнение прекращается на первой команде, завершившейся
+            ошибкой (кроме пропущенных).
+            :param plan: список (команда, позиционные аргументы,
+                именованные аргументы); команда -- имя или обертка
+            :param bus: объект класса EventBus (события и выбор реакции)
+            :returns список ответов выполненных команд
+        """
+        results, failed = [], False
+        if bus is not None:
+            bus.emit(EVT_PLAN_STARTED, total=len(plan))
+        for index, item in enumerate(plan):
+            response = self.run_step(index, item, bus)
+            results.append(response)
+            if step_failed(response):
+                failed = True
+                break
+        if bus is not None:
+            bus.emit(EVT_PLAN_FINISHED, total=len(plan),
+                     completed=len(results), success=not failed)
+        return results
+
+    def run_plan_async(self, plan, bus=None):
+        """ Выполнение плана команд в фоновом потоке
+            :returns объект потока
+        """
+        thread = Thread(target=self.run_plan, args=(plan, bus))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    @classmethod
+    def register_metrics(cls, registry, *device_classes):
+        """ Подключение реестра статистики
+            :param registry: объект класса MetricsRegistry
+            :param device_classes: профильные классы устройств
+                (ShtrihCashRegister, RRCashRegister), передающие
+                в реестр результаты анализа ответов
+        """
+        cls.metrics = registry
+        for device_class in device_classes:
+            device_class.metrics = registry
+
+    @property
+    def device_port(self):
+        """ Порт подключения устройства """
+        return self.__device.port
+
+    @property
+    def in_critical_zone(self):
+        """ Признак нахождения в критической области печати
+            (между продажей и закрытием чека)
+        """
+        return self.__device.in_critical_zone
+
+    def enable_breaker(self, threshold=3, probe_interval=1.0, fallback=None,
+                       group=None):
+        """ Включение размыкателя цепи устройства.
+            При открытом размыкателе команды завершаются ошибкой
+            без обращения к порту (или передаются резервному устройству);
+            порт, на котором устройство найдено повторно, фиксируется
+            в метрике.
+            :param threshold: число ошибок связи подряд для размыкания
+            :param probe_interval: интервал фоновой проверки устройства
+            :param fallback: резервное устройство (профильный класс)
+            :param group: группа портов для повторного поиска устройства
+        """
+        def on_state(state, port, rate):
+            self.log_warning(u"Размыкатель цепи: {} ({})".format(state, port))
+            if state == BREAKER_CLOSED and port:
+                self.set_connection_parameters(port, rate)
+
+        return self.__device.enable_breaker(
+            threshold, probe_interval, fallback, group, on_state)
+
+    def watch_hotplug(self):
+        """ Отслеживание подключения устройства (только Linux).
+            При переподключении устройство ищется только на появившемся
+            порту; найденные порт и скорость фиксируются в метрике.
+            :returns признак запуска наблюдения
+        """
+        def on_port(port, rate):
+            self.log_info(u"Устройство обнаружено на порту {}".format(port))
+            self.set_connection_parameters(port, rate)
+
+        return self.__device.watch_hotplug(on_port)
+
+    def stop_hotplug(self):
+        """ Остановка отслеживания подключения устройства """
+        self.__device.stop_hotplug()
+
+    @contextmanager
+    def job(self, seconds):
+        """ Выполнение задания с общим бюджетом времени.
+            Повторы команд внутри блока прекращаются по исчерпании бюджета,
+            что позволяет быстро переключиться на резервное устройство.
+            :param seconds: бюджет в секундах
+        """
+        self.__device.begin_job(seconds)
+        try:
+            yield self
+        finally:
+            self.__device.end_job()
 
     def check_dev_for_ready(self):
         """ Проверка на готовностоь ККТ к работе """
@@ -144,11 +459,7 @@ class CashRegister(LogMixin, SmartMixin):
         """
         params = {"rate": rate, "type": self.__device.dev_type,
                   "port": port, "check_width": self.__device.check_width}
-        metric = self.smart
-        metric_device = metric.get('device') or {}
-        metric_device.update(**params)
-        metric['device'] = metric_device
-        self.smart = metric
+        self.update_smart('device', **params)
 
     def init_connection_parameters(self):
         dev_metric = self.get_device_metric()
@@ -156,13 +467,65 @@ class CashRegister(LogMixin, SmartMixin):
             port = dev_metric.get('port') or ''
             rate = dev_metric.get('rate') or 0
 
-            if port:
-                self.__device.port = port
+            if port and rate:
+                # NOTE: Прямой вызов: порт открывается один раз
+                #   на сохраненной скорости
+                response = self.__device.init_cash_register(port, int(rate))
+                if response['exception']:
+                    self.log_error("Unable to open saved connection",
+                                   response['exception'])
+
+    def bind_device_namespace(self, data=None):
+        """ Привязка метрики к устройству по отпечатку его параметров
+            (тип, подтип, модель устройства) и порту подключения.
+            Метрика, накопленная в прежнем пространстве имен, переносится
+            в новое, если последнее еще не заполнено.
+            :param data: ответ команды get_device_metrics (при наличии)
+            :returns идентификатор пространства имен
+        """
+        if data is None:
+            response = self.__device.make_action("get_device_metrics", None)
+            if response['exception']:
+                self.log_error("Device metrics are unavailable",
+                               response['exception'])
+                return self.smart_namespace
+            data = response['data']
+
+        fingerprint = '.'.join(str(data[key]) for key in (
+            'device_type', 'device_subtype', 'device_model'))
+        with self.__lock:
+            self.bind_smart(device_identity(self.__device.port, fingerprint))
+            self.metric = self.get_commands_metric()
+        return self.smart_namespace
 
-            if rate:
-                self.__device.rate = int(rate)
+    def identify_device(self):
+        """ Определение модели и версии ПО устройства.
+            Модель и версия ПО фиксируются в метрике устройства;
+            пустая метрика команд заполняется из профиля модели,
+            что исключает период калибровки нового устройства.
+            :returns признак успешного определения
+        """
+        metrics = self.__device.make_action("get_device_metrics", None)
+        status = self.__device.make_action("get_status", None)
+        for response in (metrics, status):
+            if response['exception']:
+                self.log_error("Unable to identify device",
+                               response['exception'])
+                return False
 
-            self.init_cash_register(port, rate)
+        # NOTE: Версия ПО приходит байтами; в метрике (JSON) -- hex-строкой
+        soft_version = status['data']['soft_version']
+        if isinstance(soft_version, bytes):
+            soft_version = hexlify(soft_version).decode('ascii')
+
+        self.bind_device_namespace(metrics['data'])
+        self.update_smart('device', model=metrics['data']['device_model'],
+                          soft_version=soft_version)
+        with self.__lock:
+            if self.seed_from_profile():
+                self.log_info("Commands metric seeded from model profile")
+            self.metric = self.get_commands_metric()
+        return True
 
     def fix_in_smart(self, result):
         """ Определение времени, затраченного на выполнение команды,
@@ -177,6 +540,12 @@ class CashRegister(LogMixin, SmartMixin):
             self.log_error("Wrong structure for SMART fixing", "".join(result.keys()))
             return False
 
+        with self.__lock:
+            self.__fix_metric(result)
+        return True
+
+    def __fix_metric(self, result):
+        """ Корректировка метрики команд (под блокировкой) """
         name = result['command']
         timeout, need_to_calibrate = 0, False
 
@@ -211,13 +580,118 @@ class CashRegister(LogMixin, SmartMixin):
 
         if cmd_timeout_changed or last_cmd_timeout_changed:
             self.metric[name] = [abs(timeout), need_to_calibrate]
-            metric = self.smart
-            metric_commands = metric.get('commands') or {}
-            metric_commands.update(**self.metric)
-            metric['commands'] = metric_commands
-            self.smart = metric
+            self.update_smart('commands', **self.metric)
         self.last_command = name
-        return True
+
+    def __measure(self, name, *args, **kwargs):
+        """ Измерение времени выполнения команды устройством,
+            включая время завершения печати
+            :returns время в секундах или None в случае ошибки
+        """
+        start = default_timer()
+        response = self.__device.make_action(
+            name, CALIBRATION_TIMEOUT, *args, **kwargs)
+        if response['exception']:
+            self.log_warning("Calibration of {} failed".format(name),
+                             response['exception'])
+            return None
+
+        while default_timer() - start < CALIBRATION_TIMEOUT:
+            state = self.__device.check_dev_for_ready()
+            if state['exception'] or state['data'].get('ready') is not False:
+                break
+            time.sleep(self.delta_step)
+        return default_timer() - start
+
+    def calibrate(self, tries=3, lengths=CALIBRATION_LENGTHS, plan=None):
+        """ Калибровка времени выполнения нефискальных команд.
+            Каждая команда выполняется заданное число раз, в метрику
+            заносится наибольшее измеренное время с запасом в один шаг.
+            Печать строки измеряется для каждой длины строки отдельно
+            (строка не дополняется до ширины ленты); в метрику команды
+            заносится время самой долгой из них, времена по длинам
+            строк -- в раздел calibration (get_calibration_metric).
+            :param tries: количество выполнений каждой команды
+            :param lengths: длины строк для калибровки печати строки
+            :param plan: список команд вида (команда, args, kwargs)
+            :returns словарь вида {команда: время ожидания}, для печати
+                строки также {"print_string:<длина>": время ожидания}
+        """
+        plan = [(name, name, args, kwargs)
+                for name, args, kwargs in plan or CALIBRATION_PLAN]
+        width = self.__device.check_width
+        for length in sorted(set(min(size, width) for size in lengths)):
+            plan.append(("print_string:{}".format(length), "print_string",
+                         (u"8" * length, ), {}))
+
+        samples = {}
+        for label, name, args, kwargs in plan:
+            for _ in range(tries):
+                elapsed = self.__measure(name, *args, **kwargs)
+                if elapsed is not None:
+                    samples.setdefault((label, name), []).append(elapsed)
+
+        calibrated, timeouts = {}, {}
+        for (label, name), values in samples.items():
+            timeout = round(max(values) + self.delta_step, 3)
+            calibrated[label] = timeout
+            timeouts[name] = max(timeout, timeouts.get(name, 0))
+        lengths = dict((label, timeout) for label, timeout
+                       in calibrated.items() if label not in timeouts)
+        calibrated.update(timeouts)
+
+        with self.__lock:
+            for name, timeout in timeouts.items():
+                self.metric[name] = [timeout, False]
+            if timeouts:
+                self.update_smart('commands', **self.metric)
+            if lengths:
+                self.update_smart('calibration', **lengths)
+        self.log_info("Calibrated timeouts: {}".format(calibrated))
+        return calibrated
+
+    def __batch_start(self, items):
+        """ Позиция продолжения серии команд после ошибки
+            :param items: список позиций серии
+        """
+        with self.__lock:
+            batch, completed = self.__batch
+            return completed if batch is items else 0
+
+    def __batch_reset(self):
+        """ Сброс незавершенной серии: команда завершена (прервана,
+            пропущена или исчерпаны повторы), следующий вызов начинает
+            серию с первой позиции
+        """
+        with self.__lock:
+            self.__batch = (None, 0)
+
+    def __batch_done(self, items, response):
+        """ Учет выполнения серии команд: после ошибки запоминается
+            число выполненных позиций
+        """
+        with self.__lock:
+            self.__batch = (items, response['data']['completed']) \
+                if response['exception'] else (None, 0)
+
+    def __learn_pace(self, command, pace, busy):
+        """ Корректировка паузы между строками блока:
+            ответы "идет печать" увеличивают паузу, блок без них --
+            постепенно уменьшает
+            :param command: команда печати строки
+            :param pace: пауза, с которой выполнялся блок
+            :param busy: число ответов "идет печать предыдущей команды"
+        """
+        if busy:
+            pace = min(pace + PACING_STEP * busy, PACING_MAX)
+        elif pace:
+            pace *= PACING_DECAY
+            if pace < PACING_MIN:
+                pace = 0
+        else:
+            return
+        with self.__lock:
+            self.update_smart('pacing', **{command: round(pace, 4)})
 
     def make_cancel_check(self):
         """ Аннулирование незакрытого чека
@@ -233,7 +707,10 @@ class CashRegister(LogMixin, SmartMixin):
             :param rate: скорость обмена
             returns: словарь с результатом выполнения команды
         """
-        return self.__device.init_cash_register(port, rate)
+        response = self.__device.init_cash_register(port, rate)
+        if not response['exception']:
+            self.__bind_port()
+        return response
 
     @command
     def find_device(self, port_group=None, rate=None):
@@ -243,7 +720,27 @@ class CashRegister(LogMixin, SmartMixin):
             :param rate: скорость обмена для снижения времени поиска
             returns: словарь с результатом выполнения команды
         """
-        return self.__device.find_device(port_group, rate)
+        response = self.__device.find_device(port_group, rate)
+        if not response['exception']:
+            self.__bind_port()
+        return response
+
+    def negotiate_rate(self, dev_port=0, max_rate=None):
+        """ * Интерфейс работы с ККТ *
+            Повышение скорости обмена с устройством
+            Установленная скорость фиксируется в метрике устройства.
+            Метод не оборачивается в command: повтор команды запускал бы
+            подбор скорости заново, восстановление связи выполняет
+            профильный класс.
+            :param dev_port: номер порта устройства
+            :param max_rate: наибольшая допустимая скорость
+            returns: словарь с результатом выполнения команды
+        """
+        response = self.__device.negotiate_rate(dev_port, max_rate)
+        if not response['exception']:
+            self.set_connection_parameters(
+                response['data']['port'], response['data']['rate'])
+        return response
 
     @command
     def beep(self, timeout=None):
@@ -499,10 +996,90 @@ class CashRegister(LogMixin, SmartMixin):
             :param fill: символ или строка заполнения
             :returns объект типа BaseCommandState
         """
-        fmt_text = format_string(string, self.__device.check_width, align, fill)
-        return self.__device.make_action(
-            "print_string", timeout, fmt_text, on_check=on_check,
-            on_journal=on_journal)
+        return self.__print_line("print_string", string, timeout, on_check,
+                                 on_journal, align, fill)
+
+    @command
+    def print_text_block(self, lines, align='left', fill='', wide=False,
+                         timeout=None, on_check=True, on_journal=True):
+        """ * Интерфейс работы с ККТ с поддержкой поправки времени выполнения *
+            Печать блока строк (заголовки, подвалы, нефискальные документы)
+            Строки переносятся по ширине ленты, форматируются и кодируются
+            до начала печати; кадры передаются подряд с изученной паузой
+            между строками (раздел метрики pacing). Повтор после ошибки
+            продолжает печать с первой ненапечатанной строки.
+            :param lines: список строк
+            :param align: выравнивание текста в строке
+            :param fill: символ или строка заполнения
+            :param wide: печать жирным шрифтом
+            :param timeout: время ожидания ответа на каждую строку
+            :param on_check: печать на чековой ленте
+            :param on_journal: печать на журнальной ленте
+            :returns объект типа BaseCommandState,
+                data: {'items': ответы по строкам, 'completed': число
+                напечатанных строк, 'busy': число ответов "идет печать",
+                'invalid': номер строки с неверными данными}
+        """
+        command = 'print_wide_string' if wide else 'print_string'
+        width = self.__device.check_width
+        text_width = width // 2 if wide else width
+        fmt = formatter(width, align, fill, wide)
+        block = [fmt(part) for line in lines
+                 for part in wrap_text(line, text_width)]
+        return self.__print_block(
+            command, lines, block, timeout, on_check, on_journal)
+
+    @command
+    def print_table(self, items, columns=None, header=None, wide=False,
+                    timeout=None, on_check=True, on_journal=True):
+        """ * Интерфейс работы с ККТ с поддержкой поправки времени выполнения *
+            Печать таблицы позиций (наименование, количество, цена, сумма)
+            Строки таблицы размечаются по ширине ленты за один проход
+            (layout.TableLayout) и печатаются блоком (см. print_text_block).
+            :param items: список позиций -- словарей или последовательностей
+                значений колонок
+            :param columns: описания колонок (по умолчанию --
+                layout.ITEM_COLUMNS)
+            :param header: заголовки колонок (без заголовка -- None)
+            :param wide: печать жирным шрифтом
+            :param timeout: время ожидания ответа на каждую строку
+            :param on_check: печать на чековой ленте
+            :param on_journal: печать на журнальной ленте
+            :returns объект типа BaseCommandState (см. print_text_block);
+                если колонки без переноса не помещаются в ширину ленты,
+                команда прерывается ошибкой ERR_DATA_LENGTH
+        """
+        command = 'print_wide_string' if wide else 'print_string'
+        width = self.__device.check_width
+        try:
+            layout = TableLayout(width // 2 if wide else width,
+                                 columns or ITEM_COLUMNS)
+        except ValueError as err:
+            self.log_error("Table does not fit the check width", err)
+            exc = ShtrihCommandError(ERR_DATA_LENGTH)
+            return self.__device.analyse_result(
+                'print_table', exc.serialize())
+        block = layout.rows(items)
+        if header:
+            block.insert(0, layout.header(header))
+        return self.__print_block(
+            command, items, block, timeout, on_check, on_journal)
+
+    def __print_block(self, command, source, block, timeout, on_check,
+                      on_journal):
+        """ Печать размеченного блока строк с изученной паузой
+            и продолжением после ошибки
+            :param source: исходный список (признак продолжения блока)
+            :param block: строки для печати
+        """
+        start = self.__batch_start(source)
+        pace = self.get_pacing_metric().get(command, 0)
+        response = self.__device.print_text_block(
+            command, block, timeout, on_check, on_journal, start=start,
+            pace=pace)
+        self.__batch_done(source, response)
+        self.__learn_pace(command, pace, response['data'].get('busy', 0))
+        return response
 
     @command
     def print_wide_string(self, string, timeout=None, on_check=True,
@@ -517,11 +1094,40 @@ class CashRegister(LogMixin, SmartMixin):
             :param fill: символ или строка заполнения
             :returns объект типа BaseCommandState
         """
-        fmt_text = format_string(
-            string, self.__device.check_width, align, fill, bold=True)
-        return self.__device.make_action(
-            "print_wide_string", timeout, fmt_text, on_check=on_check,
-            on_journal=on_journal)
+        return self.__print_line("print_wide_string", string, timeout,
+                                 on_check, on_journal, align, fill)
+
+    def __print_line(self, command, string, timeout, on_check, on_journal,
+                     align, fill):
+        """ Печать строки; кадр команды берется из кэша кадров
+            (frame_cache) или строится и сохраняется в нем
+        """
+        width = self.__device.check_width
+        bold = command == "print_wide_string"
+        cache = self.frame_cache
+        if cache is None or \
+                not getattr(self.__device, "supports_frames", False):
+            fmt_text = format_string(string, width, align, fill, bold=bold)
+            return self.__device.make_action(
+                command, timeout, fmt_text, on_check=on_check,
+                on_journal=on_journal)
+
+        key = (command, string, width, align, fill, on_check, on_journal,
+               self.__device.frame_key)
+        frame = cache.get(key)
+        if frame is None:
+            fmt_text = format_string(string, width, align, fill, bold=bold)
+            try:
+                frame = self.__device.build_frame(
+                    command, fmt_text, on_check=on_check,
+                    on_journal=on_journal)
+            except (ShtrihError, ValueError, UnicodeError):
+                # NOTE: Ошибку кодирования разбирает make_action
+                return self.__device.make_action(
+                    command, timeout, fmt_text, on_check=on_check,
+                    on_journal=on_journal)
+            cache.put(key, frame)
+        return self.__device.send_frame(command, timeout, frame)
 
     @command
     def return_sale(
@@ -558,6 +1164,26 @@ class CashRegister(LogMixin, SmartMixin):
             "sale", timeout, price, count=count, text=text,
             department=department, taxes=taxes)
 
+    @command
+    def sale_many(self, items, timeout=None):
+        """ * Интерфейс работы с ККТ с поддержкой поправки времени выполнения *
+            Продажа серии позиций (кадры передаются подряд)
+            Повтор после ошибки продолжает серию с первой
+            незарегистрированной позиции, пока чек не закрыт
+            и не аннулирован.
+            :param items: список позиций -- словарей с аргументами sale
+                (price, count, text, department, taxes)
+            :param timeout: время ожидания ответа на каждую позицию
+            :returns объект типа BaseCommandState,
+                data: {'items': ответы по позициям, 'completed': число
+                зарегистрированных позиций, 'invalid': номер позиции
+                с неверными данными}
+        """
+        start = self.__batch_start(items) if self.in_critical_zone else 0
+        response = self.__device.sale_many(items, timeout, start=start)
+        self.__batch_done(items, response)
+        return response
+
     @command
     def set_date(self, c_date, timeout=None):
         """ * Интерфейс работы с ККТ *
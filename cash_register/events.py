@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+""" LoremCross
+    Модуль работы с фискальными устройствами
+    События выполнения плана команд
+
+    CashRegister.run_plan передает ход выполнения подписчикам шины
+    событий; запросы решения пользователя передаются обработчику выбора.
+    Событие -- словарь с ключом event (вид события) и данными события.
+"""
+import logging
+from threading import Lock
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+EVT_PLAN_STARTED = 'plan_started'   # total
+EVT_COMMAND = 'command'             # index, command
+EVT_RESULT = 'result'               # index, command, response
+EVT_ERROR = 'error'                 # index, command, exception
+EVT_DECISION = 'decision'           # command, case, reply
+EVT_PLAN_FINISHED = 'plan_finished'     # total, completed, success
+
+DEFAULT_REACTION = ['break']
+# Реакции на ошибку команды (см. define_user_case, _apply_reaction)
+REACTIONS = ('continue', 'retry', 'break', 'wait', 'skip')
+
+
+def valid_reaction(reaction):
+    """ Проверка списка реакций, полученного извне (клиент сервера печати)
+        :param reaction: список реакций
+    """
+    return isinstance(reaction, list) and bool(reaction) and \
+        all(action in REACTIONS for action in reaction)
+
+
+class EventBus(object):
+    """ Шина событий выполнения плана
+        :param decide: обработчик выбора decide(command, case) -> реакции;
+            без него ошибка, не разрешенная политикой, прерывает план
+    """
+
+    def __init__(self, decide=None):
+        self.__lock = Lock()
+        self.__callbacks = []
+        self.__decide = decide
+
+    def subscribe(self, callback):
+        """ Подписка на события
+            :param callback: обработчик callback(event)
+        """
+        with self.__lock:
+            self.__callbacks.append(callback)
+
+    def unsubscribe(self, callback):
+        """ Отказ от подписки """
+        with self.__lock:
+            if callback in self.__callbacks:
+                self.__callbacks.remove(callback)
+
+    def emit(self, event, **fields):
+        """ Передача события подписчикам.
+            Ошибка подписчика не прерывает выполнение плана.
+        """
+        fields['event'] = event
+        with self.__lock:
+            callbacks = list(self.__callbacks)
+        for callback in callbacks:
+            try:
+                callback(fields)
+            except Exception:
+                logging.getLogger(__name__).exception(
+                    "Event callback failed: %s", event)
+
+    def decide(self, command, case):
+        """ Запрос реакции на ошибку команды
+            :param command: наименование команды
+            :param case: результат define_user_case
+            :returns список реакций
+        """
+        if self.__decide is None:
+            return list(DEFAULT_REACTION)
+        return self.__decide(command, case) or list(DEFAULT_REACTION)
+
+
+class QueueBus(EventBus):
+    """ Шина событий с передачей в очередь (например, в поток UI).
+        Запрос решения помещается в очередь событием decision с функцией
+        reply(reaction); выполнение плана ожидает ответа.
+        :param events: очередь событий
+        :param timeout: время ожидания решения; по истечении -- прерывание
+    """
+
+    def __init__(self, events=None, timeout=None):
+        super(QueueBus, self).__init__()
+        self.events = Queue() if events is None else events
+        self.timeout = timeout
+        self.subscribe(self.events.put)
+
+    def decide(self, command, case):
+        answers = Queue(1)
+        self.emit(EVT_DECISION, command=command, case=case,
+                  reply=answers.put)
+        try:
+            return answers.get(timeout=self.timeout) or \
+                list(DEFAULT_REACTION)
+        except Empty:
+            return list(DEFAULT_REACTION)
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+""" LoremCross
+    Модуль работы с фискальными устройствами
+    Кэш готовых кадров команд печати строк
+
+    Постоянные строки чека (заголовок, реквизиты, разделители, подвал)
+    повторяются в каждом документе. Кадр такой строки (форматирование,
+    кодировка устройства, контрольная сумма) строится один раз и далее
+    берется из кэша. Ключ кадра: (команда, текст, ширина, выравнивание,
+    заполнение, флаги печати, признаки устройства).
+"""
+from collections import OrderedDict
+from threading import Lock
+
+FRAME_CACHE_SIZE = 512  # наибольшее число кадров в кэше
+
+
+class FrameCache(object):
+    """ Ограниченный кэш кадров с вытеснением давно неиспользованных
+        (LRU) и статистикой попаданий
+        :param size: наибольшее число кадров
+    """
+
+    def __init__(self, size=FRAME_CACHE_SIZE):
+        self.size = size
+        self.__frames = OrderedDict()
+        self.__lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.__frames)
+
+    def get(self, key):
+        """ Кадр по ключу (или None) """
+        with self.__lock:
+            frame = self.__frames.pop(key, None)
+            if frame is None:
+                self.misses += 1
+                return None
+            self.__frames[key] = frame
+            self.hits += 1
+            return frame
+
+    def put(self, key, frame):
+        """ Сохранение кадра с вытеснением давно неиспользованных """
+        with self.__lock:
+            self.__frames.pop(key, None)
+            self.__frames[key] = frame
+            while len(self.__frames) > self.size:
+                self.__frames.popitem(last=False)
+
+    def clear(self):
+        """ Очистка кэша и статистики """
+        with self.__lock:
+            self.__frames.clear()
+            self.hits = self.misses = 0
+
+    @property
+    def hit_rate(self):
+        """ Доля обращений, обслуженных кэшем """
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+    def stats(self):
+        """ Статистика кэша
+            :returns словарь {'size', 'length', 'hits', 'misses',
+                'hit_rate'}
+        """
+        with self.__lock:
+            return {'size': self.size, 'length': len(self.__frames),
+                    'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hit_rate}
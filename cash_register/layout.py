@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+""" LoremCross
+    Модуль работы с фискальными устройствами
+    Разметка строк чека
+
+    Форматтеры строк кэшируются по (ширина, выравнивание, заполнение,
+    жирный шрифт). Таблица (TableLayout) строит шаблон строки один раз
+    и форматирует весь список позиций за один проход: колонки с переносом
+    продолжаются на следующих строках, значения прочих колонок (суммы,
+    количества) не обрезаются -- не поместившееся значение печатается
+    отдельной строкой. Функции доступны шаблонам печати (фильтры
+    и глобальные переменные TemplateReader).
+"""
+import textwrap
+
+ALIGNS = {'left': u'<', 'center': u'^', 'right': u'>'}
+CHECK_WIDTH = 38    # ширина ленты по умолчанию (в символах)
+MIN_FLEXIBLE_WIDTH = 8  # наименьшая ширина колонки без заданной ширины
+
+# Колонки таблицы позиций чека: (ключ, ширина, выравнивание, перенос);
+# ширина None -- колонка занимает оставшееся место
+ITEM_COLUMNS = (
+    ('name', None, 'left', True),
+    ('count', 6, 'right', False),
+    ('price', 9, 'right', False),
+    ('total', 10, 'right', False),
+)
+
+_formatters = {}
+
+
+def formatter(width, align='left', fill='', bold=False):
+    """ Форматтер строки (кэшируется)
+        :param width: ширина чековой ленты (в символах)
+        :param align: выравнивание строки
+        :param fill: символ заполнения
+        :param bold: печать жирной строки (ширина вдвое меньше)
+        :returns функция форматирования строки
+    """
+    key = (width, align, fill, bold)
+    fmt = _formatters.get(key)
+    if fmt is None:
+        width = width // 2 if bold is True else width
+        fmt = _formatters[key] = (u"{:%s%s%d}" % (
+            fill or '', ALIGNS.get(align) or ALIGNS['left'], width)).format
+    return fmt
+
+
+def format_line(text, width, align='left', fill='', bold=False):
+    """ Форматирование строки перед печатью (см. formatter) """
+    return formatter(width, align, fill, bold)(text)
+
+
+def wrap_text(text, width):
+    """ Перенос текста по ширине
+        :returns список строк (пустой текст -- одна пустая строка)
+    """
+    if len(text) <= width:
+        return [text]
+    return textwrap.wrap(text, width) or [u""]
+
+
+class Column(object):
+    """ Колонка таблицы
+        :param key: ключ значения (для позиций-словарей)
+        :param width: ширина; None -- оставшееся место
+        :param align: выравнивание
+        :param wrap: перенос значения на следующие строки; ширина
+            такой колонки уменьшается, если таблица не помещается
+            (иначе значение не обрезается: не поместившееся значение
+            печатается отдельной строкой)
+        :param fmt: шаблон значения (например, u"{:.2f}")
+    """
+
+    def __init__(self, key, width=None, align='left', wrap=False, fmt=None):
+        self.key = key
+        self.width = width
+        self.align = align
+        self.wrap = wrap
+        self.fmt = fmt
+
+    @classmethod
+    def make(cls, spec):
+        """ Колонка по описанию: объект Column, словарь аргументов
+            или кортеж (key, width, align, wrap, fmt)
+        """
+        if isinstance(spec, Column):
+            return spec
+        if isinstance(spec, dict):
+            return cls(**spec)
+        return cls(*spec)
+
+    def value(self, item, index):
+        """ Текст значения колонки для позиции
+            (словарь -- по ключу, последовательность -- по номеру)
+        """
+        value = item.get(self.key, u"") if isinstance(item, dict) \
+            else item[index]
+        if value is None:
+            return u""
+        if self.fmt:
+            return self.fmt.format(value)
+        return value if isinstance(value, basestring) else u"{}".format(value)
+
+
+class TableLayout(object):
+    """ Разметка таблицы фиксированной ширины
+        :param width: ширина ленты (в символах)
+        :param columns: описания колонок (см. Column.make)
+        :param separator: разделитель колонок
+        :raises ValueError: колонки без переноса не помещаются в ширину
+    """
+
+    def __init__(self, width=CHECK_WIDTH, columns=ITEM_COLUMNS,
+                 separator=u" "):
+        self.width = width
+        self.separator = separator
+        self.columns = [Column.make(spec) for spec in columns]
+
+        widths = [column.width for column in self.columns]
+        flexible = widths.count(None)
+        wrapped = sum(column.width for column in self.columns
+                      if column.width and column.wrap)
+        room = width - len(separator) * (len(widths) - 1) - \
+            MIN_FLEXIBLE_WIDTH * flexible - \
+            sum(column.width for column in self.columns
+                if column.width and not column.wrap)
+        if room < 0 or (wrapped > room and room < MIN_FLEXIBLE_WIDTH):
+            raise ValueError(
+                u"Колонки таблицы не помещаются в ширину {}".format(width))
+        if wrapped > room:
+            # NOTE: Сужаются только колонки с переносом
+            widths = [max(column.width * room // wrapped, 1)
+                      if column.width and column.wrap else column.width
+                      for column in self.columns]
+        free = width - len(separator) * (len(widths) - 1) - \
+            sum(size or 0 for size in widths)
+        share = free // flexible if flexible else 0
+        self.widths = [size or share for size in widths]
+
+        # NOTE: Шаблоны строки строятся один раз; заголовки обрезаются
+        #   по ширине колонки, значения -- нет
+        self.__row = self.__template(truncate=False)
+        self.__title = self.__template(truncate=True)
+
+    def __template(self, truncate):
+        """ Функция форматирования строки таблицы
+            :param truncate: обрезка значений по ширине колонки
+        """
+        cells = []
+        for index, (column, size) in enumerate(
+                zip(self.columns, self.widths)):
+            cell = u"{%d:%s%d" % (index, ALIGNS.get(column.align) or u'<',
+                                  size)
+            cells.append(cell + (u".%d}" % size if truncate else u"}"))
+        return self.separator.join(cells).format
+
+    def row(self, item):
+        """ Строки одной позиции
+            :param item: словарь или последовательность значений
+            :returns список строк
+        """
+        parts, overflow = [], []
+        for index, (column, size) in enumerate(
+                zip(self.columns, self.widths)):
+            value = column.value(item, index)
+            if column.wrap:
+                parts.append(wrap_text(value, size))
+            elif len(value) > size:
+                # NOTE: Значение не обрезается -- печатается отдельной
+                #   строкой с выравниванием колонки
+                parts.append([u""])
+                overflow.append((column, value))
+            else:
+                parts.append([value])
+
+        height = max(len(part) for part in parts)
+        lines = [self.__row(*[part[line] if line < len(part) else u""
+                              for part in parts])
+                 for line in range(height)]
+        for column, value in overflow:
+            fmt = formatter(self.width, column.align)
+            lines.extend(fmt(text) for text in wrap_text(value, self.width))
+        return lines
+
+    def rows(self, items):
+        """ Строки таблицы позиций (за один проход)
+            :param items: список позиций
+            :returns список строк
+        """
+        lines = []
+        for item in items:
+            lines.extend(self.row(item))
+        return lines
+
+    def header(self, titles=None):
+        """ Строка заголовка таблицы
+            :param titles: заголовки колонок (по умолчанию -- ключи)
+        """
+        titles = titles or [column.key for column in self.columns]
+        return self.__title(*titles)
+
+
+def table(items, columns=ITEM_COLUMNS, width=CHECK_WIDTH, separator=u" "):
+    """ Строки таблицы позиций (см. TableLayout) """
+    return TableLayout(width, columns, separator).rows(items)
+
+
+# Фильтры и глобальные переменные шаблонов печати
+TEMPLATE_FILTERS = {
+    'format_line': format_line,
+    'wrap_text': wrap_text,
+    'table': table,
+}
+TEMPLATE_GLOBALS = {
+    'TableLayout': TableLayout,
+    'ITEM_COLUMNS': ITEM_COLUMNS,
+}
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+""" LoremCross
+    Модуль работы с фискальными устройствами
+    Статистика выполнения команд в разрезе устройств
+
+    Реестр наполняется оберткой команд CashRegister (количество
+    выполнений, время выполнения, повторы, аннулирования в критической
+    области) и анализатором результата ShtrihCashRegister (коды ошибок,
+    истечение времени ожидания). Повторы учитываются только оберткой
+    команд: команда считается один раз, на первой попытке.
+    Статистика выгружается в текстовом формате Prometheus:
+    через локальный HTTP сервер либо в файл для textfile collector.
+"""
+import io
+import os
+from threading import Lock, Thread
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from lc_cashcontrol.device_types.shtrih.instrumentation import Histogram, \
+    LATENCY_BUCKETS
+from lc_cashcontrol.device_types.shtrih.shtrih_constants import ERRORS, \
+    CUSTOM_ERRORS, ERR_COMMAND_TIMEOUT, ERR_LOST_DEVICE
+
+PREFIX = 'cashcontrol'
+TIMEOUT_ERRORS = [ERR_COMMAND_TIMEOUT, ERR_LOST_DEVICE]
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _labels(**labels):
+    """ Формирование строки меток """
+    items = []
+    for key in sorted(labels):
+        value = u"{}".format(labels[key])
+        value = value.replace('\\', '\\\\').replace('"', '\\"')
+        items.append(u'{}="{}"'.format(key, value))
+    return u"{%s}" % u",".join(items)
+
+
+class CommandStat(object):
+    """ Статистика выполнения команды на устройстве """
+
+    def __init__(self, bounds):
+        self.count = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.errors = {}
+        self.latency = Histogram(bounds)
+
+    def snapshot(self):
+        """ Копия статистики (для выгрузки вне блокировки реестра) """
+        return {'count': self.count, 'retries': self.retries,
+                'timeouts': self.timeouts, 'errors': dict(self.errors),
+                'latency': self.latency.snapshot()}
+
+
+class MetricsRegistry(object):
+    """ Реестр статистики работы устройств """
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.__bounds = bounds
+        self.__lock = Lock()
+        self.__commands = {}
+        self.__cancellations = {}
+        self.__server = None
+
+    def __stat(self, device, command):
+        key = (device or 'default', command)
+        if key not in self.__commands:
+            self.__commands[key] = CommandStat(self.__bounds)
+        return self.__commands[key]
+
+    def observe_command(self, device, command, latency, attempt=0):
+        """ Учет выполнения команды (обертка команд CashRegister)
+            :param device: идентификатор устройства
+            :param command: наименование команды
+            :param latency: время выполнения (в секундах)
+            :param attempt: номер попытки выполнения
+        """
+        with self.__lock:
+            stat = self.__stat(device, command)
+            stat.latency.observe(latency)
+            if attempt:
+                stat.retries += 1
+            else:
+                stat.count += 1
+
+    def observe_result(self, device, command, response):
+        """ Учет результата выполнения команды (анализ ответа устройства)
+            :param device: идентификатор устройства
+            :param command: наименование команды
+            :param response: ответ ShtrihCashRegister.analyse_result
+        """
+        exception = response.get('exception')
+        if not exception:
+            return
+
+        with self.__lock:
+            stat = self.__stat(device, command)
+            code = int(exception['code'])
+            stat.errors[code] = stat.errors.get(code, 0) + 1
+            if code in TIMEOUT_ERRORS:
+                stat.timeouts += 1
+
+    def observe_cancellation(self, device):
+        """ Учет аннулирования чека в критической области печати
+            :param device: идентификатор устройства
+        """
+        with self.__lock:
+            device = device or 'default'
+            self.__cancellations[device] = \
+                self.__cancellations.get(device, 0) + 1
+
+    def render(self):
+        """ Статистика в текстовом формате Prometheus """
+        lines = []
+        # NOTE: Копия под блокировкой: статистика меняется потоками команд
+        with self.__lock:
+            commands = [(key, self.__commands[key].snapshot())
+                        for key in sorted(self.__commands)]
+            cancellations = sorted(self.__cancellations.items())
+
+        def section(name, kind, description):
+            lines.append(u"# HELP {}_{} {}".format(PREFIX, name, description))
+            lines.append(u"# TYPE {}_{} {}".format(PREFIX, name, kind))
+
+        section('commands_total', 'counter', 'Executed commands')
+        for (device, command), stat in commands:
+            lines.append(u"{}_commands_total{} {}".format(
+                PREFIX, _labels(device=device, command=command),
+                stat['count']))
+
+        section('command_retries_total', 'counter', 'Command retries')
+        for (device, command), stat in commands:
+            lines.append(u"{}_command_retries_total{} {}".format(
+                PREFIX, _labels(device=device, command=command),
+                stat['retries']))
+
+        section('command_timeouts_total', 'counter', 'Command timeouts')
+        for (device, command), stat in commands:
+            lines.append(u"{}_command_timeouts_total{} {}".format(
+                PREFIX, _labels(device=device, command=command),
+                stat['timeouts']))
+
+        section('command_errors_total', 'counter', 'Command errors by code')
+        for (device, command), stat in commands:
+            for code, count in sorted(stat['errors'].items()):
+                kind = 'custom' if code in CUSTOM_ERRORS else 'device'
+                if code not in CUSTOM_ERRORS and code not in ERRORS:
+                    kind = 'unknown'
+                lines.append(u"{}_command_errors_total{} {}".format(
+                    PREFIX, _labels(device=device, command=command,
+                                    code=code, kind=kind), count))
+
+        section('critical_cancellations_total', 'counter',
+                'Receipts cancelled in the critical print zone')
+        for device, count in cancellations:
+            lines.append(u"{}_critical_cancellations_total{} {}".format(
+                PREFIX, _labels(device=device), count))
+
+        section('command_latency_seconds', 'histogram', 'Command latency')
+        for (device, command), stat in commands:
+            snapshot = stat['latency']
+            for bound, count in snapshot['buckets']:
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(u"{}_command_latency_seconds_bucket{} {}".format(
+                    PREFIX, _labels(device=device, command=command, le=le),
+                    count))
+            labels = _labels(device=device, command=command)
+            lines.append(u"{}_command_latency_seconds_sum{} {}".format(
+                PREFIX, labels, repr(snapshot['sum'])))
+            lines.append(u"{}_command_latency_seconds_count{} {}".format(
+                PREFIX, labels, snapshot['count']))
+
+        return u"\n".join(lines) + u"\n"
+
+    def write_textfile(self, file_name):
+        """ Выгрузка статистики в файл для textfile collector.
+            Запись выполняется через временный файл, чтобы сборщик
+            не прочитал файл частично.
+            :param file_name: имя файла (*.prom)
+        """
+        tmp_name = '{}.{}.tmp'.format(file_name, os.getpid())
+        with io.open(tmp_name, 'w', encoding='utf-8') as handle:
+            handle.write(self.render())
+        os.rename(tmp_name, file_name)
+
+    def serve(self, host='127.0.0.1', port=9169):
+        """ Запуск локального HTTP сервера статистики в фоновом потоке
+            :param host: адрес
+            :param port: порт
+            :returns объект HTTP сервера
+        """
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *_):
+                pass
+
+        self.__server = HTTPServer((host, port), MetricsHandler)
+        thread = Thread(target=self.__server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self.__server
+
+    def shutdown(self):
+        """ Остановка HTTP сервера статистики """
+        if self.__server is not None:
+            self.__server.shutdown()
+            self.__server.server_close()
+            self.__server = None
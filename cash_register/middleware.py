@@ -3,13 +3,30 @@
     Модуль работы с фискальными устройствами
     Промежуточные обработчики, классы-примеси для основного интерфейса
 """
+import functools
 import json
 import logging
 import os
-from threading import Lock
+from collections import deque
+from copy import deepcopy
+from threading import RLock
 
 from jinja2 import FileSystemLoader, Environment
 
+from layout import TEMPLATE_FILTERS, TEMPLATE_GLOBALS
+
+SMART_DEFAULT = 'default'   # пространство имен метрики по умолчанию
+LOGGER_NAME = "LoremCross.cash_control"
+STRUCTURED_FIELD = 'cash_control'   # атрибут записи журнала с полями
+
+
+def template_environment(path):
+    """ Окружение шаблонов печати с функциями разметки (layout) """
+    env = Environment(loader=FileSystemLoader(path))
+    env.filters.update(TEMPLATE_FILTERS)
+    env.globals.update(TEMPLATE_GLOBALS)
+    return env
+
 
 class TemplateReader(object):
     """ Чтение шаблонов и построение списка команд """
@@ -28,8 +45,8 @@ class TemplateReader(object):
 
     def init_template_path(self, path):
         self.__path = path
-        self.__loader = FileSystemLoader(self.__path)
-        self.__env = Environment(loader=self.__loader)
+        self.__env = template_environment(self.__path)
+        self.__loader = self.__env.loader
 
     def get_template(self, template, path=None, namespace=None):
         """ Получение шаблона
@@ -38,7 +55,7 @@ class TemplateReader(object):
             :param namespace: глобальные переменные
         """
         if (path is not None) and (os.path.exists(path)):
-            env = Environment(loader=FileSystemLoader(path))
+            env = template_environment(path)
         else:
             env = self.__env
 
@@ -52,8 +69,13 @@ class TemplateReader(object):
             :param context:
             :returns
         """
-        template = self.get_template(name, namespace=namespace)
-        return template.render(data=data, control_context=context)
+        # NOTE: Пространство имен передается при рендере, а не глобальными
+        #   переменными шаблона: окружение кэширует скомпилированный шаблон
+        #   вместе с глобальными переменными первой загрузки
+        template = self.get_template(name)
+        variables = dict(namespace or {})
+        variables.update(data=data, control_context=context)
+        return template.render(variables)
 
 
 class ProxyCashRegister(object):
@@ -72,11 +94,37 @@ class ProxyCashRegister(object):
     def commands(self):
         return self.__commands
 
-    def __call__(self, instance):
+    def serialize(self):
+        """ Список команд в переносимом виде (для передачи между
+            процессами): [[имя команды, позиционные аргументы,
+            именованные аргументы], ...]
+        """
+        return [[cmd.__name__, list(args), dict(kwargs)]
+                for cmd, args, kwargs in self.__commands]
+
+    @classmethod
+    def from_plan(cls, CashRegisterClass, plan):
+        """ Восстановление прокси по списку команд (см. serialize)
+            :param CashRegisterClass: класс CashRegister (или наследник)
+            :param plan: список команд в переносимом виде
+        """
+        proxy = cls(CashRegisterClass)
+        for name, args, kwargs in plan:
+            proxy.commands.append(
+                [getattr(CashRegisterClass, name), tuple(args), dict(kwargs)])
+        return proxy
+
+    def plan(self, instance):
+        """ План команд с временем ожидания из метрики устройства
+            :param instance: объект класса CashRegister
+            :returns список [команда, позиционные аргументы,
+                именованные аргументы]
+        """
         assert isinstance(instance, self._CashRegister)
 
-        cmd_metrics = self._CashRegister.get_commands_metric()
+        cmd_metrics = instance.get_commands_metric()
         last_command = ''
+        plan = []
 
         for item in self.__commands:
             cmd, args, kwargs = item
@@ -89,9 +137,27 @@ class ProxyCashRegister(object):
                     last_timeout, _ = cmd_metrics[last_command]
                     if last_timeout > timeout:
                         kwargs['timeout'] += abs(last_timeout)
+            plan.append([cmd, args, kwargs])
+        return plan
+
+    def __call__(self, instance):
+        for cmd, args, kwargs in self.plan(instance):
             yield cmd(instance, *args, **kwargs)
         yield
 
+    def run(self, instance, bus=None, background=False):
+        """ Выполнение команд шаблона внутри драйвера
+            с передачей событий (без генераторов на каждую команду)
+            :param instance: объект класса CashRegister
+            :param bus: объект класса EventBus
+            :param background: выполнение в фоновом потоке
+            :returns список ответов либо объект потока
+        """
+        plan = self.plan(instance)
+        if background:
+            return instance.run_plan_async(plan, bus)
+        return instance.run_plan(plan, bus)
+
     def init_cash_register(self, port, rate):
         self.__commands.append(
             [self._CashRegister.init_cash_register, (port, rate), {}])
@@ -215,6 +281,21 @@ class ProxyCashRegister(object):
             {'on_check': on_check, 'on_journal': on_journal, 'align': align,
              'fill': fill, 'timeout': timeout}])
 
+    def print_text_block(self, lines, align='left', fill='', wide=False,
+                         timeout=None, on_check=True, on_journal=True):
+        self.__commands.append([
+            self._CashRegister.print_text_block, (list(lines), ),
+            {'align': align, 'fill': fill, 'wide': wide, 'timeout': timeout,
+             'on_check': on_check, 'on_journal': on_journal}])
+
+    def print_table(self, items, columns=None, header=None, wide=False,
+                    timeout=None, on_check=True, on_journal=True):
+        self.__commands.append([
+            self._CashRegister.print_table, (list(items), ),
+            {'columns': columns, 'header': header, 'wide': wide,
+             'timeout': timeout, 'on_check': on_check,
+             'on_journal': on_journal}])
+
     def print_wide_string(self, string, timeout=None, on_check=True,
                           on_journal=True, align='left', fill=''):
         self.__commands.append([
@@ -236,6 +317,11 @@ class ProxyCashRegister(object):
             {'count': count, 'text': text, 'department': department,
              'taxes': taxes, 'timeout': timeout}])
 
+    def sale_many(self, items, timeout=None):
+        self.__commands.append([
+            self._CashRegister.sale_many, (list(items), ),
+            {'timeout': timeout}])
+
     def set_date(self, c_date, timeout=None):
         self.__commands.append([
             self._CashRegister.set_date, (c_date, ), {'timeout': timeout}])
@@ -255,121 +341,403 @@ class SMARTDescriptor(object):
         Реализует чтение и запись метрики устройства в текстовый файл
         с промежуточным кэшированием.
         Реализован на основе дескрипторов.
+
+        Метрика хранится в разрезе пространств имен: каждому устройству
+        (порт и отпечаток устройства) соответствует собственный набор
+        параметров подключения и времен выполнения команд.
+        Экземпляр класса работает с пространством имен, указанным
+        в его атрибуте smart_namespace, класс -- с пространством
+        имен по умолчанию.
     """
 
     def __init__(self, path, cache_name):
-        self.__lock = Lock()
+        self.__lock = RLock()
 
         if path.endswith(os.sep):
             path = path[:-1]
 
         file_name = [path, cache_name] if path else [cache_name, ]
         self.__file_name = os.sep.join(file_name)
-        if os.path.exists(self.__file_name):
-            with open(os.sep.join(file_name)) as handle:
-                try:
-                    self.__cache = json.load(handle)
-                except:
-                    self.__cache = {}
-        else:
-            self.__cache = {}
+        self.__cache = self.__read()
 
     def __del__(self):
         self.__write()
 
-    def __get__(self, *_):
-        return self.__cache
+    def __get__(self, instance, _):
+        return self.namespace(getattr(instance, 'smart_namespace', None))
 
-    def __set__(self, _, value):
-        self.__cache.update(**value)
-        self.__write()
+    def __set__(self, instance, value):
+        self.update(getattr(instance, 'smart_namespace', None), **value)
+
+    def __read(self):
+        cache = {}
+        if os.path.exists(self.__file_name):
+            with open(self.__file_name) as handle:
+                try:
+                    cache = json.load(handle)
+                except:
+                    cache = {}
+        # NOTE: Файл старого формата содержит метрику единственного устройства
+        if ('device' in cache) or ('commands' in cache):
+            cache = {SMART_DEFAULT: cache}
+        return cache
 
     def __write(self):
-        if self.__cache:
-            with self.__lock:
-                json.dump(self.__cache, open(self.__file_name, 'w'))
+        with self.__lock:
+            if self.__cache:
+                with open(self.__file_name, 'w') as handle:
+                    json.dump(self.__cache, handle)
+
+    @property
+    def namespaces(self):
+        """ Список зарегистрированных пространств имен """
+        with self.__lock:
+            return list(self.__cache.keys())
+
+    def namespace(self, key=None):
+        """ Метрика устройства (копия; изменение -- через update)
+            :param key: пространство имен (идентификатор устройства)
+            :returns словарь с метрикой
+        """
+        with self.__lock:
+            return deepcopy(self.__cache.get(key or SMART_DEFAULT) or {})
+
+    def update(self, key=None, **value):
+        """ Обновление метрики устройства с сохранением в файл
+            :param key: пространство имен (идентификатор устройства)
+            :param value: обновляемые разделы метрики
+        """
+        with self.__lock:
+            self.__cache.setdefault(key or SMART_DEFAULT, {}).update(**value)
+            self.__write()
+
+    def update_section(self, key, section, **value):
+        """ Атомарное обновление раздела метрики устройства
+            :param key: пространство имен (идентификатор устройства)
+            :param section: раздел метрики (device, commands)
+            :param value: обновляемые значения
+        """
+        with self.__lock:
+            metric = self.__cache.setdefault(key or SMART_DEFAULT, {})
+            metric_section = metric.get(section) or {}
+            metric_section.update(**value)
+            metric[section] = metric_section
+            self.__write()
+            return dict(metric_section)
+
+
+class SMARTProfiles(object):
+    """ Профили времен выполнения команд в разрезе модели и версии ПО ККТ.
+        Профиль строится по метрике откалиброванных устройств
+        и используется как начальное приближение для нового устройства
+        той же модели.
+    """
+
+    def __init__(self, path, profile_name):
+        self.__lock = RLock()
+
+        if path.endswith(os.sep):
+            path = path[:-1]
+
+        file_name = [path, profile_name] if path else [profile_name, ]
+        self.__file_name = os.sep.join(file_name)
+        self.__profiles = self.load(self.__file_name)
+
+    @staticmethod
+    def profile_key(model, soft_version):
+        """ Ключ профиля
+            :param model: модель устройства (device_model)
+            :param soft_version: версия ПО устройства (soft_version)
+        """
+        return u"{}:{}".format(model, soft_version)
+
+    @staticmethod
+    def load(file_name):
+        """ Чтение профилей из файла
+            :param file_name: имя файла
+            :returns словарь {ключ профиля: метрика команд}
+        """
+        if not os.path.exists(file_name):
+            return {}
+        with open(file_name) as handle:
+            try:
+                return json.load(handle)
+            except:
+                return {}
+
+    def get(self, model, soft_version):
+        """ Метрика команд для модели и версии ПО
+            :returns словарь вида {команда: [время ожидания, калибровка]}
+        """
+        with self.__lock:
+            profile = self.__profiles.get(
+                self.profile_key(model, soft_version)) or {}
+            return deepcopy(profile)
+
+    def collect(self, storage):
+        """ Агрегация метрики устройств в профили моделей.
+            Для каждой команды берется медиана времен ожидания
+            среди устройств одной модели и версии ПО.
+            :param storage: объект класса SMARTDescriptor
+        """
+        samples = {}
+        for namespace in storage.namespaces:
+            metric = storage.namespace(namespace)
+            device = metric.get('device') or {}
+            if 'model' not in device or 'soft_version' not in device:
+                continue
+            key = self.profile_key(device['model'], device['soft_version'])
+            commands = samples.setdefault(key, {})
+            for name, (timeout, _) in (metric.get('commands') or {}).items():
+                commands.setdefault(name, []).append(abs(timeout))
+
+        with self.__lock:
+            for key, commands in samples.items():
+                profile = self.__profiles.setdefault(key, {})
+                for name, timeouts in commands.items():
+                    timeouts.sort()
+                    profile[name] = [timeouts[len(timeouts) // 2], True]
+        return self.__profiles
+
+    def export(self, file_name=None):
+        """ Выгрузка профилей в файл
+            :param file_name: имя файла (по умолчанию -- файл профилей)
+        """
+        with self.__lock:
+            with open(file_name or self.__file_name, 'w') as handle:
+                json.dump(self.__profiles, handle)
+
+    def merge(self, file_name):
+        """ Загрузка профилей из файла с заменой совпадающих
+            :param file_name: имя файла
+        """
+        with self.__lock:
+            self.__profiles.update(**self.load(file_name))
+
+
+def device_identity(port, fingerprint=None):
+    """ Идентификатор устройства для пространства имен метрики
+        :param port: порт подключения
+        :param fingerprint: серийный номер или отпечаток параметров устройства
+    """
+    parts = [str(p) for p in (port, fingerprint) if p]
+    return '|'.join(parts) or SMART_DEFAULT
+
+
+class hybridmethod(object):
+    """ Метод, вызываемый от класса (первый аргумент -- класс)
+        и от экземпляра (первый аргумент -- экземпляр)
+    """
+
+    def __init__(self, func):
+        self.func = func
+
+    def __get__(self, instance, owner):
+        bound = functools.partial(
+            self.func, owner if instance is None else instance)
+        return functools.update_wrapper(bound, self.func)
 
 
 class SmartMixin(object):
     """ Интерфейс взаимодействия со SMART объектом """
 
     smart = None
+    smart_namespace = None
+    profiles = None
 
     @classmethod
     def register_smart(cls, metric_path, metric_name):
         cls.smart = SMARTDescriptor(metric_path, metric_name)
 
     @classmethod
-    def get_device_metric(cls):
-        metric = cls.smart or {}
-        return metric.get('device') or {}
+    def register_profiles(cls, profile_path, profile_name):
+        cls.profiles = SMARTProfiles(profile_path, profile_name)
 
     @classmethod
-    def get_commands_metric(cls):
-        metric = cls.smart or {}
-        return metric.get('commands') or {}
-
-
-class LogMixin(object):
-    """ Интерфейс логирования """
-
-    @staticmethod
-    def log_debug(msg, *args, **kwargs):
-        logger = logging.getLogger("LoremCross.cash_control")
+    def export_profiles(cls, file_name=None):
+        """ Построение профилей моделей по накопленной метрике
+            и выгрузка их в файл
+            :param file_name: имя файла (по умолчанию -- файл профилей)
+        """
+        storage = cls.get_smart_storage()
+        if cls.profiles is None or storage is None:
+            return False
+        cls.profiles.collect(storage)
+        cls.profiles.export(file_name)
+        return True
 
-        logger.debug(msg)
+    @classmethod
+    def get_smart_storage(cls):
+        """ Объект хранения метрики (SMARTDescriptor) """
+        for klass in cls.__mro__:
+            if isinstance(klass.__dict__.get('smart'), SMARTDescriptor):
+                return klass.__dict__['smart']
+
+    def bind_smart(self, namespace):
+        """ Привязка экземпляра к пространству имен метрики.
+            Пустое новое пространство имен заполняется метрикой того же
+            устройства: из пространства имен его порта (идентификатор
+            уточнен отпечатком устройства) или из метрики старого формата
+            с тем же портом. Параметры подключения (раздел device)
+            не переносятся.
+            :param namespace: идентификатор устройства
+        """
+        storage = self.get_smart_storage()
+        if storage is not None and namespace != self.smart_namespace and \
+                not storage.namespace(namespace):
+            source = self.__migration_source(storage, namespace)
+            source.pop('device', None)
+            if source:
+                storage.update(namespace, **source)
+        self.smart_namespace = namespace
+
+    def __migration_source(self, storage, namespace):
+        """ Метрика того же устройства для переноса в новое пространство
+            имен (или пустой словарь)
+        """
+        current = self.smart_namespace
+        if current and current != SMART_DEFAULT and \
+                namespace.startswith(current + '|'):
+            return storage.namespace(current)
+        legacy = storage.namespace(SMART_DEFAULT)
+        port = (legacy.get('device') or {}).get('port')
+        if port and device_identity(port) == namespace.split('|')[0]:
+            return legacy
+        return {}
+
+    def update_smart(self, section, **value):
+        """ Обновление раздела метрики в пространстве имен экземпляра
+            :param section: раздел метрики (device, commands)
+            :param value: обновляемые значения
+            :returns обновленный раздел метрики
+        """
+        storage = self.get_smart_storage()
+        if storage is None:
+            return dict(value)
+        return storage.update_section(self.smart_namespace, section, **value)
+
+    def seed_from_profile(self):
+        """ Заполнение пустой метрики команд из профиля модели устройства
+            :returns признак применения профиля
+        """
+        device = self.get_device_metric()
+        if self.profiles is None or self.get_commands_metric():
+            return False
+        if 'model' not in device or 'soft_version' not in device:
+            return False
+
+        profile = self.profiles.get(device['model'], device['soft_version'])
+        if profile:
+            self.update_smart('commands', **profile)
+        return bool(profile)
+
+    # NOTE: Вызов от класса -- метрика пространства имен по умолчанию
+    @hybridmethod
+    def get_device_metric(self):
+        metric = self.smart or {}
+        return dict(metric.get('device') or {})
+
+    @hybridmethod
+    def get_commands_metric(self):
+        metric = self.smart or {}
+        return dict(metric.get('commands') or {})
+
+    @hybridmethod
+    def get_pacing_metric(self):
+        """ Изученные паузы между строками блока печати по командам """
+        metric = self.smart or {}
+        return dict(metric.get('pacing') or {})
+
+    @hybridmethod
+    def get_calibration_metric(self):
+        """ Времена ожидания, измеренные калибровкой по длинам строк
+            (см. CashRegister.calibrate)
+        """
+        metric = self.smart or {}
+        return dict(metric.get('calibration') or {})
 
-        if args:
-            logger.debug("args: {}".format(args))
 
-        if kwargs:
-            logger.debug("kwargs: {}".format(kwargs))
+class RingBufferHandler(logging.Handler):
+    """ Обработчик журнала, хранящий последние записи в кольцевом буфере """
 
-    @staticmethod
-    def log_info(msg, *args, **kwargs):
-        logger = logging.getLogger("LoremCross.cash_control")
+    def __init__(self, capacity=1000, level=logging.NOTSET):
+        logging.Handler.__init__(self, level)
+        self.records = deque(maxlen=capacity)
 
-        logger.info(msg)
+    def emit(self, record):
+        self.records.append(record)
 
-        if args:
-            logger.info("args: {}".format(args))
 
-        if kwargs:
-            logger.info("kwargs: {}".format(kwargs))
+class StructuredFormatter(logging.Formatter):
+    """ Форматирование записей журнала в JSON
+        с учетом структурированных полей (команда, устройство, попытка,
+        время выполнения)
+    """
 
-    @staticmethod
-    def log_warning(msg, *args, **kwargs):
-        logger = logging.getLogger("LoremCross.cash_control")
+    def format(self, record):
+        entry = {'time': record.created, 'level': record.levelname,
+                 'message': record.getMessage()}
+        entry.update(getattr(record, STRUCTURED_FIELD, None) or {})
+        return json.dumps(entry, default=repr)
 
-        logger.warn(msg)
 
-        if args:
-            logger.warn("args: {}".format(args))
+class LogMixin(object):
+    """ Интерфейс логирования
+        Логгер кэшируется на уровне класса, сообщения формируются только
+        при включенном уровне журналирования.
+        При log_structured = True обертка команд дополнительно порождает
+        структурированные записи: поля записи доступны обработчикам
+        в атрибуте cash_control.
+    """
 
+    logger = logging.getLogger(LOGGER_NAME)
+    log_structured = False
 
-        if kwargs:
-            logger.warn("kwargs: {}".format(kwargs))
+    @classmethod
+    def log_enabled(cls, level):
+        """ Признак включенного уровня журналирования """
+        return cls.logger.isEnabledFor(level)
 
-    @staticmethod
-    def log_error(msg, *args, **kwargs):
-        logger = logging.getLogger("LoremCross.cash_control")
+    @classmethod
+    def _log(cls, level, msg, args, kwargs):
+        logger = cls.logger
+        if not logger.isEnabledFor(level):
+            return
 
-        logger.error(msg)
+        logger.log(level, msg)
 
         if args:
-            logger.error("args: {}".format(args))
+            logger.log(level, "args: %s", args)
 
         if kwargs:
-            logger.error("kwargs: {}".format(kwargs))
+            logger.log(level, "kwargs: %s", kwargs)
 
-    @staticmethod
-    def log_critical(msg, *args, **kwargs):
-        logger = logging.getLogger("LoremCross.cash_control")
+    @classmethod
+    def log_debug(cls, msg, *args, **kwargs):
+        cls._log(logging.DEBUG, msg, args, kwargs)
 
-        logger.critical(msg)
+    @classmethod
+    def log_info(cls, msg, *args, **kwargs):
+        cls._log(logging.INFO, msg, args, kwargs)
 
-        if args:
-            logger.critical("args: {}".format(args))
+    @classmethod
+    def log_warning(cls, msg, *args, **kwargs):
+        cls._log(logging.WARNING, msg, args, kwargs)
 
-        if kwargs:
-            logger.critical("kwargs: {}".format(kwargs))
+    @classmethod
+    def log_error(cls, msg, *args, **kwargs):
+        cls._log(logging.ERROR, msg, args, kwargs)
+
+    @classmethod
+    def log_critical(cls, msg, *args, **kwargs):
+        cls._log(logging.CRITICAL, msg, args, kwargs)
+
+    @classmethod
+    def log_record(cls, level, msg, **fields):
+        """ Структурированная запись журнала
+            :param level: уровень журналирования
+            :param msg: сообщение
+            :param fields: поля записи (command, device, attempt, latency)
+        """
+        if cls.log_structured and cls.logger.isEnabledFor(level):
+            cls.logger.log(level, msg, extra={STRUCTURED_FIELD: fields})
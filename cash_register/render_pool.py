@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+""" LoremCross
+    Модуль работы с фискальными устройствами
+    Пул процессов для рендера шаблонов печати
+
+    Шаблоны выполняются в процессах пула; результат -- список команд
+    в переносимом виде (ProxyCashRegister.serialize), который
+    выполняется на устройстве в процессе-владельце подключения
+    (ProxyCashRegister.from_plan). Каждый процесс пула держит свой
+    TemplateReader; указанные шаблоны компилируются при запуске процесса.
+    Класс CashRegister передается процессам пула по имени ("модуль.Класс")
+    и импортируется при запуске процесса.
+"""
+from importlib import import_module
+from multiprocessing import Pool
+
+from cash_register import CashRegister
+from middleware import ProxyCashRegister, TemplateReader
+from utils import execute_printing_script
+
+# Состояние процесса пула
+_reader = None
+_register_class = CashRegister
+
+
+def class_path(cls):
+    """ Имя класса для импорта: "модуль.Класс" """
+    return '{}.{}'.format(cls.__module__, cls.__name__)
+
+
+def import_class(path):
+    """ Класс по имени "модуль.Класс" """
+    module, _, name = path.rpartition('.')
+    return getattr(import_module(module), name)
+
+
+def _init_worker(path, warm, register_path):
+    """ Инициализация процесса пула: шаблонизатор, класс CashRegister
+        и прогрев кэша скомпилированных шаблонов
+        :param register_path: имя класса CashRegister (см. class_path)
+    """
+    global _reader, _register_class
+    _reader = TemplateReader(path)
+    _register_class = import_class(register_path)
+    for name in warm:
+        _reader.get_template(name)
+
+
+def _render(template_name, data, context):
+    """ Рендер шаблона в процессе пула
+        :returns список команд в переносимом виде
+    """
+    proxy = ProxyCashRegister(_register_class)
+    execute_printing_script(
+        template_name, {'cash_reg': proxy}, data, context, _reader)
+    return proxy.serialize()
+
+
+class RenderPool(object):
+    """ Пул процессов рендера шаблонов
+        :param path: каталог шаблонов печати
+        :param processes: число процессов (по умолчанию -- число ядер)
+        :param warm: шаблоны, компилируемые при запуске процесса
+        :param register_class: класс CashRegister (или наследник),
+            доступный для импорта по имени модуля и класса (объявленный
+            на уровне модуля), либо его имя "модуль.Класс"
+        :raises ValueError: класс недоступен для импорта по имени
+    """
+
+    def __init__(self, path, processes=None, warm=(),
+                 register_class=CashRegister):
+        if isinstance(register_class, basestring):
+            register_path = register_class
+            register_class = import_class(register_path)
+        else:
+            register_path = class_path(register_class)
+            try:
+                imported = import_class(register_path)
+            except (ImportError, AttributeError):
+                imported = None
+            if imported is not register_class:
+                raise ValueError(
+                    u"Класс {} недоступен для импорта в процессах "
+                    u"пула".format(register_path))
+        self.register_class = register_class
+        self.__pool = Pool(processes, _init_worker,
+                           (path, list(warm), register_path))
+
+    def render(self, template_name, data, context, timeout=None):
+        """ Рендер шаблона с ожиданием результата
+            :returns список команд в переносимом виде
+        """
+        result = self.__pool.apply_async(
+            _render, (template_name, data, context))
+        return result.get(timeout)
+
+    def render_async(self, template_name, data, context, callback=None):
+        """ Рендер шаблона без ожидания
+            :param callback: обработчик результата callback(plan)
+            :returns объект AsyncResult
+        """
+        return self.__pool.apply_async(
+            _render, (template_name, data, context), callback=callback)
+
+    def proxy(self, template_name, data, context, timeout=None):
+        """ Рендер шаблона в прокси-объект для выполнения на устройстве
+            (аналог execute_script)
+            :returns объект класса ProxyCashRegister
+        """
+        return ProxyCashRegister.from_plan(
+            self.register_class,
+            self.render(template_name, data, context, timeout))
+
+    def close(self):
+        """ Завершение работы пула после выполнения заданий """
+        self.__pool.close()
+        self.__pool.join()
+
+    def terminate(self):
+        self.__pool.terminate()
+        self.__pool.join()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+""" LoremCross
+    Модуль работы с фискальными устройствами
+    Политики разрешения ошибок без участия пользователя
+
+    Политика получает ответ команды, требующий реакции, и возвращает
+    список реакций (как ответ пользователя на define_user_case) либо
+    None -- тогда решение передается следующей политике цепочки,
+    а при отсутствии решения -- пользователю (эскалация).
+"""
+from lc_cashcontrol.device_types.shtrih.shtrih_constants import \
+    COMMAND_CLASSES, CMD_PAPER
+
+# Нефискальные команды, пропуск которых не нарушает документ
+SKIPPABLE_COMMANDS = frozenset(
+    name for name, cls in COMMAND_CLASSES.items()
+    if cls == CMD_PAPER and name != 'continue_print')
+
+
+class ResolutionPolicy(object):
+    """ Базовая политика: решение всегда передается пользователю """
+
+    def resolve(self, command, response, attempt):
+        """ Выбор реакции на ответ команды
+            :param command: наименование команды
+            :param response: ответ команды (action, exception, is_critical)
+            :param attempt: номер попытки выполнения команды
+            :returns список реакций или None (эскалация)
+        """
+        return None
+
+
+Escalate = ResolutionPolicy
+
+
+class AutoRetry(ResolutionPolicy):
+    """ Автоматический повтор команды (занятость устройства, 0x50)
+        и ожидание устранения ошибки (нет бумаги)
+        :param limit: наибольшее число автоматических повторов
+        :param wait: признак автоматического ожидания (action wait)
+    """
+
+    def __init__(self, limit=3, wait=True):
+        self.limit = limit
+        self.wait = wait
+
+    def resolve(self, command, response, attempt):
+        if attempt >= self.limit:
+            return None
+        action = response['action']
+        if action == 'retry':
+            return ['retry']
+        if action == 'wait' and self.wait:
+            return ['wait', 'retry']
+        return None
+
+
+class AutoSkip(ResolutionPolicy):
+    """ Пропуск нефискальных команд (печать строк, протяжка, отрезка)
+        вне критической области печати
+        :param commands: пропускаемые команды
+    """
+
+    def __init__(self, commands=SKIPPABLE_COMMANDS):
+        self.commands = frozenset(commands)
+
+    def resolve(self, command, response, attempt):
+        if response['is_critical'] or command not in self.commands:
+            return None
+        return ['skip']
+
+
+class AutoCancel(ResolutionPolicy):
+    """ Прерывание (с аннулированием чека) команды,
+        завершившейся ошибкой в критической области печати
+    """
+
+    def resolve(self, command, response, attempt):
+        if response['is_critical'] and response['action'] == 'break':
+            return ['break']
+        return None
+
+
+class ResolutionChain(ResolutionPolicy):
+    """ Цепочка политик: применяется первое найденное решение """
+
+    def __init__(self, *policies):
+        self.policies = list(policies)
+
+    def resolve(self, command, response, attempt):
+        for policy in self.policies:
+            reaction = policy.resolve(command, response, attempt)
+            if reaction is not None:
+                return reaction
+        return None
+
+
+def unattended(limit=3):
+    """ Цепочка для работы без оператора (киоски, пакетные отчеты):
+        повтор, затем пропуск нефискальной команды или аннулирование
+        чека; остальное передается пользователю
+        :param limit: наибольшее число автоматических повторов
+    """
+    return ResolutionChain(AutoRetry(limit), AutoSkip(), AutoCancel())
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+""" LoremCross
+    Модуль работы с фискальными устройствами
+    Планировщик команд устройства с классами приоритета
+
+    Все обращения к устройству выполняются одним рабочим потоком.
+    Задания (планы команд) выбираются по приоритету:
+        запросы состояния > чеки > отчеты > обслуживание.
+    Задание более высокого приоритета выполняется между командами
+    текущего задания, но не внутри критической области печати
+    (между продажей и закрытием чека). Поэтому чек следует передавать
+    одним заданием: чек, оставленный открытым, аннулируется перед
+    выполнением другого задания. Исключение в команде завершает задание
+    ошибкой, не останавливая рабочий поток. После остановки планировщика
+    незавершенные задания завершаются ошибкой, новые не принимаются.
+"""
+import heapq
+import itertools
+from threading import Condition, Event, Thread
+
+from lc_cashcontrol.device_types.shtrih.retry import RetryPolicies
+from lc_cashcontrol.device_types.shtrih.shtrih_constants import CMD_STATUS, \
+    CMD_FISCAL, CMD_PAPER, CMD_REPORT, CMD_SERVICE
+from cash_register import step_failed
+from events import EVT_PLAN_STARTED, EVT_PLAN_FINISHED, EVT_ERROR
+
+PRIO_STATUS = 0         # интерактивные запросы состояния
+PRIO_FISCAL = 1         # чеки и нефискальные документы
+PRIO_REPORT = 2         # отчеты
+PRIO_HOUSEKEEPING = 3   # обслуживание (дата, время, параметры)
+
+# Приоритет задания по классам его команд (первый найденный класс)
+PLAN_PRIORITIES = [
+    (CMD_REPORT, PRIO_REPORT),
+    (CMD_FISCAL, PRIO_FISCAL),
+    (CMD_PAPER, PRIO_FISCAL),
+    (CMD_SERVICE, PRIO_HOUSEKEEPING),
+    (CMD_STATUS, PRIO_STATUS),
+]
+
+
+def command_name(cmd):
+    """ Наименование команды плана (имя или обертка команды) """
+    return cmd if isinstance(cmd, basestring) else cmd.__name__
+
+
+def step_error(name, exc):
+    """ Ответ команды, завершившейся исключением
+        :param name: наименование команды
+        :param exc: исключение
+    """
+    return {'action': 'break', 'command': name, 'is_critical': False,
+            'post_critical': False, 'data': {}, 'delta': 0,
+            'delta_for_last_command': 0,
+            'exception': {'error': exc.__class__.__name__, 'code': -1,
+                          'message': u"{}".format(exc), 'args': (),
+                          'description': u"{}".format(exc),
+                          'action': 'break'}}
+
+
+def stopped_error():
+    """ Ошибка задания, не выполненного до остановки планировщика """
+    return RuntimeError(u"Планировщик устройства остановлен")
+
+
+def plan_priority(plan):
+    """ Приоритет задания по классам его команд
+        :param plan: список (команда, позиционные аргументы,
+            именованные аргументы)
+    """
+    classes = set(RetryPolicies.command_class(command_name(item[0]))
+                  for item in plan)
+    for command_class, priority in PLAN_PRIORITIES:
+        if command_class in classes:
+            return priority
+    return PRIO_HOUSEKEEPING
+
+
+class Task(object):
+    """ Задание планировщика """
+
+    def __init__(self, plan, priority, seq, bus=None):
+        self.plan = list(plan)
+        self.priority = priority
+        self.seq = seq
+        self.bus = bus
+        self.results = []
+        self.failed = False
+        self.__done = Event()
+
+    @property
+    def position(self):
+        """ Номер следующей команды """
+        return len(self.results)
+
+    @property
+    def finished(self):
+        return self.failed or self.position >= len(self.plan)
+
+    @property
+    def done(self):
+        return self.__done.is_set()
+
+    def wait(self, timeout=None):
+        """ Ожидание завершения задания
+            :param timeout: время ожидания
+            :returns список ответов или None по истечении времени
+        """
+        if not self.__done.wait(timeout):
+            return None
+        return self.results
+
+    def _complete(self):
+        self.__done.set()
+
+
+class DeviceScheduler(object):
+    """ Планировщик команд устройства
+        :param register: объект класса CashRegister
+    """
+
+    def __init__(self, register):
+        self.__register = register
+        self.__cond = Condition()
+        self.__queue = []
+        self.__current = None
+        self.__seq = itertools.count()
+        self.__stopped = False
+        self.__thread = Thread(target=self.__loop)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def submit(self, plan, priority=None, bus=None):
+        """ Постановка задания в очередь
+            :param plan: список (команда, позиционные аргументы,
+                именованные аргументы); команда -- имя или обертка
+            :param priority: приоритет (PRIO_*); по умолчанию --
+                по классам команд задания
+            :param bus: объект класса EventBus
+            :returns объект класса Task
+            :raises RuntimeError: планировщик остановлен
+        """
+        if priority is None:
+            priority = plan_priority(plan)
+        with self.__cond:
+            if self.__stopped:
+                raise stopped_error()
+            task = Task(plan, priority, next(self.__seq), bus)
+            heapq.heappush(self.__queue, (priority, task.seq, task))
+            self.__cond.notify()
+        return task
+
+    def call(self, name, *args, **kwargs):
+        """ Выполнение одной команды с ожиданием ответа
+            (например, запрос состояния из UI)
+            :param name: наименование команды
+            :returns ответ команды
+        """
+        task = self.submit([(name, args, kwargs)])
+        return task.wait()[0]
+
+    def stop(self, wait=True):
+        """ Остановка рабочего потока после текущей команды.
+            Задания, не выполненные до остановки, завершаются ошибкой.
+        """
+        with self.__cond:
+            self.__stopped = True
+            self.__cond.notify()
+        if wait:
+            self.__thread.join()
+
+    def __next_task(self):
+        """ Выбор задания для выполнения очередной команды """
+        with self.__cond:
+            while not (self.__stopped or self.__queue or self.__current):
+                self.__cond.wait()
+            if self.__stopped:
+                return None
+
+            current = self.__current
+            if current is not None and self.__queue and \
+                    self.__queue[0][0] < current.priority and \
+                    not self.__register.in_critical_zone:
+                # NOTE: Вытеснение между командами вне критической области
+                heapq.heappush(self.__queue,
+                               (current.priority, current.seq, current))
+                current = None
+            if current is None:
+                current = heapq.heappop(self.__queue)[2]
+            self.__current = current
+            return current
+
+    def __rollback(self):
+        """ Аннулирование чека, оставленного открытым предыдущим заданием """
+        register = self.__register
+        if not register.in_critical_zone:
+            return
+        register.log_warning(u"Аннулирование чека незавершенного задания")
+        try:
+            register.make_cancel_check()
+        except Exception as exc:
+            register.log_critical(u"Не удалось аннулировать чек", exc)
+
+    def __step(self, task):
+        """ Выполнение очередной команды задания; исключение команды
+            завершает задание ошибкой, рабочий поток продолжает работу
+        """
+        item = task.plan[task.position]
+        try:
+            return self.__register.run_step(task.position, item, task.bus)
+        except Exception as exc:
+            name = command_name(item[0])
+            self.__register.log_critical(
+                u"Unhandled exception while making {}".format(name), exc)
+            response = step_error(name, exc)
+            if task.bus is not None:
+                task.bus.emit(EVT_ERROR, index=task.position, command=name,
+                              exception=response['exception'])
+            return response
+
+    def __finish(self, task):
+        """ Завершение задания с передачей итогового события """
+        if task.bus is not None:
+            task.bus.emit(EVT_PLAN_FINISHED, total=len(task.plan),
+                          completed=task.position, success=not task.failed)
+        task._complete()
+
+    def __drain(self):
+        """ Завершение ошибкой заданий, оставшихся после остановки
+            (текущее задание и очередь)
+        """
+        with self.__cond:
+            tasks = [item[2] for item in sorted(self.__queue)]
+            if self.__current is not None:
+                tasks.insert(0, self.__current)
+            self.__queue, self.__current = [], None
+        for task in tasks:
+            index = task.position
+            name = command_name(task.plan[index][0]) \
+                if index < len(task.plan) else None
+            response = step_error(name, stopped_error())
+            task.results.append(response)
+            task.failed = True
+            if task.bus is not None:
+                task.bus.emit(EVT_ERROR, index=index, command=name,
+                              exception=response['exception'])
+            self.__finish(task)
+
+    def __loop(self):
+        last = None
+        while True:
+            task = self.__next_task()
+            if task is None:
+                self.__drain()
+                return
+            if task is not last:
+                # NOTE: Чеки заданий не должны перемежаться
+                self.__rollback()
+                last = task
+            bus = task.bus
+            if bus is not None and not task.position:
+                bus.emit(EVT_PLAN_STARTED, total=len(task.plan))
+
+            response = self.__step(task)
+            task.results.append(response)
+            task.failed = step_failed(response)
+
+            if task.finished:
+                with self.__cond:
+                    self.__current = None
+                self.__finish(task)
@@ -0,0 +1,391 @@
+# -*- coding: utf-8 -*-
+""" LoremCross
+    Модуль работы с фискальными устройствами
+    Сервер печати
+
+    Сервер держит подключения к устройствам, их метрику и скомпилированные
+    шаблоны. Клиенты передают задания через Unix сокет или TCP (localhost);
+    обмен -- строки JSON. Запросы:
+        {"id": ..., "op": "script", "device": ..., "template": ...,
+         "data": {...}, "context": {...}, "priority": ...}
+        {"id": ..., "op": "command", "device": ..., "command": ...,
+         "args": [...], "kwargs": {...}, "priority": ...}
+        {"op": "reply", "decision": ..., "reaction": [...]}
+        {"id": ..., "op": "devices"}
+    Ход выполнения передается событиями {"id": ..., "event": ..., ...}
+    (см. events); выполнение завершается событием plan_finished.
+    Задания всех клиентов выполняются планировщиком устройства
+    (DeviceScheduler) на постоянном подключении. Приоритет клиента
+    (PRIO_*) может только понизить приоритет задания относительно
+    классов его команд. Реакция в ответе reply -- список из REACTIONS,
+    иначе применяется реакция по умолчанию.
+"""
+import itertools
+import json
+import os
+import socket
+from threading import Lock
+
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+try:
+    from Queue import Queue, Empty, Full
+except ImportError:
+    from queue import Queue, Empty, Full
+
+from events import EventBus, EVT_DECISION, EVT_ERROR, EVT_PLAN_FINISHED, \
+    DEFAULT_REACTION, valid_reaction
+from middleware import ProxyCashRegister, TemplateReader
+from scheduler import DeviceScheduler, PRIO_HOUSEKEEPING, plan_priority
+from utils import execute_printing_script
+
+DEFAULT_TCP_PORT = 9170
+DECISION_TIMEOUT = 60   # время ожидания решения клиента
+
+
+def _jsonable(value):
+    """ Приведение ответа команды к виду, допустимому для JSON
+        (байтовые строки декодируются, кортежи -- списки)
+    """
+    if isinstance(value, dict):
+        return dict((k, _jsonable(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple, set)):
+        return [_jsonable(v) for v in value]
+    if isinstance(value, bytes) and not isinstance(value, str):
+        return value.decode('latin-1')
+    if isinstance(value, str) and str is bytes:
+        try:
+            return value.decode('utf-8')
+        except UnicodeDecodeError:
+            return value.decode('latin-1')
+    return value
+
+
+def request_priority(priority, plan):
+    """ Приоритет задания клиента: не выше приоритета по классам
+        команд задания (клиент не может опередить чеки и запросы
+        состояния других клиентов)
+        :param priority: приоритет из запроса (PRIO_*)
+        :param plan: план команд задания
+    """
+    base = plan_priority(plan)
+    if isinstance(priority, bool) or not isinstance(priority, (int, long)):
+        return base
+    return min(max(priority, base), PRIO_HOUSEKEEPING)
+
+
+class ClientChannel(object):
+    """ Соединение клиента: запись событий и ожидание решений """
+
+    def __init__(self, wfile, decision_timeout=DECISION_TIMEOUT):
+        self.__wfile = wfile
+        self.__lock = Lock()
+        self.__decisions = {}
+        self.__seq = itertools.count(1)
+        self.closed = False
+        self.decision_timeout = decision_timeout
+
+    def send(self, message):
+        line = json.dumps(_jsonable(message)) + '\n'
+        with self.__lock:
+            if self.closed:
+                return
+            try:
+                self.__wfile.write(line.encode('utf-8'))
+                self.__wfile.flush()
+            except (socket.error, ValueError):
+                self.closed = True
+
+    def ask(self, request_id, command, case):
+        """ Запрос решения у клиента
+            :returns список реакций
+        """
+        if self.closed or not self.decision_timeout:
+            return list(DEFAULT_REACTION)
+        answers = Queue(1)
+        with self.__lock:
+            decision = next(self.__seq)
+            self.__decisions[decision] = answers
+        self.send({'id': request_id, 'event': EVT_DECISION,
+                   'command': command, 'decision': decision,
+                   'cases': list(case['cases'].items()),
+                   'exception': case['exception']})
+        try:
+            return answers.get(timeout=self.decision_timeout) or \
+                list(DEFAULT_REACTION)
+        except Empty:
+            return list(DEFAULT_REACTION)
+        finally:
+            with self.__lock:
+                self.__decisions.pop(decision, None)
+
+    def reply(self, decision, reaction):
+        """ Передача решения клиента; неверная реакция заменяется
+            реакцией по умолчанию
+        """
+        if not valid_reaction(reaction):
+            reaction = None
+        with self.__lock:
+            answers = self.__decisions.get(decision)
+        if answers is not None:
+            try:
+                answers.put_nowait(reaction)
+            except Full:
+                pass
+
+    def close(self):
+        with self.__lock:
+            self.closed = True
+            pending = list(self.__decisions.values())
+        for answers in pending:
+            try:
+                answers.put_nowait(None)
+            except Full:
+                pass
+
+
+class RequestBus(EventBus):
+    """ Шина событий запроса: события передаются клиенту с id запроса """
+
+    def __init__(self, channel, request_id):
+        super(RequestBus, self).__init__()
+        self.channel = channel
+        self.request_id = request_id
+
+    def emit(self, event, **fields):
+        fields['id'] = self.request_id
+        fields['event'] = event
+        self.channel.send(fields)
+
+    def decide(self, command, case):
+        return self.channel.ask(self.request_id, command, case)
+
+
+class PrintServer(object):
+    """ Сервер печати
+        :param path: каталог шаблонов печати
+        :param resolution_policy: политика разрешения ошибок для всех
+            устройств сервера (ResolutionPolicy)
+        :param decision_timeout: время ожидания решения клиента;
+            0 -- решения не запрашиваются (команда прерывается)
+        :param render_pool: пул процессов рендера шаблонов (RenderPool);
+            без него шаблоны выполняются в потоке соединения
+    """
+
+    def __init__(self, path=None, resolution_policy=None,
+                 decision_timeout=DECISION_TIMEOUT, render_pool=None):
+        self.reader = TemplateReader(path)
+        self.render_pool = render_pool
+        self.resolution_policy = resolution_policy
+        self.decision_timeout = decision_timeout
+        self.__devices = {}
+        self.__servers = []
+
+    def add_device(self, name, register):
+        """ Подключение устройства к серверу
+            :param name: имя устройства в запросах клиентов
+            :param register: объект класса CashRegister
+            :returns объект класса DeviceScheduler
+        """
+        if self.resolution_policy is not None:
+            register.resolution_policy = self.resolution_policy
+        scheduler = DeviceScheduler(register)
+        self.__devices[name] = (register, scheduler)
+        return scheduler
+
+    def remove_device(self, name):
+        register, scheduler = self.__devices.pop(name)
+        scheduler.stop()
+        return register
+
+    @property
+    def devices(self):
+        return sorted(self.__devices)
+
+    def submit(self, request, bus):
+        """ Постановка запроса в очередь устройства
+            :param request: запрос (op script или command)
+            :param bus: объект класса EventBus
+            :returns объект класса Task
+        """
+        register, scheduler = self.__devices[request['device']]
+        if request['op'] == 'script':
+            data = request.get('data') or {}
+            context = request.get('context') or {}
+            if self.render_pool is not None:
+                proxy = ProxyCashRegister.from_plan(
+                    type(register), self.render_pool.render(
+                        request['template'], data, context))
+            else:
+                proxy = ProxyCashRegister(type(register))
+                execute_printing_script(
+                    request['template'], {'cash_reg': proxy}, data, context,
+                    self.reader)
+            plan = proxy.plan(register)
+        else:
+            name = request.get('command')
+            if not isinstance(name, basestring) or \
+                    not hasattr(getattr(type(register), name, None), 'raw'):
+                raise ValueError(u"Неизвестная команда: {}".format(name))
+            plan = [(name, tuple(request.get('args') or ()),
+                     request.get('kwargs') or {})]
+        return scheduler.submit(
+            plan, request_priority(request.get('priority'), plan), bus)
+
+    def handle(self, channel, request):
+        """ Обработка запроса клиента """
+        op = request.get('op')
+        request_id = request.get('id')
+        if op == 'reply':
+            channel.reply(request.get('decision'), request.get('reaction'))
+            return
+        if op == 'devices':
+            channel.send({'id': request_id, 'event': 'devices',
+                          'devices': self.devices})
+            return
+
+        bus = RequestBus(channel, request_id)
+        try:
+            if op not in ('script', 'command'):
+                raise ValueError(u"Неизвестный запрос: {}".format(op))
+            if request.get('device') not in self.__devices:
+                raise KeyError(u"Неизвестное устройство: {}".format(
+                    request.get('device')))
+            self.submit(request, bus)
+        except Exception as exc:
+            bus.emit(EVT_ERROR, exception={
+                'error': exc.__class__.__name__, 'code': -1,
+                'description': u"{}".format(exc), 'action': 'break'})
+            bus.emit(EVT_PLAN_FINISHED, total=0, completed=0, success=False)
+
+    def __handler(self):
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                channel = ClientChannel(self.wfile, server.decision_timeout)
+                try:
+                    for line in self.rfile:
+                        if not line.strip():
+                            continue
+                        try:
+                            request = json.loads(line.decode('utf-8'))
+                        except ValueError:
+                            continue
+                        if isinstance(request, dict):
+                            server.handle(channel, request)
+                finally:
+                    channel.close()
+
+        return Handler
+
+    def serve_unix(self, path):
+        """ Запуск сервера на Unix сокете (в текущем потоке)
+            :param path: путь сокета
+        """
+        if os.path.exists(path):
+            os.remove(path)
+
+        class UnixServer(socketserver.ThreadingMixIn,
+                         socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        return self.__serve(UnixServer(path, self.__handler()))
+
+    def serve_tcp(self, host='127.0.0.1', port=DEFAULT_TCP_PORT):
+        """ Запуск сервера на TCP порту (в текущем потоке)
+            :param host: адрес (по умолчанию только локальный)
+            :param port: порт
+        """
+        class TCPServer(socketserver.ThreadingMixIn,
+                        socketserver.TCPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        return self.__serve(TCPServer((host, port), self.__handler()))
+
+    def __serve(self, server):
+        self.__servers.append(server)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+
+    def shutdown(self):
+        """ Остановка сервера и планировщиков устройств """
+        for server in self.__servers:
+            server.shutdown()
+        self.__servers = []
+        for name in list(self.__devices):
+            self.remove_device(name)
+
+
+class PrintClient(object):
+    """ Клиент сервера печати
+        :param path: путь Unix сокета сервера
+        :param host: адрес TCP сервера (если path не задан)
+        :param port: порт TCP сервера
+    """
+
+    def __init__(self, path=None, host='127.0.0.1', port=DEFAULT_TCP_PORT):
+        if path is not None:
+            self.__socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.__socket.connect(path)
+        else:
+            self.__socket = socket.create_connection((host, port))
+        self.__rfile = self.__socket.makefile('rb')
+        self.__seq = itertools.count(1)
+
+    def close(self):
+        self.__rfile.close()
+        self.__socket.close()
+
+    def __send(self, request):
+        self.__socket.sendall(json.dumps(request).encode('utf-8') + b'\n')
+
+    def request(self, request, on_event=None, decide=None):
+        """ Выполнение запроса с ожиданием завершения
+            :param request: запрос (без id)
+            :param on_event: обработчик событий on_event(event)
+            :param decide: обработчик выбора decide(command, cases) -> реакции;
+                без него решение не принимается (команда прерывается)
+            :returns завершающее событие запроса
+        """
+        request = dict(request, id=next(self.__seq))
+        self.__send(request)
+        for line in self.__rfile:
+            event = json.loads(line.decode('utf-8'))
+            if event.get('id') != request['id']:
+                continue
+            if on_event is not None:
+                on_event(event)
+            if event['event'] == EVT_DECISION:
+                reaction = None
+                if decide is not None:
+                    reaction = decide(event['command'], event['cases'])
+                self.__send({'op': 'reply', 'decision': event['decision'],
+                             'reaction': reaction})
+            elif event['event'] in (EVT_PLAN_FINISHED, 'devices'):
+                return event
+        raise socket.error(u"Соединение с сервером печати закрыто")
+
+    def script(self, device, template, data=None, context=None,
+               priority=None, **kwargs):
+        """ Выполнение сценария печати на устройстве сервера """
+        return self.request(
+            {'op': 'script', 'device': device, 'template': template,
+             'data': data or {}, 'context': context or {},
+             'priority': priority}, **kwargs)
+
+    def command(self, device, command, *args, **kwargs):
+        """ Выполнение одной команды на устройстве сервера """
+        return self.request(
+            {'op': 'command', 'device': device, 'command': command,
+             'args': list(args), 'kwargs': kwargs})
+
+    def devices(self):
+        """ Список устройств сервера """
+        return self.request({'op': 'devices'})['devices']
@@ -3,6 +3,7 @@
     Модуль работы с фискальными устройствами
     Вспомогательные функции
 """
+from layout import format_line
 from middleware import TemplateReader
 
 
@@ -14,12 +15,7 @@ def format_string(text, width, align='left', fill='', bold=False):
         :param fill: символы для заполнения строки
         :param bold: печать жирной строки
     """
-    width = width / 2 if bold is True else width
-    aligns = {'left': u"{:%s<%d}" % (fill or '', width),
-              'center': u"{:%s^%d}" % (fill or '', width),
-              'right': u"{:%s>%d}" % (fill or '', width)}
-    fmt = aligns.get(align) or aligns['left']
-    return fmt.format(text)
+    return format_line(text, width, align, fill, bold)
 
 
 def prepare_barcode(value):
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+""" LoremCross
+    Модуль работы с фискальными устройствами
+    Интерфейсы печати на ККТ
+    Драйвер под устройства семейства "Штрих"
+    Размыкатель цепи (circuit breaker) для устройства
+
+    После нескольких подряд ошибок связи размыкатель открывается:
+    команды отклоняются (или передаются резервному устройству) без
+    обращения к порту. Фоновый поток проверяет устройство запросом ENQ
+    и, если устройство не отвечает, ищет его на переподключенном порту
+    той же группы. При восстановлении связи размыкатель закрывается.
+"""
+import os
+import re
+from threading import Event, Lock, Thread
+
+from .shtrih_constants import ERR_LOST_DEVICE, ERR_OPENING_PORT
+
+BREAKER_CLOSED = 'closed'
+BREAKER_OPEN = 'open'
+CONNECTION_ERRORS = [ERR_LOST_DEVICE, ERR_OPENING_PORT]
+
+
+def port_group(port):
+    """ Группа портов по имени порта (/dev/ttyUSB0 -> ttyUSB) """
+    return re.sub(r'\d+$', '', os.path.basename(port or '')) or None
+
+
+class CircuitBreaker(object):
+    """ Размыкатель цепи для объекта класса ShtrihCashRegister
+        :param register: объект класса ShtrihCashRegister
+        :param threshold: число ошибок связи подряд для размыкания
+        :param probe_interval: интервал фоновой проверки устройства
+        :param group: группа портов для повторного поиска устройства
+        :param on_state: обработчик смены состояния on_state(state, port, rate)
+    """
+
+    def __init__(self, register, threshold=3, probe_interval=1.0,
+                 group=None, on_state=None):
+        self.__register = register
+        self.__threshold = threshold
+        self.__interval = probe_interval
+        self.__group = group
+        self.__on_state = on_state
+        self.__lock = Lock()
+        self.__failures = 0
+        self.__state = BREAKER_CLOSED
+        self.__stop = Event()
+        self.__thread = None
+
+    @property
+    def state(self):
+        return self.__state
+
+    def allow(self):
+        """ Признак допустимости обращения к устройству """
+        return self.__state == BREAKER_CLOSED
+
+    def record(self, response):
+        """ Учет результата выполнения команды
+            :param response: ответ ShtrihCashRegister.make_action
+        """
+        exception = response.get('exception')
+        failed = bool(exception) and \
+            int(exception['code']) in CONNECTION_ERRORS
+        with self.__lock:
+            if not failed:
+                self.__failures = 0
+                return
+            self.__failures += 1
+            if self.__failures < self.__threshold or \
+                    self.__state == BREAKER_OPEN:
+                return
+            self.__state = BREAKER_OPEN
+        self.__notify()
+        self.__start_probe()
+
+    def close(self):
+        """ Закрытие размыкателя (связь восстановлена) """
+        with self.__lock:
+            self.__failures = 0
+            self.__state = BREAKER_CLOSED
+        self.__notify()
+
+    def stop(self):
+        """ Остановка фоновой проверки """
+        self.__stop.set()
+        if self.__thread is not None:
+            self.__thread.join(self.__interval * 2)
+            self.__thread = None
+
+    def __notify(self):
+        if self.__on_state is not None:
+            register = self.__register
+            self.__on_state(self.__state, register.port, register.rate)
+
+    def __start_probe(self):
+        if self.__thread is not None and self.__thread.is_alive():
+            return
+        self.__stop.clear()
+        self.__thread = Thread(target=self.__probe_loop)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def __probe_loop(self):
+        register = self.__register
+        group = self.__group or port_group(register.port)
+        while not self.__stop.wait(self.__interval):
+            if register.probe() or register.rediscover(group):
+                self.close()
+                return
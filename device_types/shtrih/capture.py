@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+""" LoremCross
+    Модуль работы с фискальными устройствами
+    Интерфейсы печати на ККТ
+    Драйвер под устройства семейства "Штрих"
+    Запись обмена с устройством и воспроизведение записанного сеанса
+
+    Формат файла записи: сигнатура CAPTURE_MAGIC и последовательность
+    записей вида
+        направление (1 байт): 0 -- ПК -> ККТ, 1 -- ККТ -> ПК
+        время от начала записи (8 байт, микросекунды)
+        длина данных (2 байта)
+        данные
+    Серия чтений, завершившихся по таймауту, записывается одной записью
+    с нулевой длиной.
+"""
+import time
+from struct import calcsize, pack, unpack
+from threading import Lock
+
+from .shtrih_constants import ERR_REPLAY_FINISHED
+from .shtrih_exceptions import ShtrihConnectionError
+from .utils import monotonic, str2hex
+
+CAPTURE_MAGIC = 'LCCAP\x02'
+RECORD = '<BQH'
+DIR_WRITE = 0
+DIR_READ = 1
+
+
+class CaptureWriter(object):
+    """ Запись обмена с устройством в файл """
+
+    def __init__(self, file_name):
+        self.__lock = Lock()
+        self.__handle = open(file_name, 'wb')
+        self.__handle.write(CAPTURE_MAGIC)
+        self.__start = monotonic()
+
+    def record(self, direction, data):
+        """ Запись фрагмента обмена
+            :param direction: направление (DIR_WRITE, DIR_READ)
+            :param data: переданные байты
+        """
+        stamp = int((monotonic() - self.__start) * 1000000)
+        with self.__lock:
+            if self.__handle is not None:
+                self.__handle.write(
+                    pack(RECORD, direction, stamp, len(data)) + data)
+
+    def close(self):
+        with self.__lock:
+            if self.__handle is not None:
+                self.__handle.close()
+                self.__handle = None
+
+
+def read_capture(file_name):
+    """ Чтение файла записи
+        :param file_name: имя файла
+        :returns генератор кортежей (направление, время в секундах, данные)
+    """
+    with open(file_name, 'rb') as handle:
+        if handle.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError("Неверный формат файла записи")
+        record_size = calcsize(RECORD)
+        while True:
+            header = handle.read(record_size)
+            if len(header) < record_size:
+                break
+            direction, stamp, length = unpack(RECORD, header)
+            yield direction, stamp / 1000000.0, handle.read(length)
+
+
+def dump_capture(file_name):
+    """ Текстовое представление файла записи
+        :param file_name: имя файла
+        :returns список строк вида "время направление байты"
+    """
+    lines = []
+    for direction, stamp, data in read_capture(file_name):
+        arrow = '>' if direction == DIR_WRITE else '<'
+        lines.append("%12.6f %s %s" % (stamp, arrow, str2hex(data) or '-'))
+    return lines
+
+
+class RecordingTransport(object):
+    """ Обертка над последовательным портом, записывающая обмен.
+        Прочие атрибуты и методы передаются порту без изменений.
+    """
+
+    def __init__(self, transport, writer):
+        self.__transport = transport
+        self.__writer = writer
+        self.__idle = False     # последнее чтение завершилось по таймауту
+
+    @property
+    def transport(self):
+        return self.__transport
+
+    def __getattr__(self, name):
+        return getattr(self.__transport, name)
+
+    def __setattr__(self, name, value):
+        if name.startswith('_'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.__transport, name, value)
+
+    def write(self, data):
+        self.__idle = False
+        self.__writer.record(DIR_WRITE, data)
+        return self.__transport.write(data)
+
+    def read(self, size=1):
+        data = self.__transport.read(size)
+        # NOTE: Опрос порта в ожидании ответа -- одна запись на серию
+        if data or not self.__idle:
+            self.__writer.record(DIR_READ, data)
+        self.__idle = not data
+        return data
+
+
+class ReplayTransport(object):
+    """ Имитация устройства по записанному сеансу обмена.
+        Ответы устройства выдаются в порядке записи; данные, переданные
+        драйвером, сверяются с записью (расхождения накапливаются
+        в атрибуте mismatches). Чтение после завершения сеанса
+        порождает ShtrihConnectionError (ERR_REPLAY_FINISHED).
+        :param scale: масштаб задержек ответа устройства
+            (1 -- исходные задержки, 0 -- без задержек)
+    """
+
+    def __init__(self, file_name, scale=1.0):
+        self.__records = list(read_capture(file_name))
+        self.__position = 0
+        self.__scale = scale
+        self.__last_write = (0.0, monotonic())
+        self.mismatches = []
+        self.timeout = None
+        self.writeTimeout = None
+        self.baudrate = None
+
+    @property
+    def exhausted(self):
+        """ Признак завершения записанного сеанса """
+        return self.__position >= len(self.__records)
+
+    def __next(self, direction):
+        while not self.exhausted:
+            record = self.__records[self.__position]
+            self.__position += 1
+            if record[0] == direction:
+                return record
+            if record[2]:
+                self.mismatches.append(record)
+        return None
+
+    def isOpen(self):
+        return True
+
+    def close(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def write(self, data):
+        record = self.__next(DIR_WRITE)
+        if record is None or record[2] != data:
+            self.mismatches.append((DIR_WRITE, None, data))
+        if record is not None:
+            self.__last_write = (record[1], monotonic())
+        return len(data)
+
+    def read(self, size=1):
+        # NOTE: Пустая запись -- серия чтений по таймауту. Перед ответом
+        #   устройства она пропускается (задержка воспроизводится по
+        #   отметкам времени), перед записью драйвера -- воспроизводится
+        #   таймаутом порта
+        records, position = self.__records, self.__position
+        while position < len(records) and records[position][0] == DIR_READ \
+                and not records[position][2]:
+            position += 1
+        if position >= len(records) or records[position][0] != DIR_READ:
+            if self.exhausted:
+                raise ShtrihConnectionError(ERR_REPLAY_FINISHED)
+            time.sleep(self.timeout or 0)
+            return ''
+        self.__position = position + 1
+        _, stamp, data = records[position]
+        if self.__scale:
+            written_at, written = self.__last_write
+            delay = (stamp - written_at) * self.__scale
+            delay -= monotonic() - written
+            if delay > 0:
+                time.sleep(delay)
+        return data[:size]
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+""" LoremCross
+    Модуль работы с фискальными устройствами
+    Интерфейсы печати на ККТ
+    Драйвер под устройства семейства "Штрих"
+    Отслеживание подключения устройств (inotify)
+
+    Наблюдатель следит за появлением и удалением tty устройств в /dev
+    и передает имя порта обработчикам (sysfs не порождает событий
+    inotify и не отслеживается). Работает только в Linux; на прочих
+    платформах start() возвращает False.
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+from threading import Event, Thread
+
+from .utils import monotonic
+
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_ADDED = IN_CREATE | IN_MOVED_TO
+IN_REMOVED = IN_DELETE | IN_MOVED_FROM
+WATCH_PATHS = ('/dev', )
+TTY_PREFIXES = ('ttyUSB', 'ttyACM', 'ttyS')
+EVENT = 'iIII'
+EVENT_SIZE = struct.calcsize(EVENT)
+DEDUP_TIME = 0.5    # интервал, в котором события одного порта объединяются
+# Узел устройства появляется раньше, чем порт готов к обмену (права
+# доступа, инициализация драйвера): поиск на новом порту повторяется
+PROBE_TRIES = 4
+PROBE_DELAY = 0.25  # начальная пауза между попытками (удваивается)
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        libc.inotify_init
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class HotplugWatcher(object):
+    """ Наблюдатель за подключением tty устройств
+        :param on_added: обработчик появления порта on_added(port)
+        :param on_removed: обработчик удаления порта on_removed(port)
+        :param prefixes: префиксы имен отслеживаемых устройств
+        :param paths: отслеживаемые каталоги
+    """
+
+    def __init__(self, on_added=None, on_removed=None, prefixes=TTY_PREFIXES,
+                 paths=WATCH_PATHS):
+        self.__on_added = on_added
+        self.__on_removed = on_removed
+        self.__prefixes = tuple(prefixes)
+        self.__paths = paths
+        self.__fd = None
+        self.__stop = Event()
+        self.__thread = None
+        self.__recent = {}
+
+    @property
+    def is_running(self):
+        return self.__thread is not None and self.__thread.is_alive()
+
+    def start(self):
+        """ Запуск наблюдения в фоновом потоке
+            :returns признак успешного запуска
+        """
+        libc = _load_libc()
+        if libc is None or self.is_running:
+            return self.is_running
+
+        fd = libc.inotify_init()
+        if fd < 0:
+            return False
+        watched = 0
+        for path in self.__paths:
+            if os.path.isdir(path) and libc.inotify_add_watch(
+                    fd, path.encode('utf-8'), IN_ADDED | IN_REMOVED) >= 0:
+                watched += 1
+        if not watched:
+            os.close(fd)
+            return False
+
+        self.__fd = fd
+        self.__stop.clear()
+        self.__thread = Thread(target=self.__loop)
+        self.__thread.daemon = True
+        self.__thread.start()
+        return True
+
+    def stop(self):
+        """ Остановка наблюдения """
+        self.__stop.set()
+        if self.__thread is not None:
+            self.__thread.join(1)
+            self.__thread = None
+        if self.__fd is not None:
+            os.close(self.__fd)
+            self.__fd = None
+
+    def __loop(self):
+        while not self.__stop.is_set():
+            try:
+                ready, _, _ = select.select([self.__fd], [], [], 0.5)
+                if not ready:
+                    continue
+                buf = os.read(self.__fd, 4096)
+            except (OSError, select.error) as exc:
+                if exc.args and exc.args[0] == errno.EINTR:
+                    continue
+                return
+            for mask, name in self.parse(buf):
+                self.__dispatch(mask, name)
+
+    @staticmethod
+    def parse(buf):
+        """ Разбор буфера событий inotify
+            :returns список пар (маска события, имя файла)
+        """
+        events, offset = [], 0
+        while offset + EVENT_SIZE <= len(buf):
+            _, mask, _, length = struct.unpack_from(EVENT, buf, offset)
+            offset += EVENT_SIZE
+            name = buf[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if not isinstance(name, str):
+                name = name.decode('utf-8', 'replace')
+            events.append((mask, name))
+        return events
+
+    def __dispatch(self, mask, name):
+        if not name.startswith(self.__prefixes):
+            return
+        port = '/dev/' + name
+        added = bool(mask & IN_ADDED)
+
+        # NOTE: Создание узла порождает несколько событий (создание,
+        #   переименование); повторное событие того же вида в пределах
+        #   DEDUP_TIME пропускается
+        now = monotonic()
+        key = (port, added)
+        if now - self.__recent.get(key, -DEDUP_TIME) < DEDUP_TIME:
+            return
+        self.__recent[key] = now
+
+        handler = self.__on_added if added else self.__on_removed
+        if handler is not None:
+            handler(port)
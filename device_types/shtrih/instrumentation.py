@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+""" LoremCross
+    Модуль работы с фискальными устройствами
+    Интерфейсы печати на ККТ
+    Драйвер под устройства семейства "Штрих"
+    Измерение длительности фаз рабочего цикла
+
+    Инструментирование включается назначением атрибута класса
+        Shtrih.instrumentation = Instrumentation()
+    В выключенном состоянии (None) каждая фаза обходится проверкой
+    на None. Разбивка по фазам прикладывается к результату команды
+    (ключ phases) и передается зарегистрированным обработчикам.
+"""
+from bisect import bisect_left
+from threading import Lock
+
+from .utils import monotonic
+
+# Границы интервалов гистограммы длительностей (в секундах)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    """ Гистограмма длительностей с фиксированными границами интервалов """
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """ Учет значения
+            :param value: длительность (в секундах)
+        """
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def snapshot(self):
+        """ Состояние гистограммы
+            :returns словарь вида {
+                buckets: список пар (граница интервала, накопленное число),
+                sum: сумма значений,
+                count: количество значений}
+        """
+        buckets, cumulative = [], 0
+        for bound, count in zip(self.bounds + (float('inf'), ), self.counts):
+            cumulative += count
+            buckets.append((bound, cumulative))
+        return {'buckets': buckets, 'sum': self.total, 'count': self.count}
+
+
+class PhaseTimer(object):
+    """ Отметки времени фаз одного рабочего цикла.
+        Повторяющиеся фазы (например, ожидание занятого устройства)
+        суммируются.
+    """
+    __slots__ = ('command', 'started', 'last', 'phases')
+
+    def __init__(self, command):
+        self.command = command
+        self.started = self.last = monotonic()
+        self.phases = {}
+
+    def mark(self, phase):
+        """ Завершение фазы
+            :param phase: наименование фазы
+        """
+        now = monotonic()
+        self.phases[phase] = self.phases.get(phase, 0) + now - self.last
+        self.last = now
+
+    def breakdown(self):
+        """ Разбивка по фазам с общим временем (ключ total) """
+        result = dict(self.phases)
+        result['total'] = self.last - self.started
+        return result
+
+
+class Instrumentation(object):
+    """ Регистрация обработчиков длительности фаз
+        Обработчик -- вызываемый объект вида hook(command, breakdown)
+    """
+
+    def __init__(self, *hooks):
+        self.__hooks = list(hooks)
+
+    @property
+    def hooks(self):
+        return tuple(self.__hooks)
+
+    def add_hook(self, hook):
+        self.__hooks.append(hook)
+
+    def remove_hook(self, hook):
+        if hook in self.__hooks:
+            self.__hooks.remove(hook)
+
+    @staticmethod
+    def start(command):
+        """ Начало измерения рабочего цикла
+            :param command: наименование команды
+            :returns объект класса PhaseTimer
+        """
+        return PhaseTimer(command)
+
+    def finish(self, timer):
+        """ Завершение измерения и передача результата обработчикам
+            :param timer: объект класса PhaseTimer
+            :returns словарь вида {фаза: длительность}
+        """
+        breakdown = timer.breakdown()
+        for hook in self.__hooks:
+            hook(timer.command, breakdown)
+        return breakdown
+
+
+class PhaseAggregator(object):
+    """ Обработчик, накапливающий гистограммы длительностей фаз
+        в разрезе команд
+    """
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.__bounds = bounds
+        self.__lock = Lock()
+        self.__data = {}
+
+    def __call__(self, command, breakdown):
+        with self.__lock:
+            phases = self.__data.setdefault(command, {})
+            for phase, duration in breakdown.items():
+                if phase not in phases:
+                    phases[phase] = Histogram(self.__bounds)
+                phases[phase].observe(duration)
+
+    def snapshot(self):
+        """ Состояние гистограмм
+            :returns словарь вида {команда: {фаза: состояние гистограммы}}
+        """
+        with self.__lock:
+            return dict(
+                (command, dict((phase, hist.snapshot())
+                               for phase, hist in phases.items()))
+                for command, phases in self.__data.items())
+
+    def reset(self):
+        with self.__lock:
+            self.__data = {}
@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+""" LoremCross
+    Модуль работы с фискальными устройствами
+    Интерфейсы печати на ККТ
+    Драйвер под устройства семейства "Штрих"
+    Локальный брокер устройства
+
+    Брокер держит единственное подключение к устройству и выполняет
+    команды клиентских процессов, подключенных через Unix сокет.
+    Обмен -- строки JSON; байтовые данные передаются в base64.
+        запрос: {"op": "call", "command": ..., "parameters": ...,
+                 "wait_time": ..., "budget": ...} | {"op": "probe"} |
+                {"op": "info"} | {"op": "start_capture", "file_name": ...} |
+                {"op": "stop_capture"}
+        ответ: {"result": ..., "print_zone": ...,
+                "last_critical_command": ...} | {"exception": ...}
+    budget -- остаток бюджета времени задания клиента (в секундах):
+    в его пределах брокер ожидает освобождения устройства и выполняет
+    команду.
+    Клиент, вошедший в критическую область печати, владеет устройством
+    до ее завершения; при отключении такого клиента чек аннулируется.
+"""
+import base64
+import json
+import os
+import socket
+import time
+from threading import Condition, RLock, Thread, local
+
+from .retry import DEFAULT_POLICIES, Deadline
+from .shtrih_constants import PRN_CRITICAL, PRN_NON_CRITICAL, \
+    TIME_DELTA_STEP, ERR_LOST_DEVICE, ERR_PORT_BUSY, PORT_LOCK_TIMEOUT, \
+    ROLLBACKS
+from .shtrih_exceptions import ShtrihError, ShtrihConnectionError, \
+    ShtrihCommandError
+from .utils import monotonic
+
+EXCEPTIONS = {
+    'ShtrihConnectionError': ShtrihConnectionError,
+    'ShtrihCommandError': ShtrihCommandError,
+}
+
+
+def _encode(result):
+    result = dict(result)
+    result['data'] = base64.b64encode(result.get('data') or b'').decode(
+        'ascii')
+    result.pop('phases', None)
+    return result
+
+
+def _decode(result):
+    result['data'] = base64.b64decode(result.get('data') or '')
+    return result
+
+
+class PortBroker(object):
+    """ Брокер устройства
+        :param device: объект класса Shtrih (открытое подключение)
+        :param path: путь Unix сокета
+        :param timeout: время ожидания освобождения устройства
+            клиентом, находящимся в критической области печати
+    """
+
+    def __init__(self, device, path, timeout=PORT_LOCK_TIMEOUT):
+        self.__device = device
+        self.__path = path
+        self.__timeout = timeout
+        self.__cond = Condition()
+        self.__owner = None
+        self.__socket = None
+        self.__thread = None
+
+    @property
+    def path(self):
+        return self.__path
+
+    def start(self):
+        """ Запуск брокера в фоновом потоке """
+        if os.path.exists(self.__path):
+            os.remove(self.__path)
+        self.__socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.__socket.bind(self.__path)
+        self.__socket.listen(16)
+        self.__thread = Thread(target=self.__accept)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        """ Остановка брокера """
+        if self.__socket is not None:
+            self.__socket.close()
+            self.__socket = None
+        if os.path.exists(self.__path):
+            os.remove(self.__path)
+
+    def __accept(self):
+        while self.__socket is not None:
+            try:
+                conn, _ = self.__socket.accept()
+            except (socket.error, AttributeError):
+                return
+            thread = Thread(target=self.__serve, args=(conn, ))
+            thread.daemon = True
+            thread.start()
+
+    def __serve(self, conn):
+        client = object()
+        stream = conn.makefile('rb')
+        try:
+            for line in stream:
+                reply = self.__handle(client, json.loads(line))
+                conn.sendall(json.dumps(reply).encode('utf-8') + b'\n')
+        except (socket.error, ValueError):
+            pass
+        finally:
+            stream.close()
+            conn.close()
+            self.__release(client)
+
+    def __release(self, client):
+        """ Освобождение устройства отключившимся клиентом """
+        with self.__cond:
+            if self.__owner is not client:
+                return
+            rollback = ROLLBACKS.get(self.__device.last_critical_command)
+            if rollback and self.__device.print_zone == PRN_CRITICAL:
+                try:
+                    self.__device(rollback, '')
+                except ShtrihError:
+                    pass
+            self.__owner = None
+            self.__cond.notify_all()
+
+    def __state(self):
+        device = self.__device
+        return {'print_zone': device.print_zone,
+                'last_critical_command': device.last_critical_command}
+
+    def __handle(self, client, request):
+        device = self.__device
+        op = request.get('op')
+        if op == 'info':
+            reply = {'port': device.port, 'rate': device.rate,
+                     'check_width': device.check_width,
+                     'is_opened': device.is_opened}
+            reply.update(self.__state())
+            return reply
+
+        budget = request.get('budget')
+        budget = None if budget is None else Deadline(budget)
+        with self.__cond:
+            deadline = monotonic() + self.__timeout
+            if budget is not None:
+                deadline = min(deadline, budget.expires)
+            while self.__owner not in (None, client):
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    exc = ShtrihConnectionError(ERR_PORT_BUSY)
+                    return {'exception': exc.serialize()}
+                self.__cond.wait(remaining)
+
+            if op == 'probe':
+                return {'result': device.probe()}
+            if op == 'start_capture':
+                device.start_capture(request['file_name'])
+                return {'result': True}
+            if op == 'stop_capture':
+                device.stop_capture()
+                return {'result': True}
+            try:
+                result = device(
+                    request['command'],
+                    base64.b64decode(request.get('parameters') or ''),
+                    request.get('wait_time'), budget=budget)
+            except ShtrihError as exc:
+                reply = {'exception': exc.serialize()}
+            else:
+                reply = {'result': _encode(result)}
+            reply.update(self.__state())
+
+            self.__owner = client \
+                if device.print_zone == PRN_CRITICAL else None
+            self.__cond.notify_all()
+            return reply
+
+
+class RemoteShtrih(object):
+    """ Подключение к устройству через брокер (PortBroker).
+        Реализует интерфейс класса Shtrih, используемый
+        ShtrihCashRegister при выполнении команд.
+        :param port: путь Unix сокета брокера
+        :param rate: не используется (скорость задается брокером)
+    """
+
+    instrumentation = None
+    retry_policies = DEFAULT_POLICIES
+
+    def __init__(self, port, rate=None, **_):
+        self.__path = port
+        self.__rate = rate
+        self.__check_width = 38
+        self.__socket = None
+        self.__stream = None
+        self.__lock = RLock()
+        self.__local = local()
+        self.__print_zone = PRN_NON_CRITICAL
+        self.__last_critical_command = ''
+
+    @property
+    def lock(self):
+        return self.__lock
+
+    @property
+    def port(self):
+        return self.__path
+
+    @property
+    def rate(self):
+        return self.__rate
+
+    @property
+    def check_width(self):
+        return self.__check_width
+
+    @property
+    def time_delta_step(self):
+        return TIME_DELTA_STEP
+
+    @property
+    def is_opened(self):
+        return self.__socket is not None
+
+    @property
+    def print_zone(self):
+        return self.__print_zone
+
+    @property
+    def last_critical_command(self):
+        return self.__last_critical_command
+
+    def __connect(self):
+        if self.__socket is not None:
+            return
+        if not self.__path:
+            raise ShtrihConnectionError(ERR_LOST_DEVICE)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.__path)
+        except socket.error:
+            sock.close()
+            raise ShtrihConnectionError(ERR_LOST_DEVICE)
+        self.__socket, self.__stream = sock, sock.makefile('rb')
+
+    def __request(self, **request):
+        """ Запрос к брокеру
+            :returns ответ брокера (словарь)
+        """
+        with self.__lock:
+            self.__connect()
+            try:
+                self.__socket.sendall(
+                    json.dumps(request).encode('utf-8') + b'\n')
+                line = self.__stream.readline()
+            except socket.error:
+                line = None
+            if not line:
+                self.close()
+                raise ShtrihConnectionError(ERR_LOST_DEVICE)
+            reply = json.loads(line)
+
+        if 'print_zone' in reply:
+            self.__print_zone = reply['print_zone']
+            self.__last_critical_command = reply['last_critical_command']
+        if 'exception' in reply:
+            exception = reply['exception']
+            error_class = EXCEPTIONS.get(exception['error'], ShtrihError)
+            raise error_class(exception['code'], *exception['args'])
+        return reply
+
+    def info(self):
+        """ Параметры подключения брокера к устройству """
+        reply = self.__request(op='info')
+        self.__rate = reply['rate']
+        self.__check_width = reply['check_width']
+        return reply
+
+    def __call__(self, command, parameters, wait_time=None, timer=None,
+                 budget=None, frame=None):
+        """ Выполнение команды брокером
+            :param budget: бюджет времени (объект класса Deadline);
+                брокеру передается его остаток
+            :param frame: не используется (кадр формирует брокер)
+            :returns словарь результата (см. Shtrih.result)
+        """
+        self.__local.result = {}
+        reply = self.__request(
+            op='call', command=command, wait_time=wait_time,
+            budget=budget.remaining() if budget is not None else None,
+            parameters=base64.b64encode(parameters or b'').decode('ascii'))
+        result = _decode(reply['result'])
+        self.__local.result = result
+        return result
+
+    def batch(self, command, parameter_list, wait_time=None, budget=None,
+              pace=0):
+        """ Выполнение серии команд через брокер (по одной команде);
+            серия прерывается на первой ошибке
+            :returns кортеж (список результатов, ошибка связи или None)
+        """
+        results = []
+        with self.__lock:
+            for index, parameters in enumerate(parameter_list):
+                if index and pace > 0:
+                    time.sleep(pace)
+                try:
+                    result = self(command, parameters, wait_time,
+                                  budget=budget)
+                except ShtrihError as exc:
+                    return results, exc.serialize()
+                results.append(result)
+                if result['error']:
+                    break
+        return results, None
+
+    def start_capture(self, file_name):
+        """ Запись обмена с устройством в процессе брокера
+            :param file_name: имя файла записи (на стороне брокера)
+        """
+        self.__request(op='start_capture', file_name=file_name)
+
+    def stop_capture(self):
+        """ Завершение записи обмена в процессе брокера """
+        self.__request(op='stop_capture')
+
+    @property
+    def completion_durations(self):
+        """ Длительность движения бумаги изучает процесс брокера """
+        return {}
+
+    def hold_port(self):
+        """ Владение портом обеспечивает брокер (см. Shtrih.hold_port) """
+
+    def release_port(self):
+        """ Владение портом обеспечивает брокер (см. Shtrih.release_port) """
+
+    @property
+    def result(self):
+        res = getattr(self.__local, 'result', None) or {}
+        self.__local.result = {}
+        return res
+
+    def probe(self):
+        try:
+            return bool(self.__request(op='probe')['result'])
+        except ShtrihError:
+            return False
+
+    def rebind(self, port, rate):
+        """ Подключение к брокеру (скорость задается брокером) """
+        if port != self.__path:
+            self.close()
+            self.__path = port
+        self.info()
+
+    def find_device(self, port_group=None, rate=None):
+        self.info()
+        return self.port, self.rate
+
+    def close(self):
+        with self.__lock:
+            if self.__socket is not None:
+                self.__stream.close()
+                self.__socket.close()
+            self.__socket, self.__stream = None, None
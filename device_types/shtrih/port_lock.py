@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+""" LoremCross
+    Модуль работы с фискальными устройствами
+    Интерфейсы печати на ККТ
+    Драйвер под устройства семейства "Штрих"
+    Монопольный доступ к порту из нескольких процессов
+
+    Владение портом определяется рекомендательной блокировкой (flock)
+    файла блокировки. Претенденты выстраиваются в очередь по номерам
+    (файлы в каталоге очереди), блокировку пытается взять только первый
+    в очереди; записи завершившихся процессов удаляются. Блокировка
+    процесса, завершившегося аварийно, снимается операционной системой.
+    На платформах без fcntl блокировка не выполняется.
+"""
+import errno
+import os
+import tempfile
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from .shtrih_constants import ERR_PORT_BUSY, PORT_LOCK_TIMEOUT, \
+    PORT_LOCK_POLL
+from .shtrih_exceptions import ShtrihConnectionError
+from .utils import monotonic
+
+LOCK_PREFIX = 'lc_cashcontrol.'
+
+
+def _pid_alive(pid):
+    """ Признак существования процесса """
+    try:
+        os.kill(pid, 0)
+    except OSError as exc:
+        return exc.errno != errno.ESRCH
+    return True
+
+
+class PortLock(object):
+    """ Блокировка порта между процессами с очередью претендентов
+        :param port: порт
+        :param timeout: время ожидания блокировки
+        :param lock_dir: каталог файлов блокировки
+    """
+
+    def __init__(self, port, timeout=PORT_LOCK_TIMEOUT, lock_dir=None):
+        name = LOCK_PREFIX + os.path.basename(port or 'default')
+        lock_dir = lock_dir or tempfile.gettempdir()
+        self.port = port
+        self.timeout = timeout
+        self.path = os.path.join(lock_dir, name + '.lock')
+        self.__queue = os.path.join(lock_dir, name + '.queue')
+        self.__counter = os.path.join(lock_dir, name + '.ticket')
+        self.__fd = None
+
+    @property
+    def held(self):
+        """ Признак владения портом """
+        return self.__fd is not None
+
+    def owner(self):
+        """ Идентификатор процесса-владельца порта (или None) """
+        try:
+            with open(self.path) as handle:
+                return int(handle.read().strip() or 0) or None
+        except (IOError, OSError, ValueError):
+            return None
+
+    def __take_ticket(self):
+        """ Получение номера в очереди """
+        if not os.path.isdir(self.__queue):
+            try:
+                os.makedirs(self.__queue)
+            except OSError as exc:
+                if exc.errno != errno.EEXIST:
+                    raise
+        fd = os.open(self.__counter, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            ticket = int(os.read(fd, 32).strip() or 0) + 1
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, str(ticket).encode('ascii'))
+        finally:
+            os.close(fd)
+        entry = os.path.join(self.__queue, '%020d.%d' % (ticket, os.getpid()))
+        open(entry, 'w').close()
+        return entry
+
+    def __is_first(self, entry):
+        """ Проверка очереди с удалением записей завершившихся процессов """
+        waiting = []
+        for name in os.listdir(self.__queue):
+            ticket, _, pid = name.partition('.')
+            if not (ticket.isdigit() and pid.isdigit()):
+                continue
+            if not _pid_alive(int(pid)):
+                try:
+                    os.remove(os.path.join(self.__queue, name))
+                except OSError:
+                    pass
+                continue
+            waiting.append(name)
+        return not waiting or min(waiting) == os.path.basename(entry)
+
+    def __try_lock(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode('ascii'))
+        self.__fd = fd
+        return True
+
+    def acquire(self, timeout=None):
+        """ Захват порта в порядке очереди.
+            Повторный захват владельцем не выполняет действий.
+            :param timeout: время ожидания (по умолчанию -- self.timeout)
+        """
+        if fcntl is None or self.__fd is not None:
+            return True
+        timeout = self.timeout if timeout is None else timeout
+        deadline = None if timeout is None else monotonic() + timeout
+
+        entry = self.__take_ticket()
+        try:
+            while not (self.__is_first(entry) and self.__try_lock()):
+                if deadline is not None and monotonic() >= deadline:
+                    raise ShtrihConnectionError(ERR_PORT_BUSY)
+                time.sleep(PORT_LOCK_POLL)
+        finally:
+            try:
+                os.remove(entry)
+            except OSError:
+                pass
+        return True
+
+    def release(self):
+        """ Освобождение порта """
+        fd, self.__fd = self.__fd, None
+        if fd is not None:
+            os.ftruncate(fd, 0)
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *_):
+        self.release()
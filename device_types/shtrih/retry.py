@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+""" LoremCross
+    Модуль работы с фискальными устройствами
+    Интерфейсы печати на ККТ
+    Драйвер под устройства семейства "Штрих"
+    Политики повторов и бюджет времени выполнения
+
+    Повторы выполняются на нескольких уровнях:
+        write -- повтор отправки кадра при отсутствии подтверждения (ACK),
+        read -- ожидание ответа устройства,
+        action -- повтор команды при занятости устройства,
+        command -- повтор команды по реакции пользователя.
+    Политика задается для пары (уровень, класс команды),
+    бюджет времени -- для класса команды.
+"""
+import random
+import time
+
+from .shtrih_constants import MAX_TRIES, TIME_DELTA_STEP, COMMAND_CLASSES, \
+    CMD_SERVICE, COMMAND_BUDGETS
+from .utils import monotonic
+
+LAYER_WRITE = 'write'
+LAYER_READ = 'read'
+LAYER_ACTION = 'action'
+LAYER_COMMAND = 'command'
+
+
+class Deadline(object):
+    """ Срок выполнения (бюджет времени) """
+
+    def __init__(self, seconds=None):
+        """ :param seconds: бюджет времени; None -- без ограничения """
+        self.expires = None if seconds is None else monotonic() + seconds
+
+    @classmethod
+    def earliest(cls, *deadlines):
+        """ Ближайший из сроков (None -- без ограничения) """
+        limited = [d for d in deadlines if d is not None and
+                   d.expires is not None]
+        if not limited:
+            return None
+        return min(limited, key=lambda d: d.expires)
+
+    def remaining(self):
+        """ Остаток времени или None, если срок не ограничен """
+        if self.expires is None:
+            return None
+        return max(0.0, self.expires - monotonic())
+
+    @property
+    def expired(self):
+        return self.expires is not None and monotonic() >= self.expires
+
+
+class RetryPolicy(object):
+    """ Повторы с постоянной паузой
+        :param tries: наибольшее число попыток
+        :param delay: пауза между попытками
+        :param max_time: ограничение общего времени повторов
+    """
+
+    def __init__(self, tries=MAX_TRIES, delay=TIME_DELTA_STEP, max_time=None):
+        self.tries = tries
+        self.base_delay = delay
+        self.max_time = max_time
+
+    def delay(self, attempt):
+        """ Пауза перед попыткой
+            :param attempt: номер попытки (начиная с 1 для первого повтора)
+        """
+        return self.base_delay
+
+    def attempts(self, budget=None):
+        """ Генератор номеров попыток.
+            Перед каждым повтором выдерживается пауза; повторы прекращаются
+            по исчерпании числа попыток, ограничения времени политики
+            или бюджета задания (если пауза не укладывается в остаток).
+            :param budget: объект класса Deadline
+        """
+        deadline = Deadline.earliest(Deadline(self.max_time), budget)
+        for attempt in range(self.tries):
+            if attempt:
+                pause = self.delay(attempt)
+                if deadline is not None and deadline.remaining() <= pause:
+                    return
+                if pause > 0:
+                    time.sleep(pause)
+            yield attempt
+
+
+class ExponentialPolicy(RetryPolicy):
+    """ Повторы с экспоненциальным ростом паузы
+        :param factor: множитель паузы
+        :param max_delay: наибольшая пауза
+    """
+
+    def __init__(self, tries=MAX_TRIES, delay=TIME_DELTA_STEP, factor=2.0,
+                 max_delay=1.0, max_time=None):
+        super(ExponentialPolicy, self).__init__(tries, delay, max_time)
+        self.factor = factor
+        self.max_delay = max_delay
+
+    def delay(self, attempt):
+        return min(self.max_delay,
+                   self.base_delay * self.factor ** (attempt - 1))
+
+
+class JitteredPolicy(ExponentialPolicy):
+    """ Экспоненциальные повторы со случайной паузой (full jitter):
+        исключает одновременные повторы нескольких клиентов
+    """
+
+    def delay(self, attempt):
+        return random.uniform(
+            0, super(JitteredPolicy, self).delay(attempt))
+
+
+class RetryPolicies(object):
+    """ Реестр политик повторов и бюджетов времени по классам команд """
+
+    def __init__(self, budgets=None):
+        self.__policies = {
+            (LAYER_WRITE, None): RetryPolicy(MAX_TRIES, 0),
+            (LAYER_READ, None): RetryPolicy(MAX_TRIES, TIME_DELTA_STEP),
+            (LAYER_ACTION, None): RetryPolicy(MAX_TRIES, 0),
+            (LAYER_COMMAND, None): RetryPolicy(10, 0),
+        }
+        self.__budgets = dict(COMMAND_BUDGETS if budgets is None else budgets)
+
+    @staticmethod
+    def command_class(command):
+        """ Класс команды (status, fiscal, paper, report, service) """
+        return COMMAND_CLASSES.get(command, CMD_SERVICE)
+
+    def set_policy(self, layer, policy, command_class=None):
+        """ Назначение политики
+            :param layer: уровень повторов (write, read, action, command)
+            :param policy: объект класса RetryPolicy
+            :param command_class: класс команды; None -- для всех классов
+        """
+        self.__policies[(layer, command_class)] = policy
+
+    def set_budget(self, command_class, seconds):
+        """ Назначение бюджета времени выполнения команды
+            :param command_class: класс команды
+            :param seconds: бюджет в секундах; None -- без ограничения
+        """
+        self.__budgets[command_class] = seconds
+
+    def get(self, layer, command):
+        """ Политика повторов для команды на заданном уровне """
+        key = (layer, self.command_class(command))
+        return self.__policies.get(key) or self.__policies[(layer, None)]
+
+    def budget(self, command):
+        """ Бюджет времени выполнения команды
+            :returns объект класса Deadline
+        """
+        return Deadline(self.__budgets.get(self.command_class(command)))
+
+
+DEFAULT_POLICIES = RetryPolicies()
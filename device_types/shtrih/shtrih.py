@@ -3,19 +3,35 @@
     Модуль работы с фискальными устройствами
     Интерфейсы печати на ККТ для устройств семейства Штрих: ФРК, ФРФ, М
     Драйвер
+
+    Многопоточность: каждый обмен с устройством (а также смена порта,
+    скорости и транспорта) выполняется под реентерабельной блокировкой
+    устройства (Shtrih.lock). Результат обмена возвращается вызовом
+    объекта; свойство result сохранено для совместимости и хранит
+    результат последней команды текущего потока. Последовательность
+    обменов, которая должна выполняться без вмешательства других потоков,
+    выполняется под той же блокировкой (with device.lock).
 """
 import time
 import serial
 import glob
 import sys
+from contextlib import contextmanager
+from threading import RLock, local
 
-from .utils import get_crc
+from .capture import CaptureWriter, RecordingTransport
+from .port_lock import PortLock
+from .utils import get_crc, monotonic
 from .shtrih_constants import PASSWORD, ENQ, ACK, NAK, STX, ST_NO_SIGNAL, \
-    ST_READY, COMMANDS, TIME_DELTA_STEP, MAX_TRIES, DEF_TIMEOUT, RATES, \
+    ST_READY, COMMANDS, TIME_DELTA_STEP, DEF_TIMEOUT, RATES, \
     ST_READ, ST_RETRY, TIME_DELTA_ERRORS, CRITICAL_COMMANDS, \
     POST_CRITICAL_COMMANDS, PRN_NON_CRITICAL, PRN_CRITICAL, PRN_POST_CRITICAL, \
     ERR_OPENING_PORT, ERR_LOST_DEVICE, ERR_UNKNOWN_COMMAND, NO_NEED_PASSWORD, \
-    FINAL_TIME
+    FINAL_TIME, MIN_BYTE_TIMEOUT, BYTE_TIMEOUT_FACTOR, BITS_PER_BYTE, \
+    PRINTING_SUBMODES, COMPLETION_POLL, COMPLETION_MAX, COMPLETION_LEAD, \
+    COMPLETION_FAILURES, SUBMODE_UNSUPPORTED, \
+    COMPLETION_ALPHA, ROLLBACKS, PORT_LOCK_TIMEOUT, ERR_DATA_LENGTH
+from .retry import DEFAULT_POLICIES, LAYER_WRITE, LAYER_READ, Deadline
 from .shtrih_exceptions import ShtrihConnectionError, ShtrihCommandError, \
     ShtrihError
 
@@ -77,6 +93,10 @@ class Shtrih(object):
   `--------------------------------------'
     """
 
+    instrumentation = None  # объект класса Instrumentation (измерение фаз)
+    retry_policies = DEFAULT_POLICIES   # политики повторов (RetryPolicies)
+    completion_polling = True   # ожидание печати по подрежиму устройства
+
     def __init__(self, port, rate, password=PASSWORD,
                  read_timeout=DEF_TIMEOUT, write_timeout=DEF_TIMEOUT):
         """ Открытие последовательного порта
@@ -92,7 +112,11 @@ class Shtrih(object):
                 port = port.encode('utf-8')
             else:
                 port = str(port)
-        self.__result = {}  # шаблон ответа
+        self.__lock = RLock()   # блокировка обмена с устройством
+        self.__local = local()  # результат последней команды потока
+        self.__port_lock = None     # блокировка порта между процессами
+        self.__lock_options = None  # параметры блокировки порта
+        self.__hold = 0     # вложенность монопольного владения портом
         self.__port = port
         self.__rate = rate
         self.__tm_read = read_timeout
@@ -100,6 +124,10 @@ class Shtrih(object):
         self.__password = password
         self.__srl = None
         self.__is_opened = False
+        self.__capture = None   # запись обмена (CaptureWriter)
+        self.__durations = {}   # изученная длительность движения бумаги
+        self.__submode_polling = self.completion_polling
+        self.__submode_failures = 0     # неудачные опросы подрежима подряд
         # открытие порта
         if self.__port and self.__rate:
             self.__open_port()
@@ -116,13 +144,14 @@ class Shtrih(object):
         """ Открытие порта """
         if not (self.__port and self.__rate):
             return
+        self.__bind_port_lock()
         try:
             self.__srl = serial.Serial(
                 self.port,
                 self.rate,
                 parity=serial.PARITY_NONE,
                 stopbits=serial.STOPBITS_ONE,
-                timeout=self.__tm_read,
+                timeout=self.byte_timeout,
                 writeTimeout=self.__tm_write
             )
         except Exception:
@@ -130,14 +159,129 @@ class Shtrih(object):
 
         if not self.__srl.isOpen():
             raise ShtrihConnectionError(ERR_LOST_DEVICE)
+        if self.__capture is not None:
+            self.__srl = RecordingTransport(self.__srl, self.__capture)
         self.__is_opened = True
 
     def __close_port(self):
         """ Закрытие порта """
+        if self.__port_lock is not None:
+            self.__port_lock.release()
         if self.__srl:
             self.__srl.close()
         self.__is_opened = False
 
+    def enable_port_lock(self, timeout=PORT_LOCK_TIMEOUT, lock_dir=None):
+        """ Включение монопольного доступа к порту между процессами.
+            Порт захватывается на время каждого обмена, а в критической
+            области печати -- до ее завершения (чек не прерывается
+            командами других процессов).
+            :param timeout: время ожидания освобождения порта
+            :param lock_dir: каталог файлов блокировки
+        """
+        with self.__lock:
+            self.__lock_options = (timeout, lock_dir)
+            self.__bind_port_lock()
+
+    def disable_port_lock(self):
+        """ Отключение монопольного доступа к порту """
+        with self.__lock:
+            if self.__port_lock is not None:
+                self.__port_lock.release()
+            self.__port_lock, self.__lock_options = None, None
+
+    def __bind_port_lock(self):
+        """ Привязка блокировки к текущему порту """
+        if self.__lock_options is None or not self.__port:
+            return
+        if self.__port_lock is not None:
+            if self.__port_lock.port == self.__port:
+                return
+            self.__port_lock.release()
+        timeout, lock_dir = self.__lock_options
+        self.__port_lock = PortLock(self.__port, timeout, lock_dir)
+
+    @contextmanager
+    def __owned(self):
+        """ Владение портом на время обмена """
+        port_lock = self.__port_lock
+        if port_lock is not None:
+            port_lock.acquire()
+        try:
+            yield
+        finally:
+            if port_lock is not None and not self.__hold and \
+                    self.__print_zone != PRN_CRITICAL:
+                port_lock.release()
+
+    @contextmanager
+    def exclusive(self):
+        """ Монопольное владение устройством на время блока
+            (блокировка потоков и, при включенной блокировке порта,
+            процессов)
+        """
+        with self.__lock:
+            with self.__owned():
+                self.__hold += 1
+                try:
+                    yield self
+                finally:
+                    self.__hold -= 1
+
+    def hold_port(self):
+        """ Владение портом до release_port (например, на время задания):
+            порт захватывается при первом обмене и не освобождается
+            после каждой команды (без повторной очереди претендентов)
+        """
+        with self.__lock:
+            self.__hold += 1
+
+    def release_port(self):
+        """ Завершение владения портом (см. hold_port); в критической
+            области печати порт остается захваченным до ее завершения
+        """
+        with self.__lock:
+            self.__hold = max(self.__hold - 1, 0)
+            if self.__port_lock is not None and not self.__hold and \
+                    self.__print_zone != PRN_CRITICAL:
+                self.__port_lock.release()
+
+    def attach_transport(self, transport):
+        """ Подключение к устройству через готовый транспорт
+            (например, ReplayTransport для воспроизведения сеанса)
+            :param transport: объект с интерфейсом serial.Serial
+        """
+        with self.__lock:
+            self.__close_port()
+            self.__srl = transport
+            if self.__capture is not None:
+                self.__srl = RecordingTransport(self.__srl, self.__capture)
+            self.__is_opened = True
+
+    def start_capture(self, file_name):
+        """ Начало записи обмена с устройством
+            :param file_name: имя файла записи
+        """
+        with self.__lock:
+            self.stop_capture()
+            self.__capture = CaptureWriter(file_name)
+            if self.__srl is not None:
+                self.__srl = RecordingTransport(self.__srl, self.__capture)
+
+    def stop_capture(self):
+        """ Завершение записи обмена с устройством """
+        with self.__lock:
+            if isinstance(self.__srl, RecordingTransport):
+                self.__srl = self.__srl.transport
+            if self.__capture is not None:
+                self.__capture.close()
+                self.__capture = None
+
+    @property
+    def lock(self):
+        """ Блокировка обмена с устройством (threading.RLock) """
+        return self.__lock
+
     @property
     def check_width(self):
         """ Ширина чека. Зависит от модели ККТ """
@@ -148,6 +292,26 @@ class Shtrih(object):
         """ Минимальный шаг по времени выполнения """
         return TIME_DELTA_STEP
 
+    @property
+    def byte_timeout(self):
+        """ Межбайтовый таймаут: время передачи нескольких байт
+            на текущей скорости, но не менее MIN_BYTE_TIMEOUT.
+            Используется как таймаут порта; сроки ожидания ответа
+            задаются для каждого обмена отдельно.
+        """
+        if not self.__rate:
+            return MIN_BYTE_TIMEOUT
+        return max(MIN_BYTE_TIMEOUT,
+                   BYTE_TIMEOUT_FACTOR * BITS_PER_BYTE / float(self.__rate))
+
+    def frame_time(self, length):
+        """ Время передачи кадра заданной длины на текущей скорости
+            :param length: длина кадра в байтах
+        """
+        if not self.__rate:
+            return 0
+        return length * BITS_PER_BYTE / float(self.__rate)
+
     @property
     def is_opened(self):
         """ Признак открытого порта """
@@ -160,9 +324,12 @@ class Shtrih(object):
 
     @port.setter
     def port(self, value):
-        self.__close_port()
-        self.__port = value
-        self.__open_port()
+        with self.__lock:
+            if value == self.__port and self.__is_opened:
+                return
+            self.__close_port()
+            self.__port = value
+            self.__open_port()
 
     @property
     def rate(self):
@@ -171,9 +338,37 @@ class Shtrih(object):
 
     @rate.setter
     def rate(self, value):
-        self.__close_port()
-        self.__rate = value
-        self.__open_port()
+        with self.__lock:
+            if value == self.__rate and self.__is_opened:
+                return
+            self.__rate = value
+            if self.__is_opened:
+                # Перенастройка открытого порта без переоткрытия
+                try:
+                    self.__srl.baudrate = value
+                    self.__srl.timeout = self.byte_timeout
+                except Exception:
+                    self.__close_port()
+                else:
+                    return
+            self.__open_port()
+
+    def rebind(self, port, rate):
+        """ Перенастройка подключения с единственным открытием порта.
+            Для открытого порта смена скорости выполняется без
+            переоткрытия.
+            :param port: порт
+            :param rate: скорость работы (в бодах)
+        """
+        with self.__lock:
+            if port is not None and not isinstance(port, str):
+                port = port.encode('utf-8')
+            if port == self.__port and self.__is_opened:
+                self.rate = rate
+                return
+            self.__close_port()
+            self.__port, self.__rate = port, rate
+            self.__open_port()
 
     @property
     def print_zone(self):
@@ -186,23 +381,77 @@ class Shtrih(object):
             :param rate: скорость обмена данными
             :returns номер порта, скорость обмена данными
         """
-        if sys.platform.startswith('win'):
-            ports = ['COM%s' % (i + 1) for i in range(256)]
-        else:
-            ports = glob.glob('/dev/tty[A-Za-z]*')
-            if port_group:
-                ports = [p for p in ports if port_group in p]
-        rates = [rate, ] if rate in RATES else RATES
-        for port in ports:
+        with self.__lock:
+            if sys.platform.startswith('win'):
+                ports = ['COM%s' % (i + 1) for i in range(256)]
+            else:
+                ports = glob.glob('/dev/tty[A-Za-z]*')
+                if port_group:
+                    ports = [p for p in ports if port_group in p]
+            rates = [rate, ] if rate in RATES else RATES
+            for port in ports:
+                if self.__probe_port(port, rates):
+                    return self.port, self.rate
+            raise ShtrihConnectionError(ERR_LOST_DEVICE)
+
+    def probe_port(self, port, rates=None):
+        """ Поиск устройства на одном порту.
+            Порт открывается однократно, скорости перебираются
+            перенастройкой открытого порта. Если устройство на порту
+            не отвечает, восстанавливается прежнее подключение (порт
+            и скорость).
+            :param port: порт
+            :param rates: список проверяемых скоростей
+            :returns скорость обмена или None, если устройство не отвечает
+        """
+        with self.__lock:
+            previous = self.__port, self.__rate
+            rate = self.__probe_port(port, rates or RATES)
+            if rate is None:
+                try:
+                    self.rebind(*previous)
+                except ShtrihConnectionError:
+                    self.__close_port()
+            return rate
+
+    def __probe_port(self, port, rates):
+        """ Перебор скоростей на порту (без восстановления подключения)
+            :returns скорость обмена или None
+        """
+        try:
+            self.rebind(port, self.__rate or rates[0])
+        except ShtrihConnectionError:
+            return None
+        for rate in rates:
             try:
-                self.port = port
-            except:
-                continue
-            for rate in rates:
                 self.rate = rate
-                if self.__check_state() != ST_NO_SIGNAL:
-                    return self.port, self.rate
-        raise ShtrihConnectionError(ERR_LOST_DEVICE)
+            except ShtrihConnectionError:
+                return None
+            try:
+                with self.__owned():
+                    if self.__check_state() != ST_NO_SIGNAL:
+                        return rate
+            except ShtrihConnectionError:
+                return None
+        return None
+
+    def probe(self):
+        """ Проверка связи с устройством запросом ENQ
+            (без выполнения команды)
+        """
+        with self.__lock:
+            if not self.__is_opened:
+                return False
+            try:
+                with self.__owned():
+                    return self.__check_state() != ST_NO_SIGNAL
+            except ShtrihConnectionError:
+                return False
+
+    def close(self):
+        """ Закрытие порта """
+        with self.__lock:
+            self.__close_port()
 
     def __check_state(self):
         """ Проверка готовности аппарата """
@@ -211,7 +460,7 @@ class Shtrih(object):
         try:
             self.__srl.flush()
             self.__srl.write(ENQ)
-            reply = self.__srl.read(1)
+            reply = self.__wait_byte(monotonic() + self.__tm_read)
         except:
             pass
         else:
@@ -222,43 +471,102 @@ class Shtrih(object):
                     answer = ST_READ
         return answer
 
-    def __write(self, command, parameters, wait_time=None):
-        """ Отправка данных на устройство с учетом времени ожидания записи
-            :param command: код команды на исполнение
-            :param parameters: строка с аргументами
+    def __wait_byte(self, deadline):
+        """ Ожидание очередного байта до истечения срока.
+            Таймаут порта равен межбайтовому интервалу, поэтому ожидание
+            завершается сразу после поступления байта.
+            :param deadline: срок ожидания (по часам monotonic)
+            :returns прочитанный байт или пустая строка
+        """
+        while True:
+            byte = self.__srl.read(1)
+            if byte or monotonic() >= deadline:
+                return byte
+
+    def __read_exact(self, size):
+        """ Чтение заданного числа байт с межбайтовым таймаутом:
+            чтение прекращается, если очередной байт не поступил
+            в течение межбайтового интервала
+            :param size: количество байт
+        """
+        data = ''
+        while len(data) < size:
+            chunk = self.__srl.read(size - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    @property
+    def frame_key(self):
+        """ Признаки устройства, от которых зависит кадр команды """
+        return type(self).__name__, self.__password
+
+    def build_frame(self, command, parameters):
+        """ Формирование кадра команды
+            :param command: команда
+            :param parameters: строка с параметрами
+            :returns кадр для отправки на устройство
         """
-        password = '' if command in NO_NEED_PASSWORD else self.__password
-        data = chr(command) + password + parameters
+        if command not in COMMANDS:
+            raise ShtrihCommandError(ERR_UNKNOWN_COMMAND)
+        code = COMMANDS[command][0]
+        password = '' if code in NO_NEED_PASSWORD else self.__password
+        data = chr(code) + password + (parameters or '')
+        if len(data) > 0xFF:
+            raise ShtrihCommandError(ERR_DATA_LENGTH)
         content = chr(len(data)) + data
-        crc = get_crc(content)
-
-        for _ in range(MAX_TRIES):
-            self.__srl.write(STX + content + crc)
-            if wait_time is not None:
-                self.__tm_read = wait_time
-                self.__srl.timeout = wait_time
-            reply = self.__srl.read(1)
+        return STX + content + get_crc(content)
+
+    def __write(self, frame, policy, budget=None, timer=None):
+        """ Отправка кадра на устройство с ожиданием подтверждения.
+            Срок ожидания подтверждения складывается из времени передачи
+            кадра и времени ожидания чтения по умолчанию.
+            :param frame: кадр команды (см. build_frame)
+            :param policy: политика повторов отправки
+            :param budget: бюджет времени (объект класса Deadline)
+            :param timer: объект класса PhaseTimer (при измерении фаз)
+        """
+        ack_time = self.frame_time(len(frame)) + self.__tm_read
+
+        for _ in policy.attempts(budget):
+            self.__srl.write(frame)
+            if timer:
+                timer.mark('write')
+            reply = self.__wait_byte(monotonic() + ack_time)
+            if timer:
+                timer.mark('ack')
             if reply == ACK:
                 return ST_READY
 
         return ST_NO_SIGNAL
 
-    def __read(self):
+    def __read(self, deadline=None, timer=None):
         """ Чтение данных с устройства
             с проверкой длины ответа и контрольной суммы
+            :param deadline: срок ожидания начала ответа (по часам monotonic);
+                по умолчанию -- время ожидания чтения
+            :param timer: объект класса PhaseTimer (при измерении фаз)
         """
-        bit = self.__srl.read(1)
+        if deadline is None:
+            deadline = monotonic() + self.__tm_read
+        bit = self.__wait_byte(deadline)
         if bit != STX:
             return ST_RETRY, 0, None
 
-        length = ord(self.__srl.read(1))
+        length = self.__read_exact(1)
+        if not length:
+            return ST_RETRY, 0, None
+        length = ord(length)
         ctrl_len = length - 2
-        command = self.__srl.read(1)
-        err_code = self.__srl.read(1)
-        data = self.__srl.read(ctrl_len)
-
-        crc_dev = self.__srl.read(1)
+        frame = self.__read_exact(length + 1)
+        command, err_code = frame[0:1], frame[1:2] or '\x00'
+        data, crc_dev = frame[2:2 + ctrl_len], frame[2 + ctrl_len:]
+        if timer:
+            timer.mark('read')
         crc_data = get_crc(chr(length) + command + err_code + data)
+        if timer:
+            timer.mark('crc')
         if crc_dev != crc_data:
             self.__srl.write(NAK)
             return ST_RETRY, ord(err_code), None
@@ -267,49 +575,141 @@ class Shtrih(object):
         self.__srl.read(1)
         return ST_READY, ord(err_code), data
 
-    def __call__(self, command, parameters, wait_time=None):
+    def __call__(self, command, parameters, wait_time=None, timer=None,
+                 budget=None, frame=None):
         """ Один рабочий цикл
             (проверка состояния, отправка команды, получение и анализ ответа)
             :param command: команда
             :param parameters: строка с параметрами
             :param wait_time: время ожидания отклика
+            :param timer: объект класса PhaseTimer внешнего измерения;
+                если не передан, при включенном инструментировании
+                разбивка по фазам помещается в результат (ключ phases)
+            :param budget: бюджет времени (объект класса Deadline);
+                по умолчанию -- бюджет класса команды
+            :param frame: готовый кадр команды (см. build_frame);
+                parameters при этом не используются
+            :returns словарь результата (см. result)
         """
         if command not in COMMANDS:
             raise ShtrihCommandError(ERR_UNKNOWN_COMMAND)
 
+        self.__local.result = {}
+        with self.__lock:
+            with self.__owned():
+                result = self.__exchange(
+                    command, parameters, wait_time, timer, budget, frame)
+        self.__local.result = result
+        return result
+
+    def batch(self, command, parameter_list, wait_time=None, budget=None,
+              pace=0):
+        """ Выполнение серии однотипных команд подряд.
+            Кадры всех команд формируются до начала обмена. Между кадрами
+            серии состояние устройства не запрашивается (ENQ): ответ на
+            предыдущую команду уже получен и подтвержден. Серия
+            прерывается на первой ошибке.
+            :param command: команда
+            :param parameter_list: список строк с параметрами
+            :param wait_time: время ожидания отклика на каждую команду
+            :param budget: бюджет времени серии (объект класса Deadline)
+            :param pace: пауза перед каждым следующим кадром (согласование
+                с темпом печати устройства)
+            :returns кортеж (список результатов выполненных команд,
+                ошибка связи или None)
+        """
+        frames = [self.build_frame(command, parameters)
+                  for parameters in parameter_list]
+        results, exception = [], None
+
+        self.__local.result = {}
+        with self.__lock:
+            with self.__owned():
+                for index, frame in enumerate(frames):
+                    if index and pace > 0:
+                        time.sleep(pace)
+                    try:
+                        result = self.__exchange(
+                            command, None, wait_time, None,
+                            Deadline.earliest(
+                                budget, self.retry_policies.budget(command)),
+                            frame, probe=not index)
+                    except ShtrihError as exc:
+                        exception = exc.serialize()
+                        break
+                    results.append(result)
+                    if result['error']:
+                        break
+        self.__local.result = results[-1] if results else {}
+        return results, exception
+
+    def __exchange(self, command, parameters, wait_time, timer, budget,
+                   frame=None, probe=True):
+        """ Рабочий цикл под блокировкой устройства
+            :param frame: готовый кадр команды (по умолчанию формируется
+                из parameters)
+            :param probe: запрос состояния перед отправкой (ENQ)
+            :returns словарь результата (см. result)
+        """
         code, command_description = COMMANDS[command]
-        self.__result.update(
-            {'code': code, 'command': command_description, 'error': None,
-             'data': '', 'delta': 0, 'last_cmd_delta': 0}
-        )
+        result = {'code': code, 'command': command_description,
+                  'error': None, 'data': '', 'delta': 0, 'last_cmd_delta': 0}
+
+        own_timer = None
+        if timer is None and self.instrumentation:
+            timer = own_timer = self.instrumentation.start(command)
 
-        state = self.__check_state()
+        if frame is None:
+            frame = self.build_frame(command, parameters)
+
+        state = self.__check_state() if probe else ST_READY
+        if timer:
+            timer.mark('enq')
         if state == ST_READ:
             self.__read()
             # NOTE: В ККТ болтается ответ на предыдущую команду
+            if timer:
+                timer.mark('stale_read')
         elif state != ST_READY:
             raise ShtrihConnectionError(ERR_LOST_DEVICE)
 
-        state = self.__write(code, parameters, wait_time or DEF_TIMEOUT)
+        if budget is None:
+            budget = self.retry_policies.budget(command)
+        state = self.__write(
+            frame, self.retry_policies.get(LAYER_WRITE, command), budget,
+            timer)
         if state == ST_NO_SIGNAL:
             raise ShtrihConnectionError(ERR_LOST_DEVICE)
 
-        t_max = MAX_TRIES
-        while t_max > 0:
-            state, err_code, data = self.__read()
+        wait_time = wait_time or DEF_TIMEOUT
+        for attempt in self.retry_policies.get(
+                LAYER_READ, command).attempts(budget):
+            if timer and attempt:
+                timer.mark('wait')
+            # NOTE: Ожидание ответа не выходит за бюджет задания
+            timeout = wait_time
+            remaining = budget.remaining() if budget is not None else None
+            if remaining is not None:
+                timeout = min(timeout, remaining)
+            started = monotonic()
+            state, err_code, data = self.__read(started + timeout, timer)
 
             if state == ST_RETRY:
+                # NOTE: Поправка не превышает шага: один потерянный ответ
+                #   не удваивает изученное время ожидания
                 cmd_key = 'delta'
                 if self._last_command_is_printing:
                     cmd_key = 'last_cmd_' + cmd_key
-                self.__result[cmd_key] += TIME_DELTA_STEP
-                time.sleep(TIME_DELTA_STEP)
-                t_max -= 1
+                result[cmd_key] += min(monotonic() - started, TIME_DELTA_STEP)
+                if timer:
+                    timer.mark('wait')
                 continue
             else:
                 if err_code in TIME_DELTA_ERRORS:
-                    self.__result['last_cmd_delta'] += TIME_DELTA_STEP
+                    result['last_cmd_delta'] += TIME_DELTA_STEP
                     time.sleep(TIME_DELTA_STEP)
+                    if timer:
+                        timer.mark('busy')
                 break
         else:
             raise ShtrihConnectionError(ERR_LOST_DEVICE)
@@ -317,25 +717,117 @@ class Shtrih(object):
         if self._last_command_is_printing:
             self._last_command_is_printing = False
 
-        self.__result['data'] = data
+        result['data'] = data
         if err_code:
-            self.__result['error'] = ShtrihError(err_code).serialize()
+            result['error'] = ShtrihError(err_code).serialize()
+            if timer:
+                timer.mark('decode')
         else:
             if command in CRITICAL_COMMANDS:
                 self.__print_zone = PRN_CRITICAL
                 self.__last_critical_command = command
             elif command in POST_CRITICAL_COMMANDS:
                 self.__print_zone = PRN_POST_CRITICAL
+            elif command in ROLLBACKS.values():
+                # NOTE: Аннулированный чек выводит из критической области
+                self.__print_zone = PRN_NON_CRITICAL
 
-            if t_max == MAX_TRIES:
-                self.__result['delta'] -= TIME_DELTA_STEP
+            if attempt == 0:
+                result['delta'] -= TIME_DELTA_STEP
 
             if command in FINAL_TIME:
-                time.sleep(FINAL_TIME[command])
+                self.__await_completion(command, budget)
+                if timer:
+                    timer.mark('final')
+
+        if own_timer:
+            result['phases'] = self.instrumentation.finish(own_timer)
+        return result
+
+    @property
+    def completion_durations(self):
+        """ Изученная длительность движения бумаги по командам """
+        return dict(self.__durations)
+
+    def __poll_submode(self):
+        """ Короткий запрос состояния без изменения результата команды.
+            Опрос отключается, если устройство не поддерживает запрос
+            или не отвечает на него COMPLETION_FAILURES раз подряд.
+            :returns подрежим устройства или None
+        """
+        command = 'get_short_status'
+        try:
+            state = self.__check_state()
+            if state == ST_READ:
+                self.__read()
+            elif state != ST_READY:
+                return None
+            state = self.__write(
+                self.build_frame(command, ''),
+                self.retry_policies.get(LAYER_WRITE, command))
+            if state == ST_NO_SIGNAL:
+                return None
+            state, err_code, data = self.__read()
+        except (ShtrihError, serial.SerialException):
+            return self.__submode_failed()
+
+        if state != ST_READY:
+            return self.__submode_failed()
+        if err_code in SUBMODE_UNSUPPORTED or \
+                not err_code and len(data or '') < 5:
+            # NOTE: Устройство не сообщает подрежим -- далее только паузы
+            self.__submode_polling = False
+            return None
+        if err_code:
+            return self.__submode_failed()
+        self.__submode_failures = 0
+        return ord(data[4])
+
+    def __submode_failed(self):
+        """ Учет неудачного опроса подрежима """
+        self.__submode_failures += 1
+        if self.__submode_failures >= COMPLETION_FAILURES:
+            self.__submode_polling = False
+        return None
+
+    def __await_completion(self, command, budget=None):
+        """ Ожидание завершения движения бумаги (протяжка, отрезка).
+            Подрежим устройства опрашивается до выхода из печати; первый
+            опрос откладывается на долю изученной длительности. Если
+            подрежим недоступен, выдерживается пауза FINAL_TIME.
+            :param command: команда
+            :param budget: бюджет времени (объект класса Deadline)
+        """
+        started = monotonic()
+        fallback = FINAL_TIME[command]
+        learned = self.__durations.get(command)
+
+        if self.__submode_polling:
+            if learned:
+                time.sleep(min(learned * COMPLETION_LEAD, fallback))
+            limit = started + COMPLETION_MAX
+            if budget is not None and budget.expires is not None:
+                limit = min(limit, budget.expires)
+            while True:
+                submode = self.__poll_submode()
+                if submode is None:
+                    break
+                now = monotonic()
+                if submode not in PRINTING_SUBMODES or now >= limit:
+                    duration = now - started
+                    self.__durations[command] = duration if learned is None \
+                        else learned + COMPLETION_ALPHA * (duration - learned)
+                    return
+                time.sleep(COMPLETION_POLL)
+
+        remaining = fallback - (monotonic() - started)
+        if remaining > 0:
+            time.sleep(remaining)
 
     @property
     def result(self):
-        """ Результат выполнения операции
+        """ Результат последней операции текущего потока
+            (очищается при чтении)
             returns: словарь вида {
                 code: код команды,
                 command: описание команды,
@@ -343,8 +835,8 @@ class Shtrih(object):
                 data: возвращаемый ответ (байты),
                 delta: приращение ко времени ожидания ответа}
         """
-        res = self.__result
-        self.__result = {}
+        res = getattr(self.__local, 'result', None) or {}
+        self.__local.result = {}
         return res
 
     @property
@@ -3,11 +3,21 @@
     Модуль работы с фискальными устройствами
     Интерфейсы печати на ККТ для устройств семейства Штрих: ФРК, ФРФ, М
 """
-from shtrih_constants import MAX_TRIES, PRN_CRITICAL, ERR_COMMAND_TIMEOUT, \
-    TIME_DELTA_ERRORS, TIME_DELTA_STEP, WAITING_ERRORS, ROLLBACKS, PRN_POST_CRITICAL
+from struct import error as StructError
+from threading import Thread
+
+from shtrih_constants import PRN_CRITICAL, ERR_COMMAND_TIMEOUT, \
+    TIME_DELTA_ERRORS, TIME_DELTA_STEP, WAITING_ERRORS, ROLLBACKS, \
+    PRN_POST_CRITICAL, EXCHANGE_RATES, RATES, VERIFY_TRIES, ERR_LOST_DEVICE, \
+    ERR_DEVICE_UNAVAILABLE, ERR_DATA_LENGTH
 from shtrih_exceptions import ShtrihConnectionError, ShtrihError, \
     ShtrihCommandError
 from shtrih import Shtrih
+from retry import Deadline, ExponentialPolicy, LAYER_ACTION
+from breaker import CircuitBreaker
+from capture import ReplayTransport
+from hotplug import HotplugWatcher, PROBE_DELAY, PROBE_TRIES
+from port_broker import PortBroker, RemoteShtrih
 from shtrih_middleware import ShtrihPrepareRequest, ShtrihPrepareResponse
 
 
@@ -16,6 +26,8 @@ class ShtrihCashRegister(object):
 
     dev_type = "Shtrih"
     dev_class = Shtrih
+    metrics = None  # объект класса MetricsRegistry (статистика ошибок)
+    supports_frames = True  # выполнение команд по готовым кадрам
 
     def __init__(self, port=None, rate=None):
         try:
@@ -25,6 +37,10 @@ class ShtrihCashRegister(object):
 
         self._prepare = ShtrihPrepareRequest()
         self._response = ShtrihPrepareResponse()
+        self.__job = None   # бюджет времени текущего задания (Deadline)
+        self.breaker = None     # размыкатель цепи (CircuitBreaker)
+        self.fallback = None    # резервное устройство при открытом размыкателе
+        self.hotplug = None     # наблюдатель подключения (HotplugWatcher)
 
         self.check_width = self.__device.check_width
 
@@ -33,8 +49,7 @@ class ShtrihCashRegister(object):
         is_ready = None
 
         try:
-            self.__device("get_short_status", '', None)
-            result = self.__device.result
+            result = self.__device("get_short_status", '', None)
         except ShtrihError:
             pass
         else:
@@ -44,6 +59,197 @@ class ShtrihCashRegister(object):
 
         return is_ready
 
+    @property
+    def port(self):
+        """ Порт подключения устройства """
+        return self.__device.port
+
+    @property
+    def rate(self):
+        """ Скорость обмена данными """
+        return self.__device.rate
+
+    @property
+    def in_critical_zone(self):
+        """ Признак нахождения в критической области печати """
+        return self.__device.print_zone == PRN_CRITICAL
+
+    def attach_transport(self, transport):
+        """ Подключение к устройству через готовый транспорт
+            :param transport: объект с интерфейсом serial.Serial
+        """
+        self.__device.attach_transport(transport)
+
+    def replay(self, file_name, scale=1.0):
+        """ Подключение к записанному сеансу обмена вместо устройства
+            :param file_name: имя файла записи
+            :param scale: масштаб задержек (1 -- исходные, 0 -- без задержек)
+            :returns объект класса ReplayTransport
+        """
+        transport = ReplayTransport(file_name, scale)
+        self.__device.attach_transport(transport)
+        return transport
+
+    def start_capture(self, file_name):
+        """ Начало записи обмена с устройством в файл """
+        self.__device.start_capture(file_name)
+
+    def stop_capture(self):
+        """ Завершение записи обмена с устройством """
+        self.__device.stop_capture()
+
+    def rebind(self, port, rate):
+        """ Перенастройка подключения без пересоздания драйвера
+            :param port: порт
+            :param rate: скорость обмена
+        """
+        self.__device.rebind(port, rate)
+
+    def enable_port_lock(self, timeout=None, lock_dir=None):
+        """ Монопольный доступ к порту между процессами
+            (см. Shtrih.enable_port_lock)
+            :param timeout: время ожидания освобождения порта
+            :param lock_dir: каталог файлов блокировки
+            :returns признак включения блокировки
+        """
+        kwargs = {'lock_dir': lock_dir}
+        if timeout is not None:
+            kwargs['timeout'] = timeout
+        self.__device.enable_port_lock(**kwargs)
+        return True
+
+    def serve_broker(self, path):
+        """ Запуск локального брокера устройства: клиентские процессы
+            (BrokerCashRegister) выполняют команды через одно подключение
+            :param path: путь Unix сокета
+            :returns объект класса PortBroker
+        """
+        broker = PortBroker(self.__device, path)
+        broker.start()
+        return broker
+
+    def enable_breaker(self, threshold=3, probe_interval=1.0, fallback=None,
+                       group=None, on_state=None):
+        """ Включение размыкателя цепи
+            :param threshold: число ошибок связи подряд для размыкания
+            :param probe_interval: интервал фоновой проверки устройства
+            :param fallback: резервное устройство (ShtrihCashRegister),
+                получающее команды при открытом размыкателе
+            :param group: группа портов для повторного поиска устройства
+            :param on_state: обработчик смены состояния
+                on_state(state, port, rate)
+            :returns объект класса CircuitBreaker
+        """
+        self.disable_breaker()
+        self.breaker = CircuitBreaker(
+            self, threshold, probe_interval, group, on_state)
+        self.fallback = fallback
+        return self.breaker
+
+    def disable_breaker(self):
+        """ Отключение размыкателя цепи """
+        if self.breaker is not None:
+            self.breaker.stop()
+        self.breaker, self.fallback = None, None
+
+    def probe(self):
+        """ Быстрая проверка связи с устройством (ENQ) """
+        return self.__device.probe()
+
+    def rediscover(self, group=None):
+        """ Поиск устройства на переподключенном порту
+            :param group: группа портов (ttyUSB, ttyACM)
+            :returns признак обнаружения устройства
+        """
+        self.__device.close()
+        try:
+            self.__device.find_device(group, self.rate)
+        except ShtrihConnectionError:
+            return False
+        return True
+
+    def probe_port(self, port, rates=None):
+        """ Поиск устройства на одном порту
+            :param port: порт
+            :param rates: список проверяемых скоростей
+            :returns скорость обмена или None
+        """
+        return self.__device.probe_port(port, rates)
+
+    def watch_hotplug(self, on_port=None, prefixes=None):
+        """ Отслеживание подключения устройств (только Linux).
+            При появлении порта устройство ищется только на нем и только
+            если текущее подключение не отвечает; полный перебор портов
+            (find_device) не выполняется. Поиск на новом порту
+            повторяется с нарастающей паузой (PROBE_TRIES, PROBE_DELAY):
+            порт готов к обмену не сразу после появления узла. Поиск
+            выполняется в отдельном потоке и не задерживает обработку
+            событий других портов; если устройство на новом порту
+            не найдено, прежнее подключение сохраняется.
+            :param on_port: обработчик обнаружения устройства
+                on_port(port, rate)
+            :param prefixes: префиксы имен отслеживаемых портов
+            :returns признак запуска наблюдения
+        """
+        self.stop_hotplug()
+
+        def probe_added(port):
+            rates = [r for r in RATES if r != self.rate]
+            if self.rate:
+                rates.insert(0, self.rate)
+            rate = None
+            for _ in ExponentialPolicy(PROBE_TRIES, PROBE_DELAY).attempts():
+                if self.probe():
+                    return
+                rate = self.probe_port(port, rates)
+                if rate is not None:
+                    break
+            if rate is None:
+                return
+            if self.breaker is not None:
+                self.breaker.close()
+            if on_port is not None:
+                on_port(port, rate)
+
+        def on_added(port):
+            thread = Thread(target=probe_added, args=(port, ))
+            thread.daemon = True
+            thread.start()
+
+        def on_removed(port):
+            if port == self.port:
+                self.__device.close()
+
+        kwargs = {} if prefixes is None else {'prefixes': prefixes}
+        self.hotplug = HotplugWatcher(on_added, on_removed, **kwargs)
+        if not self.hotplug.start():
+            self.hotplug = None
+            return False
+        return True
+
+    def stop_hotplug(self):
+        """ Остановка отслеживания подключения устройств """
+        if self.hotplug is not None:
+            self.hotplug.stop()
+            self.hotplug = None
+
+    def begin_job(self, seconds):
+        """ Начало задания с общим бюджетом времени: повторы всех команд
+            задания прекращаются по его исчерпании
+            Порт (при включенной блокировке порта) захватывается
+            один раз на все задание.
+            :param seconds: бюджет в секундах
+        """
+        if self.__job is None:
+            self.__device.hold_port()
+        self.__job = Deadline(seconds)
+
+    def end_job(self):
+        """ Завершение задания """
+        if self.__job is not None:
+            self.__device.release_port()
+        self.__job = None
+
     def is_opened(self):
         """ Признак, доступно ли устройство по указанному порту """
         return self.__device.is_opened
@@ -84,9 +290,8 @@ class ShtrihCashRegister(object):
         """
         response = self.prepare_response()
         try:
-            self.__device = Shtrih(port, rate)
+            self.__device.rebind(port, rate)
         except ShtrihConnectionError as exc:
-            self.__device = None
             response['exception'] = exc.serialize()
             response['command'] = 'break'
         else:
@@ -94,6 +299,94 @@ class ShtrihCashRegister(object):
         response['command'] = 'init_cash_register'
         return response
 
+    def __verify_link(self):
+        """ Проверочный обмен с устройством на текущей скорости """
+        for _ in range(VERIFY_TRIES):
+            try:
+                if self._check_for_ready() is None:
+                    return False
+            except ShtrihError:
+                return False
+        return True
+
+    def __switch_rate(self, rate):
+        """ Переключение скорости порта с проверкой связи """
+        try:
+            self.__device.rate = rate
+        except ShtrihConnectionError:
+            return False
+        return self.__verify_link()
+
+    def __restore_rate(self, dev_port, rate, failed_rate):
+        """ Возврат устройства на прежнюю скорость обмена.
+            Сначала порт переоткрывается на прежней скорости (обмен
+            по неисправной связи не выполняется). Если устройство на ней
+            не отвечает, команда возврата скорости передается на новой
+            скорости; если и после этого связь не восстановлена,
+            скорость определяется перебором на том же порту.
+            :param rate: прежняя скорость
+            :param failed_rate: скорость, не прошедшая проверку
+        """
+        if self.__switch_rate(rate):
+            return rate
+        try:
+            self.__device.rate = failed_rate
+        except ShtrihConnectionError:
+            pass
+        else:
+            self.make_action("set_exchange_param", None, dev_port,
+                             EXCHANGE_RATES.index(rate))
+            if self.__switch_rate(rate):
+                return rate
+        for candidate in RATES:
+            if self.__switch_rate(candidate):
+                return candidate
+        return None
+
+    def negotiate_rate(self, dev_port=0, max_rate=None):
+        """ Повышение скорости обмена до наибольшей, на которой
+            устройство проходит проверочный обмен.
+            Порт переоткрывается на новой скорости без повторного поиска
+            устройства; при неудаче устройство возвращается на прежнюю
+            скорость.
+            :param dev_port: номер порта устройства
+            :param max_rate: наибольшая допустимая скорость
+            :returns словарь с результатом, data: {'port', 'rate'}
+        """
+        with self.__device.lock:
+            return self.__negotiate_rate(dev_port, max_rate)
+
+    def __negotiate_rate(self, dev_port, max_rate):
+        """ Подбор скорости обмена (под блокировкой устройства) """
+        response = self.prepare_response(command='negotiate_rate')
+        old_rate = self.rate
+        if old_rate not in EXCHANGE_RATES:
+            response['data'] = {'port': self.port, 'rate': old_rate}
+            return response
+
+        candidates = [rate for rate in EXCHANGE_RATES if rate > old_rate and
+                      (max_rate is None or rate <= max_rate)]
+        rate = old_rate
+        for candidate in reversed(candidates):
+            result = self.make_action("set_exchange_param", None, dev_port,
+                                      EXCHANGE_RATES.index(candidate))
+            if result['exception']:
+                continue
+            if self.__switch_rate(candidate):
+                rate = candidate
+                break
+            rate = self.__restore_rate(dev_port, old_rate, candidate)
+            if rate is None:
+                exc = ShtrihConnectionError(ERR_LOST_DEVICE)
+                response['exception'] = exc.serialize()
+                response['action'] = 'break'
+                return response
+            if rate != old_rate:
+                break
+
+        response['data'] = {'port': self.port, 'rate': rate}
+        return response
+
     def check_dev_for_ready(self):
         """ Определение состояния ККТ на основе краткого опроса.
             Используется для фактической проверки готовности ККТ
@@ -133,40 +426,281 @@ class ShtrihCashRegister(object):
                 'data': словарь с данными ответа,
                 'delta': приращение ко времени выполнения команды,
                 'delta_for_last_command': приращение ко времени выполнения
-                                          предыдущей команды
+                                          предыдущей команды,
+                'phases': длительность фаз выполнения (при включенном
+                          инструментировании Shtrih.instrumentation)
                 }
         """
-        _delta, _last_delta = 0, 0
+        if self.__blocked(command):
+            if self.__fallback_allowed():
+                return self.fallback.make_action(
+                    command, timeout, *args, **kwargs)
+            exc = ShtrihConnectionError(ERR_DEVICE_UNAVAILABLE)
+            return self.analyse_result(command, exc.serialize())
+
+        instrumentation = self.__device.instrumentation
+        timer = instrumentation.start(command) if instrumentation else None
         data = getattr(self._prepare, command)(*args, **kwargs)
+        if timer:
+            timer.mark('encode')
+        return self.__perform(command, timeout, data, None, timer)
 
-        for _ in range(MAX_TRIES):
-            try:
-                self.__device(command, data, timeout)
-            except ShtrihError as exc:
-                response = self.analyse_result(command, exc.serialize())
-                break
-            else:
-                response = self.analyse_result(command)
+    @property
+    def frame_key(self):
+        """ Признаки устройства, от которых зависит кадр команды """
+        return self.__device.frame_key
 
-                _delta += response['delta']
-                _last_delta += response['delta_for_last_command']
+    def build_frame(self, command, *args, **kwargs):
+        """ Формирование кадра команды (см. Shtrih.build_frame)
+            :param command: наименование команды
+            :param args: позиционные аргументы
+            :param kwargs: именованные аргументы
+            :returns кадр для отправки на устройство
+        """
+        return self.__device.build_frame(
+            command, getattr(self._prepare, command)(*args, **kwargs))
 
-                if response['action'] == 'retry':
-                    continue
-                else:
-                    response['delta'] += _delta
-                    response['delta_for_last_command'] += _last_delta
+    def send_frame(self, command, timeout, frame):
+        """ Выполнение команды по готовому кадру (см. build_frame)
+            :param command: наименование команды
+            :param timeout: возможное время ожидания
+            :param frame: кадр команды
+            :returns словарь с результатом (см. make_action)
+        """
+        if self.__blocked(command):
+            fallback = self.fallback
+            if self.__fallback_allowed() and fallback.supports_frames and \
+                    fallback.frame_key == self.frame_key:
+                return fallback.send_frame(command, timeout, frame)
+            exc = ShtrihConnectionError(ERR_DEVICE_UNAVAILABLE)
+            return self.analyse_result(command, exc.serialize())
+
+        instrumentation = self.__device.instrumentation
+        timer = instrumentation.start(command) if instrumentation else None
+        return self.__perform(command, timeout, None, frame, timer)
+
+    def __perform(self, command, timeout, data, frame, timer):
+        """ Выполнение команды с повторами и анализом ответа
+            :param data: закодированные параметры команды
+            :param frame: готовый кадр команды (вместо data)
+            :param timer: объект класса PhaseTimer (при измерении фаз)
+        """
+        breaker = self.breaker
+        instrumentation = self.__device.instrumentation
+        policies = self.__device.retry_policies
+        budget = Deadline.earliest(self.__job, policies.budget(command))
+
+        _delta, _last_delta = 0, 0
+        # NOTE: Повторы и анализ ответа (с опросом готовности)
+        #   выполняются без вмешательства других потоков
+        with self.__device.lock:
+            for _ in policies.get(LAYER_ACTION, command).attempts(budget):
+                try:
+                    result = self.__device(
+                        command, data, timeout, timer, budget, frame=frame)
+                except ShtrihError as exc:
+                    response = self.analyse_result(command, exc.serialize())
                     break
+                else:
+                    response = self.analyse_result(command, result=result)
+                    if timer:
+                        timer.mark('analyse')
+
+                    if response['action'] == 'retry':
+                        _delta += response['delta']
+                        _last_delta += response['delta_for_last_command']
+                        continue
+                    else:
+                        # NOTE: Поправки предыдущих попыток (без повторного
+                        #   учета поправки последней)
+                        response['delta'] += _delta
+                        response['delta_for_last_command'] += _last_delta
+                        break
+            else:
+                exp = ShtrihCommandError(ERR_COMMAND_TIMEOUT)
+                response = self.analyse_result(command, exp.serialize())
+
+        if timer:
+            response['phases'] = instrumentation.finish(timer)
+        if breaker is not None:
+            breaker.record(response)
+        return response
+
+    def sale_many(self, items, timeout=None, start=0):
+        """ Регистрация серии продаж
+            Параметры всех позиций кодируются до начала обмена; кадры
+            передаются на устройство подряд (Shtrih.batch). Серия
+            прерывается на первой ошибке; ошибка "идет печать предыдущей
+            команды" повторяет серию с позиции ошибки. Аннулирование
+            незакрытого чека (ROLLBACKS) выполняется вызывающей стороной
+            по признаку is_critical, как и для sale.
+            :param items: список позиций -- словарей именованных
+                аргументов sale (price, count, text, department, taxes)
+                или кортежей позиционных аргументов
+            :param timeout: время ожидания ответа на каждую позицию
+            :param start: номер первой позиции (продолжение серии)
+            :returns словарь с результатом (см. make_batch)
+            :raises TypeError: неверный состав аргументов позиции
+        """
+        if self.__unavailable() and self.__fallback_allowed(start):
+            return self.fallback.sale_many(items, timeout, start)
+        encoded, invalid = self.__encode(
+            lambda item: self._prepare.sale(*item)
+            if isinstance(item, (list, tuple)) else self._prepare.sale(**item),
+            items, start)
+        return self.make_batch('sale', encoded, timeout, start,
+                               name='sale_many', invalid=invalid)
+
+    def print_text_block(self, command, lines, timeout=None, on_check=True,
+                         on_journal=True, start=0, pace=0):
+        """ Печать блока готовых (отформатированных) строк
+            :param command: print_string или print_wide_string
+            :param lines: список строк
+            :param timeout: время ожидания ответа на каждую строку
+            :param on_check: печать на чековой ленте
+            :param on_journal: печать на журнальной ленте
+            :param start: номер первой строки (продолжение блока)
+            :param pace: пауза между кадрами (см. Shtrih.batch)
+            :returns словарь с результатом (см. make_batch)
+        """
+        if self.__unavailable() and self.__fallback_allowed(start):
+            return self.fallback.print_text_block(
+                command, lines, timeout, on_check, on_journal, start, pace)
+        prepare = getattr(self._prepare, command)
+        encoded, invalid = self.__encode(
+            lambda line: prepare(line, on_check=on_check,
+                                 on_journal=on_journal),
+            lines, start)
+        return self.make_batch(command, encoded, timeout, start, pace,
+                               name='print_text_block', invalid=invalid)
+
+    @staticmethod
+    def __encode(prepare, items, start):
+        """ Кодирование параметров серии до начала обмена.
+            Кодирование прерывается на первой позиции с неверными данными
+            (значение вне диапазона, кодировка); ошибки вызова (TypeError)
+            не перехватываются.
+            :param prepare: функция кодирования позиции
+            :param items: список позиций
+            :param start: номер первой позиции
+            :returns кортеж (список параметров или None,
+                номер позиции с неверными данными или None)
+        """
+        encoded = []
+        for index, item in enumerate(items[start:], start):
+            try:
+                encoded.append(prepare(item))
+            except (ValueError, UnicodeError, StructError):
+                return None, index
+        return encoded, None
+
+    def __unavailable(self):
+        """ Признак открытого размыкателя цепи """
+        return self.breaker is not None and not self.breaker.allow()
+
+    def __blocked(self, command):
+        """ Признак отклонения команды открытым размыкателем цепи.
+            Аннулирование чека (ROLLBACKS) передается устройству
+            в любом случае: незакрытый чек остается на нем.
+        """
+        return self.__unavailable() and command not in ROLLBACKS.values()
+
+    def __fallback_allowed(self, start=0):
+        """ Признак допустимости передачи команд резервному устройству:
+            в критической области печати чек открыт на основном
+            устройстве, и продолжать его на резервном нельзя
+            :param start: номер первой команды серии; продолжение
+                начатой серии (start > 0) на резервном устройстве
+                не выполняется
+        """
+        return self.fallback is not None and not start and \
+            not self.in_critical_zone
+
+    def make_batch(self, command, parameter_list, timeout=None, start=0,
+                   pace=0, name=None, invalid=None):
+        """ Выполнение серии однотипных команд (Shtrih.batch)
+            Серия прерывается на первой ошибке; ошибка "идет печать
+            предыдущей команды" повторяет серию с позиции ошибки.
+            :param command: наименование команды
+            :param parameter_list: закодированные параметры команд;
+                None -- ошибка кодирования (обмен не выполняется)
+            :param timeout: время ожидания ответа на каждую команду
+            :param start: номер первой команды серии
+            :param pace: пауза между кадрами
+            :param name: наименование серии в ответе
+            :param invalid: номер команды с неверными данными
+                (при ошибке кодирования)
+            :returns словарь с результатом (см. make_action), data: {
+                'items': ответы по командам,
+                'completed': число выполненных команд (с учетом start),
+                'busy': число ответов "идет печать предыдущей команды",
+                'invalid': номер команды с неверными данными или None}
+        """
+        breaker = self.breaker
+        responses, failed, busy = [], None, 0
+        if self.__unavailable():
+            exc = ShtrihConnectionError(ERR_DEVICE_UNAVAILABLE)
+            failed = self.analyse_result(command, exc.serialize())
+        elif parameter_list is None:
+            exc = ShtrihCommandError(ERR_DATA_LENGTH)
+            failed = self.analyse_result(command, exc.serialize())
         else:
-            exp = ShtrihCommandError(ERR_COMMAND_TIMEOUT)
-            response = self.analyse_result(command, exp.serialize())
+            policies = self.__device.retry_policies
+            with self.__device.lock:
+                for _ in policies.get(LAYER_ACTION, command).attempts(
+                        self.__job):
+                    try:
+                        results, error = self.__device.batch(
+                            command, parameter_list[len(responses):],
+                            timeout, self.__job, pace)
+                    except ShtrihError as exc:
+                        results, error = [], exc.serialize()
 
+                    retry = False
+                    for result in results:
+                        response = self.analyse_result(command, result=result)
+                        if response['action'] == 'retry':
+                            code = int(response['exception']['code'])
+                            if code in TIME_DELTA_ERRORS:
+                                busy += 1
+                            retry = True
+                            break
+                        responses.append(response)
+                        if response['exception']:
+                            failed = response
+                            break
+                    if retry:
+                        continue
+                    if failed is None and error:
+                        failed = self.analyse_result(command, error)
+                    break
+                else:
+                    exc = ShtrihCommandError(ERR_COMMAND_TIMEOUT)
+                    failed = self.analyse_result(command, exc.serialize())
+
+        response = self.prepare_response(command=name or command)
+        completed = [item for item in responses if not item['exception']]
+        response['data'] = {'items': responses, 'busy': busy,
+                            'completed': start + len(completed),
+                            'invalid': invalid}
+        # NOTE: timeout серии применяется к каждой команде
+        response['delta'] = max([item['delta'] for item in responses] or [0])
+        if failed is not None:
+            for key in ('action', 'exception', 'delta_for_last_command'):
+                response[key] = failed[key]
+        response['is_critical'] = self.__device.print_zone == PRN_CRITICAL
+        response['post_critical'] = \
+            self.__device.print_zone == PRN_POST_CRITICAL
+        if breaker is not None and parameter_list is not None:
+            breaker.record(response)
         return response
 
-    def analyse_result(self, command, exception=None):
+    def analyse_result(self, command, exception=None, result=None):
         """ Предварительный анализ результата выполнения команды
             :param command: выполняемая команда
             :param exception: возникшее исключение
+            :param result: результат обмена (по умолчанию --
+                результат последней команды текущего потока)
             :returns словарь вида {
                 'action': константа (дальнейшее действие),
                 'command': текущая команда,
@@ -187,7 +721,8 @@ class ShtrihCashRegister(object):
             response['action'] = 'break'
             response['exception'] = exception
         else:
-            result = self.__device.result
+            if result is None:
+                result = self.__device.result
 
             if result['error']:
                 error = result['error']
@@ -223,4 +758,61 @@ class ShtrihCashRegister(object):
                 response['data'] = data
                 response['delta'] = result['delta']
 
+        if self.metrics is not None:
+            self.metrics.observe_result(self.port, command, response)
         return response
+
+
+class BrokerCashRegister(ShtrihCashRegister):
+    """ Выполнение команд через локальный брокер устройства (PortBroker).
+        Вместо порта передается путь Unix сокета брокера.
+        Готовые кадры команд не используются (кадр формирует брокер).
+        Портом (скорость, блокировка, отслеживание подключения,
+        транспорт) управляет процесс брокера; клиент такие операции
+        не выполняет. Запись обмена выполняется в процессе брокера.
+    """
+
+    dev_class = RemoteShtrih
+    supports_frames = False
+
+    def __unavailable_response(self, command):
+        """ Ответ на операцию, выполняемую только процессом брокера """
+        exc = ShtrihConnectionError(ERR_DEVICE_UNAVAILABLE)
+        return self.analyse_result(command, exc.serialize())
+
+    def negotiate_rate(self, dev_port=0, max_rate=None):
+        """ Скорость обмена задается брокером
+            :returns ответ с ошибкой ERR_DEVICE_UNAVAILABLE
+        """
+        return self.__unavailable_response('negotiate_rate')
+
+    def attach_transport(self, transport):
+        """ Транспорт подключается в процессе брокера
+            :returns ответ с ошибкой ERR_DEVICE_UNAVAILABLE
+        """
+        return self.__unavailable_response('attach_transport')
+
+    def replay(self, file_name, scale=1.0):
+        """ Сеанс воспроизводится в процессе брокера
+            :returns ответ с ошибкой ERR_DEVICE_UNAVAILABLE
+        """
+        return self.__unavailable_response('replay')
+
+    def enable_port_lock(self, timeout=None, lock_dir=None):
+        """ Монопольный доступ к порту обеспечивает брокер;
+            блокировка в процессе клиента не включается
+            :returns False
+        """
+        return False
+
+    def probe_port(self, port, rates=None):
+        """ Поиск устройства на порту выполняет брокер
+            :returns None
+        """
+        return None
+
+    def watch_hotplug(self, on_port=None, prefixes=None):
+        """ Подключение устройства отслеживает брокер
+            :returns False (наблюдение не запускается)
+        """
+        return False
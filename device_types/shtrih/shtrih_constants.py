@@ -9,6 +9,10 @@ PASSWORD = '\x1e\x00\x00\x00'   # пароль по умолчанию
 RATES = [1843200, 921600, 460800, 230400, 115200,
          57600, 38400, 19200, 9600, 4800, 2400,
          1200, 600, 300, 150, 100, 75, 50]
+# Скорости обмена, устанавливаемые командой set_exchange_param (индекс -- код)
+EXCHANGE_RATES = [2400, 4800, 9600, 19200, 38400, 57600, 115200,
+                  230400, 460800, 921600]
+VERIFY_TRIES = 3    # число проверочных обменов после смены скорости
 
 # ##################
 # Режимы работы ККТ
@@ -64,6 +68,9 @@ MAX_TRIES = 50      # количество попыток
 MIN_TIMEOUT = 0.01  # минимальное время ожидания выполнения команды
 DEF_TIMEOUT = 0.5   # время ожидания по умолчанию
 TIME_DELTA_STEP = 0.01  # Шаг корректировки времени ожидания
+BITS_PER_BYTE = 10.0    # бит на байт при передаче (8N1 со стартовым битом)
+MIN_BYTE_TIMEOUT = 0.05     # наименьший межбайтовый таймаут
+BYTE_TIMEOUT_FACTOR = 4     # межбайтовый таймаут в байтах на текущей скорости
 # Минимальное число попыток чтения, с которого
 # активизируется корректировка времени ожидания
 MIN_TRIES_FOR_FIX = 5
@@ -120,7 +127,62 @@ COMMANDS = {
 }
 
 NO_NEED_PASSWORD = [0xfc]
+
+# Классы команд (для политик повторов и бюджетов времени)
+CMD_STATUS = 'status'       # запросы состояния
+CMD_FISCAL = 'fiscal'       # фискальные операции
+CMD_PAPER = 'paper'         # печать и протяжка ленты
+CMD_REPORT = 'report'       # отчеты
+CMD_SERVICE = 'service'     # прочие команды
+COMMAND_CLASSES = {
+    "get_autocut_param": CMD_STATUS,
+    "get_cash_reg": CMD_STATUS,
+    "get_device_metrics": CMD_STATUS,
+    "get_exchange_param": CMD_STATUS,
+    "get_short_status": CMD_STATUS,
+    "get_status": CMD_STATUS,
+    "cancel_check": CMD_FISCAL,
+    "cash_income": CMD_FISCAL,
+    "cash_outcome": CMD_FISCAL,
+    "close_check": CMD_FISCAL,
+    "open_session": CMD_FISCAL,
+    "return_sale": CMD_FISCAL,
+    "sale": CMD_FISCAL,
+    "sale_many": CMD_FISCAL,
+    "continue_print": CMD_PAPER,
+    "cut_check": CMD_PAPER,
+    "feed_document": CMD_PAPER,
+    "print_barcode": CMD_PAPER,
+    "print_image": CMD_PAPER,
+    "print_line_barcode": CMD_PAPER,
+    "print_string": CMD_PAPER,
+    "print_table": CMD_PAPER,
+    "print_text_block": CMD_PAPER,
+    "print_wide_string": CMD_PAPER,
+    "print_report_with_cleaning": CMD_REPORT,
+    "print_report_without_cleaning": CMD_REPORT,
+}
+# Бюджет времени выполнения команды по классам (в секундах)
+COMMAND_BUDGETS = {
+    CMD_STATUS: 5,
+    CMD_FISCAL: 60,
+    CMD_PAPER: 30,
+    CMD_REPORT: 300,
+    CMD_SERVICE: 30,
+}
 FINAL_TIME = {"feed_document": 0.2, "cut_check": 0.3}
+# Ожидание завершения движения бумаги по подрежиму устройства
+PRINTING_SUBMODES = (4, 5)  # подрежимы: идет печать
+COMPLETION_POLL = 0.02      # интервал опроса подрежима
+COMPLETION_MAX = 3.0        # наибольшее время опроса
+COMPLETION_LEAD = 0.8       # доля изученной длительности до первого опроса
+COMPLETION_ALPHA = 0.3      # вес нового замера в изученной длительности
+COMPLETION_FAILURES = 3     # число неудачных опросов подряд до отказа
+# Ошибки запроса подрежима: команда не поддерживается устройством
+SUBMODE_UNSUPPORTED = (0x37, )
+# Монопольный доступ к порту из нескольких процессов
+PORT_LOCK_TIMEOUT = 30      # время ожидания освобождения порта
+PORT_LOCK_POLL = 0.01       # интервал проверки очереди
 
 # ###################################
 # Обработка ошибок выполнения команд
@@ -135,6 +197,9 @@ PRN_CRITICAL = 1        # печать документа в критическ
 PRN_POST_CRITICAL = -1  # печать документа в закритической области
 
 ERR_UNDEFINED_DEVICE = -3   # не определен класс устройства
+ERR_DEVICE_UNAVAILABLE = -4     # устройство отключено размыкателем цепи
+ERR_PORT_BUSY = -5      # порт занят другим процессом
+ERR_REPLAY_FINISHED = -6    # записанный сеанс обмена завершен
 ERR_LOST_DEVICE = -1     # ошибка отсутствия связи с устройством
 ERR_OPENING_PORT = -2    # ошибка открытия порта
 ERR_UNKNOWN_COMMAND = -10    # неизвестная команда
@@ -144,6 +209,9 @@ ERR_COMMAND_TIMEOUT = -13
 
 CUSTOM_ERRORS = {
     ERR_UNDEFINED_DEVICE: u"Не определен класс устройства",
+    ERR_DEVICE_UNAVAILABLE: u"Устройство недоступно",
+    ERR_PORT_BUSY: u"Порт занят другим процессом",
+    ERR_REPLAY_FINISHED: u"Записанный сеанс обмена завершен",
     ERR_LOST_DEVICE: u"Нет связи с устройством",
     ERR_OPENING_PORT: u"Не удалось открыть порт",
     ERR_UNKNOWN_COMMAND: u"Неизвестная команда",
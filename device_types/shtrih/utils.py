@@ -5,6 +5,12 @@
     Драйвер под устройства семейства "Штрих"
     Вспомогательные функции
 """
+try:
+    from time import monotonic
+except ImportError:
+    # NOTE: Python 2 -- монотонные часы пакета monotonic; системное время
+    #   (time.time) меняется при коррекции часов и сдвигает все сроки
+    from monotonic import monotonic
 
 
 def get_crc(str_data):
@@ -8,7 +8,8 @@ setup(
     install_requires=[
         "configparser",
         "pyserial",
-        "jinja2"],
+        "jinja2",
+        "monotonic; python_version < '3.3'"],
     url='',
     license='LGPL',
     author='jn',
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+""" LoremCross
+    Модуль работы с фискальными устройствами
+    Имитация устройства семейства Штрих на другой стороне
+    последовательного порта (для тестов)
+"""
+import shutil
+import tempfile
+import time
+
+from lc_cashcontrol.cash_register.cash_register import CashRegister
+from lc_cashcontrol.device_types.shtrih.shtrih_constants import ACK, \
+    COMMANDS, ENQ, EXCHANGE_RATES, NAK, NO_NEED_PASSWORD, PASSWORD, STX
+from lc_cashcontrol.device_types.shtrih.utils import get_crc, monotonic
+
+CODES = dict((code, name) for name, (code, _) in COMMANDS.items())
+# Данные ответа по умолчанию: номер оператора и нули (достаточно
+# для разбора ответа любой команды)
+REPLY_DATA = PASSWORD[0] + '\x00' * 31
+POLL = 0.001    # пауза чтения при отсутствии данных
+
+
+def response_frame(code, error=0, data=REPLY_DATA):
+    """ Кадр ответа устройства """
+    content = chr(len(data) + 2) + chr(code) + chr(error) + data
+    return STX + content + get_crc(content)
+
+
+class FakePort(object):
+    """ Порт с устройством Штрих: устройство отвечает на ENQ и кадры
+        команд на своей скорости обмена (rate). Выполненные команды
+        накапливаются в списке commands (наименование, параметры).
+        :param rate: скорость обмена устройства и порта
+    """
+
+    def __init__(self, rate=115200):
+        self.baudrate = rate
+        self.rate = rate
+        self.timeout = None
+        self.closed = False
+        self.commands = []
+        self.broken_rates = set()   # скорости без связи с устройством
+        self.__replies = {}
+        self.__delays = []
+        self.__input = []
+        self.__paused = None
+
+    def reply(self, command, error=0, data=REPLY_DATA):
+        """ Очередной ответ на команду (по умолчанию -- без ошибки) """
+        self.__replies.setdefault(command, []).append((error, data))
+
+    def delay(self, seconds):
+        """ Задержка очередного ответа на команду """
+        self.__delays.append(float(seconds))
+
+    def isOpen(self):
+        return not self.closed
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def write(self, data):
+        if self.baudrate != self.rate or self.baudrate in self.broken_rates:
+            return len(data)
+        if data == ENQ:
+            self.__input.append(NAK)
+        elif data[:1] == STX:
+            self.__command(data[1:-1])
+        return len(data)
+
+    def __command(self, content):
+        code = ord(content[1])
+        name = CODES[code]
+        skip = 2 if code in NO_NEED_PASSWORD else 2 + len(PASSWORD)
+        parameters = content[skip:]
+        self.commands.append((name, parameters))
+
+        replies = self.__replies.get(name)
+        error, data = replies.pop(0) if replies else (0, REPLY_DATA)
+        self.__input.append(ACK)
+        if self.__delays:
+            self.__input.append(self.__delays.pop(0))
+        self.__input.append(response_frame(code, error, data))
+        if name == 'set_exchange_param' and not error:
+            self.rate = EXCHANGE_RATES[ord(parameters[1])]
+
+    def read(self, size=1):
+        data = ''
+        while self.__input and len(data) < size:
+            item = self.__input[0]
+            if isinstance(item, float):
+                if data:
+                    break
+                if self.__paused is None:
+                    self.__paused = monotonic()
+                if monotonic() - self.__paused < item:
+                    break
+                self.__paused = None
+                self.__input.pop(0)
+                continue
+            chunk = item[:size - len(data)]
+            data += chunk
+            if len(chunk) < len(item):
+                self.__input[0] = item[len(chunk):]
+            else:
+                self.__input.pop(0)
+        if not data:
+            time.sleep(POLL)
+        return data
+
+
+def register_class(test_case, base=CashRegister):
+    """ Класс устройства с метрикой во временном каталоге теста """
+    path = tempfile.mkdtemp()
+    test_case.addCleanup(shutil.rmtree, path)
+
+    class Register(base):
+        pass
+    Register.register_smart(path, 'smart.json')
+    # NOTE: Метрика записывается и при удалении хранилища -- до удаления
+    #   каталога
+    test_case.addCleanup(setattr, Register, 'smart', None)
+    return Register
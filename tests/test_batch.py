@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+""" LoremCross
+    Модуль работы с фискальными устройствами
+    Тесты серий однотипных команд (sale_many, print_text_block)
+"""
+import unittest
+
+from lc_cashcontrol.device_types.shtrih.shtrih_cash_register import \
+    ShtrihCashRegister
+from lc_cashcontrol.device_types.shtrih.shtrih_constants import \
+    ERR_DATA_LENGTH
+
+from fake_device import FakePort
+
+WAIT = 0.5
+PORT = '/dev/ttyFAKE0'
+BUSY = 0x50
+NO_PAPER = 0x6B
+ITEMS = [{'price': 10, 'text': u'Хлеб'}, {'price': 20, 'text': u'Молоко'},
+         {'price': 30, 'text': u'Сыр'}]
+
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.port = FakePort()
+        self.device = ShtrihCashRegister(PORT)
+        self.device.attach_transport(self.port)
+
+    def executed(self, name):
+        return len([item for item in self.port.commands if item[0] == name])
+
+    def test_items_are_sent_in_one_series(self):
+        response = self.device.sale_many(ITEMS, WAIT)
+        self.assertIsNone(response['exception'])
+        self.assertEqual(response['data']['completed'], len(ITEMS))
+        self.assertIsNone(response['data']['invalid'])
+        self.assertEqual(self.executed('sale'), len(ITEMS))
+
+    def test_busy_device_repeats_series_from_failed_item(self):
+        self.port.reply('sale')
+        self.port.reply('sale', BUSY)
+        response = self.device.sale_many(ITEMS, WAIT)
+        self.assertIsNone(response['exception'])
+        self.assertEqual(response['data']['completed'], len(ITEMS))
+        self.assertEqual(response['data']['busy'], 1)
+        self.assertEqual(self.executed('sale'), len(ITEMS) + 1)
+
+    def test_device_error_stops_series(self):
+        self.port.reply('sale')
+        self.port.reply('sale', NO_PAPER)
+        response = self.device.sale_many(ITEMS, WAIT)
+        self.assertEqual(response['exception']['code'], NO_PAPER)
+        self.assertEqual(response['data']['completed'], 1)
+        self.assertEqual(self.executed('sale'), 2)
+
+    def test_invalid_item_is_reported_before_exchange(self):
+        items = ITEMS[:1] + [{'price': 20, 'department': 300}] + ITEMS[2:]
+        response = self.device.sale_many(items, WAIT)
+        self.assertEqual(response['exception']['code'], ERR_DATA_LENGTH)
+        self.assertEqual(response['data']['invalid'], 1)
+        self.assertEqual(response['data']['completed'], 0)
+        self.assertEqual(self.port.commands, [])
+
+    def test_invalid_line_is_reported_with_start_offset(self):
+        lines = ['first', 'second', '\xff']
+        response = self.device.print_text_block(
+            'print_string', lines, WAIT, start=1)
+        self.assertEqual(response['data']['invalid'], 2)
+        self.assertEqual(response['data']['completed'], 1)
+        self.assertEqual(self.port.commands, [])
+
+    def test_wrong_arguments_are_not_hidden(self):
+        self.assertRaises(TypeError, self.device.sale_many,
+                          [{'price': 10, 'cost': 10}], WAIT)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+""" LoremCross
+    Модуль работы с фискальными устройствами
+    Тесты размыкателя цепи (CircuitBreaker)
+"""
+import unittest
+from threading import Event
+
+from lc_cashcontrol.device_types.shtrih.breaker import BREAKER_CLOSED, \
+    BREAKER_OPEN, CircuitBreaker, port_group
+from lc_cashcontrol.device_types.shtrih.shtrih_constants import \
+    ERR_LOST_DEVICE
+
+
+def failure(code=ERR_LOST_DEVICE):
+    return {'exception': {'code': code}}
+
+
+class Register(object):
+    """ Устройство для фоновой проверки размыкателя """
+
+    port = '/dev/ttyUSB0'
+    rate = 115200
+
+    def __init__(self, alive=False):
+        self.alive = alive
+        self.probed = Event()
+
+    def probe(self):
+        self.probed.set()
+        return self.alive
+
+    def rediscover(self, group):
+        return False
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.register = Register()
+        self.states = []
+        self.breaker = CircuitBreaker(
+            self.register, threshold=2, probe_interval=0.01,
+            on_state=lambda state, port, rate: self.states.append(state))
+
+    def tearDown(self):
+        self.breaker.stop()
+
+    def test_opens_after_threshold(self):
+        self.breaker.record(failure())
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record(failure())
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.state, BREAKER_OPEN)
+        self.assertEqual(self.states, [BREAKER_OPEN])
+
+    def test_success_and_device_errors_reset_failures(self):
+        self.breaker.record(failure())
+        self.breaker.record({'exception': None})
+        self.breaker.record(failure())
+        self.breaker.record(failure(0x4e))
+        self.breaker.record(failure())
+        self.assertTrue(self.breaker.allow())
+
+    def test_close(self):
+        self.breaker.record(failure())
+        self.breaker.record(failure())
+        self.breaker.close()
+        self.assertEqual(self.breaker.state, BREAKER_CLOSED)
+        self.assertEqual(self.states, [BREAKER_OPEN, BREAKER_CLOSED])
+
+    def test_probe_closes_restored_device(self):
+        self.breaker.record(failure())
+        self.breaker.record(failure())
+        self.assertTrue(self.register.probed.wait(1))
+        self.register.alive = True
+        for _ in range(100):
+            if self.breaker.allow():
+                break
+            Event().wait(0.01)
+        self.assertTrue(self.breaker.allow())
+
+    def test_port_group(self):
+        self.assertEqual(port_group('/dev/ttyUSB12'), 'ttyUSB')
+        self.assertIsNone(port_group(None))
+
+
+if __name__ == '__main__':
+    unittest.main()
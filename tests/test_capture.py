@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+""" LoremCross
+    Модуль работы с фискальными устройствами
+    Тесты записи обмена с устройством и воспроизведения сеанса
+    (RecordingTransport, ReplayTransport)
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from lc_cashcontrol.device_types.shtrih.capture import DIR_READ, \
+    read_capture
+from lc_cashcontrol.device_types.shtrih.shtrih_cash_register import \
+    ShtrihCashRegister
+from lc_cashcontrol.device_types.shtrih.utils import monotonic
+
+from fake_device import FakePort
+
+WAIT = 0.5
+PORT = '/dev/ttyFAKE0'
+
+
+class CaptureTest(unittest.TestCase):
+
+    def setUp(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        self.file_name = os.path.join(path, 'session.cap')
+
+    def record(self, delay=0):
+        port = FakePort()
+        port.delay(delay)
+        device = ShtrihCashRegister(PORT)
+        device.attach_transport(port)
+        device.start_capture(self.file_name)
+        response = device.make_action('beep', WAIT)
+        device.stop_capture()
+        self.assertIsNone(response['exception'])
+
+    def test_idle_reads_are_collapsed(self):
+        self.record(delay=0.05)
+        reads = [data for direction, _, data in read_capture(self.file_name)
+                 if direction == DIR_READ]
+        self.assertIn('', reads)
+        self.assertFalse([index for index in range(1, len(reads))
+                          if not reads[index - 1] and not reads[index]])
+
+    def test_replay_reproduces_session(self):
+        self.record()
+        device = ShtrihCashRegister(PORT)
+        transport = device.replay(self.file_name, scale=0)
+        response = device.make_action('beep', WAIT)
+        self.assertIsNone(response['exception'])
+        self.assertEqual(response['data'], {'operator': 30})
+        self.assertEqual(transport.mismatches, [])
+
+    def test_finished_replay_fails_without_waiting(self):
+        self.record()
+        device = ShtrihCashRegister(PORT)
+        device.replay(self.file_name, scale=0)
+        device.make_action('beep', WAIT)
+
+        started = monotonic()
+        response = device.make_action('beep', 5)
+        self.assertTrue(response['exception'])
+        self.assertLess(monotonic() - started, 1)
+
+    def test_unknown_format_is_rejected(self):
+        with open(self.file_name, 'wb') as handle:
+            handle.write('LCCAP\x01')
+        self.assertRaises(ValueError, list, read_capture(self.file_name))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+""" LoremCross
+    Модуль работы с фискальными устройствами
+    Тесты ожидания завершения движения бумаги по подрежиму устройства
+"""
+import unittest
+
+from lc_cashcontrol.device_types.shtrih.shtrih import Shtrih
+from lc_cashcontrol.device_types.shtrih.shtrih_constants import \
+    COMPLETION_FAILURES
+
+from fake_device import FakePort
+
+WAIT = 0.5
+FEED = '\x02\x01'
+UNSUPPORTED = 0x37
+BUSY = 0x50
+
+
+class SubmodePollingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.port = FakePort()
+        self.device = Shtrih(None, None)
+        self.device.attach_transport(self.port)
+
+    def polls(self):
+        """ Число опросов подрежима за одну протяжку """
+        before = len(self.port.commands)
+        self.device('feed_document', FEED, WAIT)
+        return len([name for name, _ in self.port.commands[before:]
+                    if name == 'get_short_status'])
+
+    def test_unsupported_request_disables_polling(self):
+        self.port.reply('get_short_status', UNSUPPORTED)
+        self.assertEqual(self.polls(), 1)
+        self.assertEqual(self.polls(), 0)
+
+    def test_transient_error_keeps_polling(self):
+        self.port.reply('get_short_status', BUSY)
+        self.assertEqual(self.polls(), 1)
+        self.assertEqual(self.polls(), 1)
+
+    def test_consecutive_failures_disable_polling(self):
+        for _ in range(COMPLETION_FAILURES):
+            self.port.reply('get_short_status', BUSY)
+            self.assertEqual(self.polls(), 1)
+        self.assertEqual(self.polls(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
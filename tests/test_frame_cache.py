@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+""" LoremCross
+    Модуль работы с фискальными устройствами
+    Тесты кэша кадров команд печати (FrameCache)
+"""
+import unittest
+
+from lc_cashcontrol.cash_register.frame_cache import FrameCache
+
+
+class FrameCacheTest(unittest.TestCase):
+
+    def test_hit_and_miss(self):
+        cache = FrameCache()
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', b'frame')
+        self.assertEqual(cache.get('a'), b'frame')
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(cache.hit_rate, 0.5)
+
+    def test_least_recently_used_is_evicted(self):
+        cache = FrameCache(size=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_clear_resets_stats(self):
+        cache = FrameCache()
+        cache.put('a', 1)
+        cache.get('a')
+        cache.clear()
+        self.assertEqual(cache.stats(), {'size': cache.size, 'length': 0,
+                                         'hits': 0, 'misses': 0,
+                                         'hit_rate': 0.0})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+""" LoremCross
+    Модуль работы с фискальными устройствами
+    Тесты поиска устройства на появившемся порту (probe_port)
+"""
+import os
+import struct
+import unittest
+
+from lc_cashcontrol.device_types.shtrih.hotplug import HotplugWatcher, \
+    IN_CREATE, IN_DELETE
+from lc_cashcontrol.device_types.shtrih.shtrih import Shtrih
+
+RATE = 9600
+
+
+def pseudo_tty(test_case):
+    """ Порт без устройства (псевдотерминал) """
+    master, slave = os.openpty()
+    test_case.addCleanup(os.close, master)
+    test_case.addCleanup(os.close, slave)
+    return os.ttyname(slave)
+
+
+class ProbePortTest(unittest.TestCase):
+
+    def test_silent_port_keeps_previous_connection(self):
+        current, added = pseudo_tty(self), pseudo_tty(self)
+        device = Shtrih(current, RATE, read_timeout=0.05)
+        self.addCleanup(device.close)
+
+        self.assertIsNone(device.probe_port(added, [115200]))
+        self.assertEqual(device.port, current)
+        self.assertEqual(device.rate, RATE)
+        self.assertTrue(device.is_opened)
+
+    def test_missing_port(self):
+        current = pseudo_tty(self)
+        device = Shtrih(current, RATE, read_timeout=0.05)
+        self.addCleanup(device.close)
+
+        self.assertIsNone(device.probe_port('/dev/ttyMISSING0', [RATE]))
+        self.assertEqual(device.port, current)
+        self.assertTrue(device.is_opened)
+
+
+class HotplugWatcherTest(unittest.TestCase):
+
+    def test_parse(self):
+        name = b'ttyUSB0'.ljust(16, b'\0')
+        buf = struct.pack('iIII', 1, IN_CREATE, 0, len(name)) + name + \
+            struct.pack('iIII', 1, IN_DELETE, 0, 0)
+        self.assertEqual(HotplugWatcher.parse(buf),
+                         [(IN_CREATE, 'ttyUSB0'), (IN_DELETE, '')])
+
+
+if __name__ == '__main__':
+    unittest.main()
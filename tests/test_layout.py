@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+""" LoremCross
+    Модуль работы с фискальными устройствами
+    Тесты разметки строк чека (layout)
+"""
+import unittest
+
+from lc_cashcontrol.cash_register import layout
+from lc_cashcontrol.cash_register.layout import Column, TableLayout
+
+
+class FormatLineTest(unittest.TestCase):
+
+    def test_align_and_fill(self):
+        self.assertEqual(layout.format_line(u"ab", 6, 'center', '*'),
+                         u"**ab**")
+        self.assertEqual(layout.format_line(u"ab", 6, 'right'), u"    ab")
+
+    def test_bold_halves_width(self):
+        self.assertEqual(len(layout.format_line(u"ab", 10, bold=True)), 5)
+
+    def test_formatter_is_cached(self):
+        self.assertIs(layout.formatter(20, 'left'),
+                      layout.formatter(20, 'left'))
+
+    def test_wrap_text(self):
+        self.assertEqual(layout.wrap_text(u"", 5), [u""])
+        self.assertEqual(layout.wrap_text(u"one two three", 7),
+                         [u"one two", u"three"])
+
+
+class TableLayoutTest(unittest.TestCase):
+
+    def test_default_widths(self):
+        table = TableLayout(38)
+        self.assertEqual(table.widths, [10, 6, 9, 10])
+        row = table.row((u"Bread", 1, u"30.00", u"30.00"))
+        self.assertEqual(row, [u"Bread           1     30.00      30.00"])
+
+    def test_name_is_wrapped(self):
+        lines = TableLayout(38).row((u"Milk fresh 1l", 2, u"79.90",
+                                     u"159.80"))
+        self.assertEqual(lines, [u"Milk fresh      2     79.90     159.80",
+                                 u"1l".ljust(38)])
+
+    def test_numeric_values_are_not_truncated(self):
+        lines = TableLayout(38).row({'name': u"Item", 'count': 1,
+                                     'price': u"123456.78",
+                                     'total': u"1234567890.12"})
+        text = u"\n".join(lines)
+        self.assertIn(u"123456.78", text)
+        self.assertIn(u"1234567890.12", text)
+        # NOTE: Не поместившаяся сумма -- отдельной строкой справа
+        self.assertEqual(lines[-1], u"1234567890.12".rjust(38))
+
+    def test_only_wrap_columns_shrink(self):
+        table = TableLayout(20, [('name', 20, 'left', True),
+                                 ('total', 10, 'right', False)])
+        self.assertEqual(table.widths, [9, 10])
+
+    def test_fixed_columns_do_not_fit(self):
+        self.assertRaises(ValueError, TableLayout, 19)
+
+    def test_header_is_cut_to_column_width(self):
+        header = TableLayout(38).header([u"Name", u"Quantity", u"Price",
+                                         u"Total"])
+        self.assertEqual(len(header), 38)
+        self.assertIn(u"Quanti ", header)
+
+    def test_column_format(self):
+        column = Column.make({'key': 'total', 'width': 8, 'fmt': u"{:.2f}"})
+        self.assertEqual(column.value({'total': 3}, 0), u"3.00")
+        self.assertEqual(column.value({'total': None}, 0), u"")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+""" LoremCross
+    Модуль работы с фискальными устройствами
+    Тесты статистики выполнения команд (MetricsRegistry)
+"""
+import re
+import unittest
+from threading import Thread
+
+from lc_cashcontrol.cash_register.metrics import MetricsRegistry
+from lc_cashcontrol.device_types.shtrih.shtrih_cash_register import \
+    ShtrihCashRegister
+
+from fake_device import FakePort, register_class
+
+PORT = '/dev/ttyFAKE0'
+NO_PAPER = 0x6B
+
+
+def value(text, name, **labels):
+    """ Значение показателя с заданными метками """
+    pattern = r'^cashcontrol_{}\{{{}\}} (\S+)$'.format(name, ','.join(
+        '{}="{}"'.format(key, labels[key]) for key in sorted(labels)))
+    match = re.search(pattern, text, re.M)
+    return match and float(match.group(1))
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = MetricsRegistry()
+        self.port = FakePort()
+        device = ShtrihCashRegister(PORT)
+        device.metrics = self.metrics
+        device.attach_transport(self.port)
+        Register = register_class(self)
+        Register.metrics = self.metrics
+        self.register = Register(device)
+
+    def test_commands_and_errors_are_counted(self):
+        self.port.reply('beep', NO_PAPER)
+        self.register.execute('beep')
+        self.register.execute('beep')
+
+        text = self.metrics.render()
+        self.assertEqual(value(text, 'commands_total',
+                               command='beep', device=PORT), 2)
+        self.assertEqual(value(text, 'command_errors_total', code=NO_PAPER,
+                               command='beep', device=PORT, kind='device'), 1)
+        self.assertEqual(value(text, 'command_latency_seconds_count',
+                               command='beep', device=PORT), 2)
+
+    def test_render_is_consistent_during_updates(self):
+        def observe():
+            for _ in range(5000):
+                self.metrics.observe_command(PORT, 'beep', 0.01)
+        thread = Thread(target=observe)
+        thread.start()
+        while thread.is_alive():
+            text = self.metrics.render()
+            self.assertEqual(
+                value(text, 'commands_total', command='beep', device=PORT),
+                value(text, 'command_latency_seconds_count',
+                      command='beep', device=PORT))
+        thread.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+""" LoremCross
+    Модуль работы с фискальными устройствами
+    Тесты повышения скорости обмена (negotiate_rate) с перенастройкой
+    открытого порта без переоткрытия
+"""
+import unittest
+
+from lc_cashcontrol.device_types.shtrih.shtrih_cash_register import \
+    ShtrihCashRegister
+from lc_cashcontrol.device_types.shtrih.shtrih_constants import \
+    EXCHANGE_RATES
+
+from fake_device import FakePort
+
+PORT = '/dev/ttyFAKE0'
+RATE = 9600
+REJECTED = 0x33
+
+
+class NegotiateRateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.port = FakePort(RATE)
+        self.device = ShtrihCashRegister(PORT)
+        self.device.attach_transport(self.port)
+        self.device.rebind(PORT, RATE)
+
+    def requested_rates(self):
+        return [EXCHANGE_RATES[ord(params[1])]
+                for name, params in self.port.commands
+                if name == 'set_exchange_param']
+
+    def test_rate_is_raised_on_open_port(self):
+        response = self.device.negotiate_rate(max_rate=115200)
+        self.assertIsNone(response['exception'])
+        self.assertEqual(response['data'], {'port': PORT, 'rate': 115200})
+        self.assertEqual(self.port.baudrate, 115200)
+        self.assertFalse(self.port.closed)
+        self.assertEqual(self.device.make_action('beep', 0.5)['data'],
+                         {'operator': 30})
+
+    def test_rejected_rate_is_skipped(self):
+        self.port.reply('set_exchange_param', REJECTED)
+        response = self.device.negotiate_rate(max_rate=115200)
+        self.assertEqual(response['data']['rate'], 57600)
+        self.assertEqual(self.requested_rates(), [115200, 57600])
+        self.assertEqual(self.port.baudrate, 57600)
+
+    def test_current_rate_is_kept_without_faster_rates(self):
+        response = self.device.negotiate_rate(max_rate=RATE)
+        self.assertEqual(response['data']['rate'], RATE)
+        self.assertEqual(self.requested_rates(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
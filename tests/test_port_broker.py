@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+""" LoremCross
+    Модуль работы с фискальными устройствами
+    Тесты брокера устройства (PortBroker, BrokerCashRegister)
+    и блокировки порта между процессами (PortLock)
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from lc_cashcontrol.device_types.shtrih.capture import read_capture
+from lc_cashcontrol.device_types.shtrih.port_broker import PortBroker
+from lc_cashcontrol.device_types.shtrih.port_lock import PortLock
+from lc_cashcontrol.device_types.shtrih.shtrih import Shtrih
+from lc_cashcontrol.device_types.shtrih.shtrih_cash_register import \
+    BrokerCashRegister, ShtrihCashRegister
+from lc_cashcontrol.device_types.shtrih.shtrih_constants import \
+    ERR_DEVICE_UNAVAILABLE, ERR_PORT_BUSY
+from lc_cashcontrol.device_types.shtrih.shtrih_exceptions import \
+    ShtrihConnectionError
+from lc_cashcontrol.device_types.shtrih.utils import monotonic
+
+from fake_device import FakePort
+
+WAIT = 0.1
+PORT = '/dev/ttyFAKE0'
+
+
+class BrokerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.port = FakePort()
+        device = Shtrih(None, None)
+        device.attach_transport(self.port)
+        self.broker = PortBroker(device, os.path.join(self.path, 'broker'),
+                                 timeout=5)
+        self.broker.start()
+        self.addCleanup(self.broker.stop)
+
+    def client(self):
+        return BrokerCashRegister(self.broker.path)
+
+    def test_command_is_executed_by_broker(self):
+        response = self.client().make_action('beep', WAIT)
+        self.assertIsNone(response['exception'])
+        self.assertEqual(response['data'], {'operator': 30})
+        self.assertEqual(self.port.commands, [('beep', '')])
+
+    def test_job_budget_limits_wait_for_busy_device(self):
+        owner = self.client()
+        response = owner.make_action('sale', WAIT, 1.0)
+        self.assertTrue(response['is_critical'])
+
+        client = self.client()
+        client.begin_job(WAIT)
+        started = monotonic()
+        response = client.make_action('beep', WAIT)
+        client.end_job()
+        self.assertEqual(response['exception']['code'], ERR_PORT_BUSY)
+        self.assertLess(monotonic() - started, 2)
+
+    def test_capture_is_recorded_by_broker(self):
+        client = self.client()
+        file_name = os.path.join(self.path, 'session.cap')
+        client.start_capture(file_name)
+        client.make_action('beep', WAIT)
+        client.stop_capture()
+        self.assertTrue(list(read_capture(file_name)))
+
+    def test_port_operations_are_unavailable(self):
+        client = self.client()
+        for response in (client.attach_transport(FakePort()),
+                         client.replay('session.cap'),
+                         client.negotiate_rate()):
+            self.assertEqual(response['exception']['code'],
+                             ERR_DEVICE_UNAVAILABLE)
+        self.assertFalse(client.enable_port_lock())
+
+
+class PortLockTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def test_job_holds_port(self):
+        device = ShtrihCashRegister(PORT)
+        self.assertTrue(device.enable_port_lock(lock_dir=self.path))
+        device.attach_transport(FakePort())
+        other = PortLock(PORT, WAIT, self.path)
+
+        device.begin_job(5)
+        device.make_action('beep', WAIT)
+        device.make_action('beep', WAIT)
+        self.assertRaises(ShtrihConnectionError, other.acquire)
+
+        device.end_job()
+        self.assertTrue(other.acquire())
+        other.release()
+
+    def test_port_is_released_after_command(self):
+        device = ShtrihCashRegister(PORT)
+        device.enable_port_lock(lock_dir=self.path)
+        device.attach_transport(FakePort())
+
+        device.make_action('beep', WAIT)
+        other = PortLock(PORT, WAIT, self.path)
+        self.assertTrue(other.acquire())
+        other.release()
+
+
+if __name__ == '__main__':
+    unittest.main()
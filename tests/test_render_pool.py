@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+""" LoremCross
+    Модуль работы с фискальными устройствами
+    Тесты пула процессов рендера шаблонов (RenderPool)
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from lc_cashcontrol.cash_register.cash_register import CashRegister
+from lc_cashcontrol.cash_register.events import EventBus
+from lc_cashcontrol.cash_register.middleware import ProxyCashRegister, \
+    TemplateReader
+from lc_cashcontrol.cash_register.render_pool import RenderPool
+from lc_cashcontrol.cash_register.server import PrintServer
+from lc_cashcontrol.cash_register.utils import execute_printing_script
+from lc_cashcontrol.device_types.shtrih.shtrih_cash_register import \
+    ShtrihCashRegister
+
+from fake_device import FakePort, register_class
+
+WAIT = 10
+PORT = '/dev/ttyFAKE0'
+TEMPLATE = 'beeps.j2'
+DATA = {'count': 3}
+
+
+class RenderPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        with open(os.path.join(self.path, TEMPLATE), 'w') as handle:
+            handle.write("{% for _ in range(data['count']) %}"
+                         "{{ cash_reg.beep() or '' }}{% endfor %}")
+
+    def pool(self):
+        pool = RenderPool(self.path, processes=1, warm=[TEMPLATE])
+        self.addCleanup(pool.terminate)
+        return pool
+
+    def test_plan_matches_inline_rendering(self):
+        proxy = ProxyCashRegister(CashRegister)
+        execute_printing_script(TEMPLATE, {'cash_reg': proxy}, DATA, {},
+                                TemplateReader(self.path))
+        self.assertEqual(self.pool().render(TEMPLATE, DATA, {}, WAIT),
+                         proxy.serialize())
+
+    def test_reused_reader_renders_into_each_proxy(self):
+        reader = TemplateReader(self.path)
+        reader.get_template(TEMPLATE)
+        for count in (1, 2):
+            proxy = ProxyCashRegister(CashRegister)
+            execute_printing_script(TEMPLATE, {'cash_reg': proxy},
+                                    {'count': count}, {}, reader)
+            self.assertEqual(len(proxy.commands), count)
+
+    def test_server_executes_rendered_plan(self):
+        port = FakePort()
+        device = ShtrihCashRegister(PORT)
+        device.attach_transport(port)
+        server = PrintServer(self.path, render_pool=self.pool(),
+                             decision_timeout=0)
+        server.add_device('kkt', register_class(self)(device))
+        self.addCleanup(server.shutdown)
+
+        task = server.submit({'op': 'script', 'device': 'kkt',
+                              'template': TEMPLATE, 'data': DATA},
+                             EventBus())
+        self.assertIsNotNone(task.wait(WAIT))
+        self.assertFalse(task.failed)
+        self.assertEqual([name for name, _ in port.commands], ['beep'] * 3)
+
+    def test_class_must_be_importable_by_name(self):
+        class Register(CashRegister):
+            pass
+        self.assertRaises(ValueError, RenderPool, self.path,
+                          register_class=Register)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+""" LoremCross
+    Модуль работы с фискальными устройствами
+    Тесты политик повторов и бюджета времени (RetryPolicy, Deadline)
+"""
+import unittest
+
+from lc_cashcontrol.device_types.shtrih.retry import Deadline, \
+    ExponentialPolicy, RetryPolicies, RetryPolicy, LAYER_ACTION, LAYER_READ
+from lc_cashcontrol.device_types.shtrih.shtrih_cash_register import \
+    ShtrihCashRegister
+from lc_cashcontrol.device_types.shtrih.shtrih_constants import \
+    TIME_DELTA_STEP
+
+from fake_device import FakePort, register_class
+
+WAIT = 0.1
+
+
+class DeadlineTest(unittest.TestCase):
+
+    def test_unlimited(self):
+        deadline = Deadline()
+        self.assertIsNone(deadline.remaining())
+        self.assertFalse(deadline.expired)
+
+    def test_expired(self):
+        deadline = Deadline(0)
+        self.assertEqual(deadline.remaining(), 0.0)
+        self.assertTrue(deadline.expired)
+
+    def test_earliest(self):
+        short, long_ = Deadline(1), Deadline(10)
+        self.assertIs(Deadline.earliest(long_, None, short, Deadline()),
+                      short)
+        self.assertIsNone(Deadline.earliest(None, Deadline()))
+
+
+class RetryPolicyTest(unittest.TestCase):
+
+    def test_attempts(self):
+        self.assertEqual(list(RetryPolicy(3, 0).attempts()), [0, 1, 2])
+
+    def test_expired_budget_stops_retries(self):
+        attempts = RetryPolicy(5, 0.01).attempts(Deadline(0))
+        self.assertEqual(list(attempts), [0])
+
+    def test_max_time_stops_retries(self):
+        self.assertEqual(list(RetryPolicy(5, 0.01, max_time=0).attempts()),
+                         [0])
+
+    def test_exponential_delay(self):
+        policy = ExponentialPolicy(5, 0.1, factor=2.0, max_delay=0.3)
+        self.assertEqual([policy.delay(attempt) for attempt in (1, 2, 3)],
+                         [0.1, 0.2, 0.3])
+
+
+class RetryPoliciesTest(unittest.TestCase):
+
+    def test_class_policy_overrides_default(self):
+        policies = RetryPolicies()
+        paper = RetryPolicy(7, 0)
+        policies.set_policy(LAYER_ACTION, paper,
+                            policies.command_class('print_string'))
+        self.assertIs(policies.get(LAYER_ACTION, 'print_string'), paper)
+        self.assertIsNot(policies.get(LAYER_ACTION, 'beep'), paper)
+        self.assertIsNotNone(policies.get(LAYER_READ, 'print_string'))
+
+    def test_budget(self):
+        policies = RetryPolicies(budgets={})
+        self.assertIsNone(policies.budget('beep').remaining())
+        policies.set_budget(policies.command_class('beep'), 5)
+        self.assertTrue(0 < policies.budget('beep').remaining() <= 5)
+
+
+class UnansweredReadTest(unittest.TestCase):
+
+    def test_lost_reply_adds_one_step(self):
+        port = FakePort()
+        device = ShtrihCashRegister()
+        device.attach_transport(port)
+        register = register_class(self)(device)
+        register.update_smart('commands', beep=[WAIT, False])
+
+        # NOTE: Ответ приходит после истечения первого ожидания
+        port.delay(WAIT * 1.5)
+        response = register.execute('beep', kwargs={'timeout': WAIT})
+        self.assertIsNone(response['exception'])
+        self.assertAlmostEqual(response['delta'], TIME_DELTA_STEP)
+
+        register.fix_in_smart(response)
+        timeout, _ = register.get_commands_metric()['beep']
+        self.assertAlmostEqual(timeout, WAIT + TIME_DELTA_STEP)
+
+    def test_answered_read_lowers_one_step(self):
+        device = ShtrihCashRegister()
+        device.attach_transport(FakePort())
+        register = register_class(self)(device)
+        register.update_smart('commands', beep=[WAIT, False])
+
+        response = register.execute('beep', kwargs={'timeout': WAIT})
+        register.fix_in_smart(response)
+        timeout, _ = register.get_commands_metric()['beep']
+        self.assertAlmostEqual(timeout, WAIT - TIME_DELTA_STEP)
+
+
+if __name__ == '__main__':
+    unittest.main()
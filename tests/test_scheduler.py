@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+""" LoremCross
+    Модуль работы с фискальными устройствами
+    Тесты обработки ошибок планировщика команд (DeviceScheduler)
+"""
+import unittest
+from threading import Event
+
+from lc_cashcontrol.cash_register.events import EventBus, EVT_PLAN_FINISHED
+from lc_cashcontrol.cash_register.scheduler import DeviceScheduler
+
+WAIT = 5
+
+
+def ok(name):
+    return {'action': 'continue', 'command': name, 'exception': None,
+            'is_critical': False, 'post_critical': False, 'data': {},
+            'delta': 0, 'delta_for_last_command': 0}
+
+
+class Register(object):
+    """ Устройство планировщика: sale открывает чек, boom -- исключение """
+
+    def __init__(self, cancel_error=False):
+        self.in_critical_zone = False
+        self.cancel_error = cancel_error
+        self.cancelled = 0
+        self.calls = []
+        self.started = Event()
+        self.release = Event()
+
+    def run_step(self, index, item, bus=None):
+        name = item[0]
+        self.calls.append(name)
+        if name == 'boom':
+            raise RuntimeError('boom')
+        if name == 'slow':
+            self.started.set()
+            self.release.wait(WAIT)
+        if name == 'sale':
+            self.in_critical_zone = True
+        elif name == 'close_check':
+            self.in_critical_zone = False
+        return ok(name)
+
+    def make_cancel_check(self):
+        self.cancelled += 1
+        if self.cancel_error:
+            raise RuntimeError('cancel')
+        self.in_critical_zone = False
+
+    def log_warning(self, *_):
+        pass
+
+    def log_critical(self, *_):
+        pass
+
+
+class DeviceSchedulerTest(unittest.TestCase):
+
+    def make(self, **kwargs):
+        self.register = Register(**kwargs)
+        self.scheduler = DeviceScheduler(self.register)
+        self.addCleanup(self.scheduler.stop)
+        return self.scheduler
+
+    def test_exception_fails_task_and_keeps_worker(self):
+        scheduler = self.make()
+        task = scheduler.submit([('boom', (), {}), ('beep', (), {})])
+        results = task.wait(WAIT)
+        self.assertIsNotNone(results)
+        self.assertTrue(task.failed)
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]['exception']['error'], 'RuntimeError')
+        self.assertEqual(results[0]['action'], 'break')
+
+        self.assertIsNone(scheduler.call('beep')['exception'])
+        self.assertEqual(self.register.calls, ['boom', 'beep'])
+
+    def test_open_receipt_is_cancelled_before_next_task(self):
+        scheduler = self.make()
+        scheduler.submit([('sale', (), {})]).wait(WAIT)
+        self.assertTrue(self.register.in_critical_zone)
+
+        scheduler.call('beep')
+        self.assertEqual(self.register.cancelled, 1)
+        self.assertFalse(self.register.in_critical_zone)
+
+    def test_closed_receipt_is_not_cancelled(self):
+        scheduler = self.make()
+        scheduler.submit([('sale', (), {}), ('close_check', (), {})]).wait(
+            WAIT)
+        scheduler.call('beep')
+        self.assertEqual(self.register.cancelled, 0)
+
+    def test_failed_rollback_keeps_worker(self):
+        scheduler = self.make(cancel_error=True)
+        scheduler.submit([('sale', (), {})]).wait(WAIT)
+        self.assertIsNone(scheduler.call('beep')['exception'])
+        self.assertEqual(self.register.cancelled, 1)
+
+    def test_stop_fails_unfinished_tasks(self):
+        scheduler = self.make()
+        events = []
+        bus = EventBus()
+        bus.subscribe(events.append)
+        current = scheduler.submit([('slow', (), {}), ('beep', (), {})])
+        self.assertTrue(self.register.started.wait(WAIT))
+        queued = scheduler.submit([('beep', (), {})], bus=bus)
+
+        scheduler.stop(wait=False)
+        self.register.release.set()
+        for task in (current, queued):
+            results = task.wait(WAIT)
+            self.assertIsNotNone(results)
+            self.assertTrue(task.failed)
+            self.assertEqual(results[-1]['exception']['error'],
+                             'RuntimeError')
+        self.assertEqual(current.results[0]['command'], 'slow')
+        self.assertEqual(self.register.calls, ['slow'])
+        self.assertEqual(events[-1]['event'], EVT_PLAN_FINISHED)
+        self.assertFalse(events[-1]['success'])
+
+    def test_submit_after_stop_is_rejected(self):
+        scheduler = self.make()
+        scheduler.stop()
+        self.assertRaises(RuntimeError, scheduler.call, 'beep')
+
+
+if __name__ == '__main__':
+    unittest.main()
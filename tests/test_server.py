@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+""" LoremCross
+    Модуль работы с фискальными устройствами
+    Тесты сервера печати (PrintServer, ClientChannel)
+"""
+import json
+import os
+import shutil
+import socket
+import tempfile
+import time
+import unittest
+from threading import Thread
+
+from lc_cashcontrol.cash_register.events import DEFAULT_REACTION
+from lc_cashcontrol.cash_register.scheduler import PRIO_STATUS, \
+    PRIO_FISCAL, PRIO_REPORT, PRIO_HOUSEKEEPING
+from lc_cashcontrol.cash_register.server import ClientChannel, PrintClient, \
+    PrintServer, request_priority
+from lc_cashcontrol.device_types.shtrih.shtrih_cash_register import \
+    ShtrihCashRegister
+
+from fake_device import FakePort, register_class
+
+WAIT = 5
+PORT = '/dev/ttyFAKE0'
+SALE = [('sale', (10, ), {})]
+CASE = {'cases': {'retry': u"Повторить"}, 'exception': None}
+
+
+class Output(object):
+    """ Поток записи событий клиенту """
+
+    def __init__(self):
+        self.lines = []
+
+    def write(self, data):
+        self.lines.append(data)
+
+    def flush(self):
+        pass
+
+
+class PrintServerTest(unittest.TestCase):
+
+    def setUp(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        self.path = os.path.join(path, 'server.sock')
+
+        self.port = FakePort()
+        device = ShtrihCashRegister(PORT)
+        device.attach_transport(self.port)
+        self.server = PrintServer(decision_timeout=0)
+        self.server.add_device('kkt', register_class(self)(device))
+
+        thread = Thread(target=self.server.serve_unix, args=(self.path, ))
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.shutdown)
+        deadline = time.time() + WAIT
+        while not os.path.exists(self.path) and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_command_is_executed_on_device(self):
+        client = PrintClient(self.path)
+        self.addCleanup(client.close)
+        event = client.command('kkt', 'beep')
+        self.assertTrue(event['success'])
+        self.assertEqual([name for name, _ in self.port.commands], ['beep'])
+
+    def test_non_object_request_is_skipped(self):
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(client.close)
+        client.settimeout(WAIT)
+        client.connect(self.path)
+        client.sendall(b'[1, 2]\n"devices"\n{"id": 1, "op": "devices"}\n')
+        event = json.loads(client.makefile('rb').readline().decode('utf-8'))
+        self.assertEqual(event['devices'], ['kkt'])
+
+
+class RequestPriorityTest(unittest.TestCase):
+
+    def test_client_cannot_raise_priority(self):
+        self.assertEqual(request_priority(PRIO_STATUS, SALE), PRIO_FISCAL)
+        self.assertEqual(request_priority(PRIO_REPORT, SALE), PRIO_REPORT)
+        self.assertEqual(request_priority(99, SALE), PRIO_HOUSEKEEPING)
+
+    def test_invalid_priority_is_ignored(self):
+        for priority in (None, '0', 0.5, True, [0]):
+            self.assertEqual(request_priority(priority, SALE), PRIO_FISCAL)
+
+
+class ClientChannelTest(unittest.TestCase):
+
+    def decide(self, reaction):
+        output = Output()
+        channel = ClientChannel(output, decision_timeout=WAIT)
+        answers = []
+        thread = Thread(target=lambda: answers.append(
+            channel.ask(1, 'sale', CASE)))
+        thread.start()
+        deadline = time.time() + WAIT
+        while not output.lines and time.time() < deadline:
+            time.sleep(0.01)
+        decision = json.loads(output.lines[0].decode('utf-8'))['decision']
+        channel.reply(decision, reaction)
+        thread.join(WAIT)
+        return answers[0]
+
+    def test_known_reaction_is_passed(self):
+        self.assertEqual(self.decide(['wait', 'retry']), ['wait', 'retry'])
+
+    def test_unknown_reaction_is_replaced_by_default(self):
+        for reaction in (['drop'], 'retry', [], {'retry': 1}):
+            self.assertEqual(self.decide(reaction), DEFAULT_REACTION)
+
+
+if __name__ == '__main__':
+    unittest.main()
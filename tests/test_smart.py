@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+""" LoremCross
+    Модуль работы с фискальными устройствами
+    Тесты пространств имен метрики устройств (SMARTDescriptor, SmartMixin)
+"""
+import gc
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from lc_cashcontrol.cash_register.middleware import SMART_DEFAULT, \
+    SMARTDescriptor, SmartMixin
+
+from lc_cashcontrol.device_types.shtrih.shtrih_cash_register import \
+    ShtrihCashRegister
+
+from fake_device import FakePort, register_class
+
+METRIC_FILE = 'smart.json'
+LEGACY = {'device': {'port': '/dev/ttyS0', 'rate': 9600},
+          'commands': {'sale': [1.5, False]}}
+
+
+class SmartTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        # NOTE: Метрика записывается и при удалении объекта хранилища --
+        #   до удаления каталога
+        self.addCleanup(gc.collect)
+
+    def write(self, metric):
+        with open(os.path.join(self.path, METRIC_FILE), 'w') as handle:
+            json.dump(metric, handle)
+
+
+class SMARTDescriptorTest(SmartTestCase):
+
+    def test_legacy_file_is_default_namespace(self):
+        self.write(LEGACY)
+        storage = SMARTDescriptor(self.path, METRIC_FILE)
+        self.assertEqual(storage.namespaces, [SMART_DEFAULT])
+        self.assertEqual(storage.namespace()['commands'],
+                         LEGACY['commands'])
+
+    def test_read_does_not_create_namespace(self):
+        storage = SMARTDescriptor(self.path, METRIC_FILE)
+        self.assertEqual(storage.namespace('/dev/ttyUSB0'), {})
+        self.assertEqual(storage.namespaces, [])
+
+    def test_namespace_is_a_copy(self):
+        storage = SMARTDescriptor(self.path, METRIC_FILE)
+        storage.update_section('a', 'commands', beep=[0.1, False])
+        storage.namespace('a')['commands']['beep'] = [9, True]
+        self.assertEqual(storage.namespace('a')['commands']['beep'],
+                         [0.1, False])
+
+    def test_update_section_merges_and_persists(self):
+        storage = SMARTDescriptor(self.path, METRIC_FILE)
+        storage.update_section('a', 'commands', beep=[0.1, False])
+        storage.update_section('a', 'commands', sale=[1, False])
+        storage.update_section('b', 'commands', beep=[0.2, False])
+
+        reloaded = SMARTDescriptor(self.path, METRIC_FILE)
+        self.assertEqual(sorted(reloaded.namespace('a')['commands']),
+                         ['beep', 'sale'])
+        self.assertEqual(reloaded.namespace('b')['commands'],
+                         {'beep': [0.2, False]})
+
+
+class SmartMixinTest(SmartTestCase):
+
+    def make_class(self):
+        class Register(SmartMixin):
+            pass
+        Register.register_smart(self.path, METRIC_FILE)
+        return Register
+
+    def test_legacy_metric_moves_to_same_port_only(self):
+        self.write(LEGACY)
+        register_class = self.make_class()
+        storage = register_class.get_smart_storage()
+
+        same = register_class()
+        same.bind_smart('/dev/ttyS0')
+        self.assertEqual(storage.namespace('/dev/ttyS0'),
+                         {'commands': LEGACY['commands']})
+
+        other = register_class()
+        other.bind_smart('/dev/ttyS1')
+        self.assertEqual(other.get_commands_metric(), {})
+        self.assertNotIn('/dev/ttyS1', storage.namespaces)
+
+    def test_port_namespace_refined_by_fingerprint(self):
+        register_class = self.make_class()
+        register = register_class()
+        register.bind_smart('/dev/ttyS0')
+        register.update_smart('device', port='/dev/ttyS0', rate=115200)
+        register.update_smart('commands', beep=[0.1, False])
+
+        register.bind_smart('/dev/ttyS0|0.0.1')
+        self.assertEqual(register.get_commands_metric(),
+                         {'beep': [0.1, False]})
+        self.assertEqual(register.get_device_metric(), {})
+
+    def test_metric_getters_on_class_and_instance(self):
+        self.write(LEGACY)
+        register_class = self.make_class()
+        self.assertEqual(register_class.get_commands_metric(),
+                         LEGACY['commands'])
+        register = register_class()
+        register.bind_smart('/dev/ttyS1')
+        self.assertEqual(register.get_commands_metric(), {})
+
+        metric = register_class.get_commands_metric()
+        metric['beep'] = [1, False]
+        self.assertNotIn('beep', register_class.get_commands_metric())
+
+
+class Device(object):
+    """ Профильный класс, подключающийся к порту по команде """
+    dev_type = 'Shtrih'
+    check_width = 38
+
+    def __init__(self, port=None):
+        self.port = port
+
+    def delta_step(self):
+        return 0.01
+
+    def init_cash_register(self, port, rate):
+        self.port = port
+        return {'action': 'continue', 'exception': None,
+                'is_critical': False, 'data': {}}
+
+    def find_device(self, port_group=None, rate=None):
+        return self.init_cash_register(port_group, rate)
+
+
+class RegisterNamespaceTest(SmartTestCase):
+
+    def test_found_device_gets_port_namespace(self):
+        Register = register_class(self)
+        first, second = Register(Device()), Register(Device())
+        self.assertEqual(first.smart_namespace, SMART_DEFAULT)
+
+        first.execute('find_device', ('/dev/ttyS0',))
+        second.execute('init_cash_register', ('/dev/ttyS1', 9600))
+        self.assertEqual(first.smart_namespace, '/dev/ttyS0')
+        self.assertEqual(second.smart_namespace, '/dev/ttyS1')
+
+        first.update_smart('commands', beep=[0.1, False])
+        self.assertEqual(second.get_commands_metric(), {})
+
+    def test_saved_connection_binds_port_namespace(self):
+        Register = register_class(self)
+        Register.get_smart_storage().update_section(
+            SMART_DEFAULT, 'device', **LEGACY['device'])
+        Register.get_smart_storage().update_section(
+            SMART_DEFAULT, 'commands', **LEGACY['commands'])
+
+        register = Register(Device())
+        self.assertEqual(register.smart_namespace, '/dev/ttyS0')
+        self.assertEqual(register.metric, LEGACY['commands'])
+
+    def test_fingerprint_namespace_is_read_after_restart(self):
+        Register = register_class(self)
+        register = Register(Device('/dev/ttyS0'))
+        register.bind_device_namespace({'device_type': 0,
+                                        'device_subtype': 0,
+                                        'device_model': 1})
+        register.set_connection_parameters('/dev/ttyS0', 115200)
+
+        restarted = Register(Device('/dev/ttyS0'))
+        self.assertEqual(restarted.smart_namespace, '/dev/ttyS0|0.0.1')
+        self.assertEqual(restarted.get_device_metric()['rate'], 115200)
+
+
+class CalibrationTest(SmartTestCase):
+
+    def test_line_lengths_are_stored(self):
+        device = ShtrihCashRegister('/dev/ttyFAKE0')
+        device.attach_transport(FakePort())
+        register = register_class(self)(device)
+
+        calibrated = register.calibrate(tries=1, lengths=(1, 19), plan=[])
+        metric = register.get_calibration_metric()
+        self.assertEqual(sorted(metric), ['print_string:1', 'print_string:19'])
+        self.assertEqual(metric['print_string:19'],
+                         calibrated['print_string:19'])
+        self.assertEqual(register.get_commands_metric()['print_string'][0],
+                         max(metric.values()))
+
+
+if __name__ == '__main__':
+    unittest.main()